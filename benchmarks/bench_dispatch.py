@@ -0,0 +1,73 @@
+#
+# Microbenchmark: finding the service for a request URI with many prefix services, as in a multiserver
+# configuration generated from templates
+#
+# "linear" is the previous HTTPServer.dispatch: copy the service list under the server lock and try
+# the services one by one with uri.startswith(prefix), first match wins.
+# "trie" is ServiceDispatcher: longest prefix match over a trie of path segments.
+#
+# Usage: python benchmarks/bench_dispatch.py [iterations]
+#
+
+import sys, os, timeit, threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from webpie.HTTPServer import ServiceDispatcher
+
+class PrefixService(object):
+
+    def __init__(self, prefix):
+        self.Prefix = prefix
+
+    def accept(self, uri):
+        return uri.startswith(self.Prefix), "accepted"
+
+EXPERIMENTS = ["icarus", "sbnd", "protodune", "dune", "lariat", "uboone", "minerva", "nova", "mu2e", "hw"]
+PREFIXES = (
+    ["/%s_off_ucon_prod/app/" % (e,) for e in EXPERIMENTS]
+    + ["/%s_on_ucon_prod/app/" % (e,) for e in EXPERIMENTS]
+    + ["/%s_con_prod/app/" % (e,) for e in EXPERIMENTS]
+    + ["/%s_con_dev/app/" % (e,) for e in EXPERIMENTS]
+    + ["/QE/%s/" % (e,) for e in EXPERIMENTS]
+)
+
+SERVICES = [PrefixService(prefix) for prefix in PREFIXES]
+
+URIS = {
+    "first service":    "/icarus_off_ucon_prod/app/data/folder?t=123",
+    "middle service":   "/lariat_con_prod/app/get?folder=x&t=1",
+    "last service":     "/QE/hw/query?q=abc",
+    "no match":         "/favicon.ico",
+}
+
+def linear(lock, services, uri):
+    with lock:
+        services = services[:]
+    for service in services:
+        match, status = service.accept(uri)
+        if match:
+            return service
+    return None
+
+def trie(dispatcher, uri):
+    for service in dispatcher.candidates(uri):
+        match, status = service.accept(uri)
+        if match:
+            return service
+    return None
+
+def main():
+    n = int(sys.argv[1]) if sys.argv[1:] else 200000
+    lock = threading.RLock()
+    dispatcher = ServiceDispatcher(SERVICES)
+    print("%d services" % (len(SERVICES),))
+    print("%-16s %12s %10s" % ("uri", "linear, us", "trie, us"))
+    for name, uri in URIS.items():
+        assert linear(lock, SERVICES, uri) is trie(dispatcher, uri)
+        t_linear = timeit.timeit(lambda: linear(lock, SERVICES, uri), number=n)/n*1e6
+        t_trie = timeit.timeit(lambda: trie(dispatcher, uri), number=n)/n*1e6
+        print("%-16s %12.2f %10.2f" % (name, t_linear, t_trie))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+#
+# Microbenchmark: per-request cost of building the WSGI environ and parsing the query string
+#
+# Compares the previous implementation with the current one. Previously:
+#   - the environ was built by a loop over the headers with lower()/upper().replace()
+#   - the query string was parsed 3 times: for query_dict, by WPApp.parseQuery and by request.GET
+#   - WPApp created 2 Request objects per request, each creating a Response object
+#
+# Usage: python benchmarks/bench_environ.py [iterations]
+#
+
+import sys, os, timeit
+from urllib.parse import unquote_plus
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from webpie.HTTPServer import HTTPHeader, Request, BodyFile
+from webpie.WPApp import WPApp, Request as WPRequest
+from webpie.webob import Request as webob_request, Response
+
+RAW = (
+    b"GET /api/v1/items/search?q=blue+shoes&page=2&size=50&sort=price&tag=a&tag=b HTTP/1.1\r\n"
+    b"Host: shop.example.com:8080\r\n"
+    b"User-Agent: Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko)\r\n"
+    b"Accept: application/json, text/plain, */*\r\n"
+    b"Accept-Language: en-US,en;q=0.9\r\n"
+    b"Accept-Encoding: gzip, deflate, br\r\n"
+    b"Cookie: webpie_session_id=0123456789abcdef; theme=dark\r\n"
+    b"Referer: https://shop.example.com/catalog\r\n"
+    b"X-Requested-With: XMLHttpRequest\r\n"
+    b"Connection: keep-alive\r\n"
+    b"\r\n"
+)
+
+def old_parse_query(query, unquote):
+    out = {}
+    for w in query.split("&"):
+        if w:
+            words = w.split("=", 1)
+            k = words[0]
+            if k:
+                v = None
+                if len(words) > 1:  v = unquote_plus(words[1]) if unquote else words[1]
+                if k in out:
+                    old = out[k]
+                    if not isinstance(old, list):
+                        old = out[k] = [old]
+                    old.append(v)
+                else:
+                    out[k] = v
+    return out
+
+def old_wsgi_env(request):
+    header = request.HTTPHeader
+    env = dict(
+        REQUEST_METHOD = header.Method.upper(),
+        PATH_INFO = header.path(),
+        SCRIPT_NAME = "",
+        SCRIPT_FILENAME = "",
+        SERVER_PROTOCOL = header.Protocol,
+        QUERY_STRING = header.query(),
+    )
+    env.update(request.Environ)
+    env["REQUEST_SCHEME"] = env["wsgi.url_scheme"] = "http"
+    env["WebPie.request_id"] = request.Id
+    env["WebPie.headers"] = header.Headers
+    env["query_dict"] = old_parse_query(header.query(), False)
+    body_length = 0
+    for h, v in header.Headers.items():
+        h = h.lower()
+        if h == "content-type": env["CONTENT_TYPE"] = v
+        elif h == "host":
+            words = v.split(":",1)
+            words.append("")
+            env["HTTP_HOST"] = v
+            env["SERVER_NAME"] = words[0]
+            env["SERVER_PORT"] = words[1]
+        elif h == "content-length":
+            env["CONTENT_LENGTH"] = body_length = int(v)
+        else:
+            env["HTTP_%s" % (h.upper().replace("-","_"),)] = v
+    env["wsgi.input"] = BodyFile(request.Body, None, body_length)
+    return env
+
+class OldRequest(WPRequest):
+
+    def __init__(self, *params, **args):
+        WPRequest.__init__(self, *params, **args)
+        self._response = Response()
+
+    GET = webob_request.GET
+
+def make_request():
+    header = HTTPHeader()
+    header.consume(RAW)
+    request = Request(8080, None, ("127.0.0.1", 50000))
+    request.HTTPHeader = header
+    return request
+
+app = WPApp(None)
+
+def before():
+    request = make_request()
+    env = old_wsgi_env(request)
+    req = OldRequest(env)
+    args = old_parse_query(env["QUERY_STRING"], True)
+    return OldRequest(env).GET
+
+def after():
+    request = make_request()
+    env = request.wsgi_env()
+    args = app.queryArgs(env)
+    return WPRequest(env).GET
+
+def header_only():
+    return make_request()
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    assert list(before().items()) == list(after().items())
+    base = min(timeit.repeat(header_only, number=n, repeat=3))
+    t_before = min(timeit.repeat(before, number=n, repeat=3)) - base
+    t_after = min(timeit.repeat(after, number=n, repeat=3)) - base
+    print("header parsing (not included):  %.2f us/request" % (base/n*1e6,))
+    print("before:                         %.2f us/request" % (t_before/n*1e6,))
+    print("after:                          %.2f us/request" % (t_after/n*1e6,))
+    print("saving:                         %.2f us/request (%.0f%%)" % ((t_before-t_after)/n*1e6, (1-t_after/t_before)*100))
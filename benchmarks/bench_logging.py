@@ -0,0 +1,70 @@
+#
+# Microbenchmark: the logging hot path used by Service.taskEnded and RequestReader:
+#   Logged.log() -> Logger.log() -> LogChannel.log() -> LogFile.log()
+#
+# "before" replaces the timestamp formatting and the log rotation check with the previous implementation
+# (datetime + strftime for every line, datetime.date.today() for every line)
+#
+# Usage: python benchmarks/bench_logging.py [iterations]
+#
+
+import sys, os, time, datetime, timeit, tempfile, shutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from webpie.logs import Logger, Logged
+from webpie.logs import log_file
+
+def old_make_timestamp(t=None):
+    if t is None:
+        t = datetime.datetime.now()
+    elif isinstance(t, (int, float)):
+        t = datetime.datetime.fromtimestamp(t)
+    return t.strftime("%m/%d/%Y %H:%M:%S") + ".%03d" % (t.microsecond//1000)
+
+def old_rollover_needed(log_file_object):
+    def rollover_needed(t):
+        log_file_object.LastLog = datetime.date.today()
+        return False
+    return rollover_needed
+
+class Server(Logged):
+    pass
+
+LINE = 'Jst.001 127.0.0.1:50000 :8080 GET /api/items?page=2 -> app /api/items 200 1234'
+
+def run(n, path, background, old):
+    logger = Logger(path, debug=False, background=background)
+    server = Server("[server 8080]", logger=logger)
+    writer = logger.Channels["log"].Writer
+    new_make_timestamp = log_file.make_timestamp
+    if old:
+        log_file.make_timestamp = old_make_timestamp
+        writer.rolloverNeeded = old_rollover_needed(writer)
+    try:
+        t = min(timeit.repeat(lambda: server.log(LINE), number=n, repeat=3))
+        writer.flush()
+    finally:
+        log_file.make_timestamp = new_make_timestamp
+    writer.close()
+    return t/n*1e6
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    tmp = tempfile.mkdtemp()
+    try:
+        t = time.time()
+        print("make_timestamp:       before %.2f us   after %.2f us" % (
+            min(timeit.repeat(lambda: old_make_timestamp(t), number=n, repeat=3))/n*1e6,
+            min(timeit.repeat(lambda: log_file.make_timestamp(t), number=n, repeat=3))/n*1e6
+        ))
+        i = 0
+        for background in (False, True):
+            times = []
+            for old in (True, False):
+                i += 1
+                times.append(run(n, os.path.join(tmp, "log%d" % (i,)), background, old))
+            print("Logged.log(), %-10s before %.2f us   after %.2f us (on the calling thread)" % (
+                "background" if background else "sync", times[0], times[1]))
+    finally:
+        shutil.rmtree(tmp)
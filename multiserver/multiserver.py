@@ -1,10 +1,12 @@
-import traceback, sys, time, signal, importlib, yaml, os, os.path, datetime, threading, pprint
+import traceback, sys, time, random, gc, signal, importlib, yaml, os, os.path, datetime, threading, pprint
 from pythreader import Task, TaskQueue, Primitive, synchronized, PyThread, LogFile
 from webpie import HTTPServer, RequestProcessor, yaml_expand as expand, init_uid
 from multiprocessing import Process, Pipe
-from webpie.logs import Logger, Logged
+from multiprocessing.connection import wait as wait_for_messages
+from webpie.logs import Logger, Logged, LogChannel
+from webpie.HTTPServer import listen_socket, DefaultBacklog, ServiceQueue
 
-import re, socket
+import re, socket, selectors
 
 def to_bytes(s):    
     return s if isinstance(s, bytes) else s.encode("utf-8")
@@ -45,6 +47,73 @@ def services_from_config(config):
 class RequestTask(RequestProcessor):
     pass
 
+class AdaptiveTaskQueue(ServiceQueue):
+
+    #
+    # ServiceQueue with the number of concurrently running tasks adjusted between min_workers and max_workers.
+    # The limit grows when the tasks waiting in the queue would wait longer than target_wait, estimated from
+    # the average task run time, and shrinks by one every idle_time seconds during which the queue had no waiting
+    # tasks and the running tasks did not reach the limit.
+    # Each task runs in its own thread, created when the task starts, so there are no idle worker threads to
+    # release: lowering the limit does not interrupt running tasks, it only makes the next burst of requests
+    # queue up to target_wait before the limit grows again.
+    # adapt() is called when tasks are started and periodically by the Housekeeper, so that the limit goes
+    # down while the service receives no requests
+    #
+
+    def __init__(self, min_workers, max_workers, capacity=None, delegate=None, target_wait=0.1, idle_time=30.0, **args):
+        # args: ServiceQueue admission control parameters
+        ServiceQueue.__init__(self, min_workers, capacity=capacity, delegate=delegate, **args)
+        self.MinWorkers = min_workers
+        self.MaxWorkers = max_workers
+        self.TargetWait = target_wait
+        self.IdleTime = idle_time
+        self.RunTime = None             # exponential moving average of the task run time
+        self.LastBusy = time.monotonic()
+
+    @synchronized
+    def start_tasks(self):
+        self.adapt()
+        ServiceQueue.start_tasks(self)
+
+    def taskDone(self, task):
+        if task.Started is not None and task.Ended is not None:
+            t = task.Ended - task.Started
+            with self:
+                self.RunTime = t if self.RunTime is None else self.RunTime*0.9 + t*0.1
+        ServiceQueue.taskDone(self, task)
+
+    @synchronized
+    def adapt(self):
+        # returns True if the limit was raised
+        nwaiting, nrunning = self.counts()
+        nworkers = self.NWorkers
+        backlog = nwaiting - (nworkers - nrunning)     # tasks, which can not start now
+        now = time.monotonic()
+        if backlog >= 0:
+            self.LastBusy = now
+        if backlog > 0 and nworkers < self.MaxWorkers:
+            run_time = self.RunTime
+            if run_time is None or backlog * run_time / nworkers > self.TargetWait:
+                self.NWorkers = min(self.MaxWorkers, nrunning + nwaiting)
+        elif nworkers > self.MinWorkers and now > self.LastBusy + self.IdleTime:
+            self.NWorkers = nworkers - 1
+            self.LastBusy = now
+        if self.NWorkers != nworkers:
+            self.call_delegate("workersChanged", self, self.NWorkers)
+        return self.NWorkers > nworkers
+
+def load_services(config, logger, owner):
+    # owner: Logged object to report services, which failed to initialize
+    service_list = []
+    for svc_cfg in services_from_config(config):
+        svc = Service(svc_cfg, logger)
+        if svc.Initialized:
+            service_list.append(svc)
+        else:
+            owner.log(f'service "{svc.ServiceName}" failed to initialize - removing from service list')
+    return service_list
+
 class Service(Primitive, Logged):
     
     def __init__(self, config, logger=None):
@@ -74,6 +143,7 @@ class Service(Primitive, Logged):
         self.Prefix = config.get("prefix", "/")
         self.ReplacePrefix = config.get("replace_prefix")
         self.Timeout = config.get("timeout", 10)
+        self.AccessLog = bool(config.get("access_log"))     # JSON lines with request timings, written by MPLogger
 
         saved_path = sys.path[:]
         saved_modules = set(sys.modules.keys())
@@ -143,15 +213,27 @@ class Service(Primitive, Logged):
             self.WSGIApp = app
 
             max_workers = config.get("max_workers", 5)
+            min_workers = min(config.get("min_workers", max_workers), max_workers)
             queue_capacity = config.get("queue_capacity", 10)
             self.QueueTimeout = config.get("queue_timeout", 0)
-            self.RequestQueue = TaskQueue(max_workers, capacity = queue_capacity, delegate=self)
+            admission = ServiceQueue.config_args(config)
+            if min_workers < max_workers:
+                self.RequestQueue = AdaptiveTaskQueue(min_workers, max_workers, capacity = queue_capacity, delegate=self,
+                    target_wait = config.get("target_queue_wait", 0.1),
+                    idle_time = config.get("workers_idle_time", 30.0),
+                    **admission
+                )
+            else:
+                self.RequestQueue = ServiceQueue(max_workers, capacity = queue_capacity, delegate=self, **admission)
             log_message = f"""\
                 prefix:               {self.Prefix}
                 replace prefix:       {self.ReplacePrefix}
+                min workers:          {min_workers}
                 max workers:          {max_workers}
                 queue capacity:       {queue_capacity}
                 queue timeout:        {self.QueueTimeout}
+                queue discipline:     {admission["discipline"]}
+                request deadline:     {admission["deadline"]}
                 timeout:              {self.Timeout}
                 wsgi app:             {app}
                   args:               {args}
@@ -184,6 +266,15 @@ class Service(Primitive, Logged):
         except:
             pass
 
+    def adapt_workers(self):
+        # called periodically by the Housekeeper
+        queue = self.RequestQueue
+        if isinstance(queue, AdaptiveTaskQueue) and queue.adapt():
+            queue.start_tasks()
+
+    def workersChanged(self, queue, nworkers):
+        self.debug("workers limit changed to", nworkers)
+
     def interval(self, x, y):
         if x is None or y is None:
             return 0.0
@@ -203,6 +294,8 @@ class Service(Primitive, Logged):
                         task.StatusCode, task.ByteCount, start_time, processing_time, error
                     )
         self.log(log_line, channel="requests")
+        if self.AccessLog and request.Timings is not None:
+            self.log(request.access_record(task), channel="access")
 
     def accept(self, request):
         #print(f"Service {self}: accept()")
@@ -224,10 +317,15 @@ class Service(Primitive, Logged):
                 script_path = script_path[:-1]
             request.Environ["SCRIPT_NAME"] = script_path
             request.Environ["SCRIPT_FILENAME"] = self.ScriptFileName
+            timings = request.Timings
+            if not self.AccessLog:
+                request.Timings = None
             try:
-                self.RequestQueue.add(RequestTask(self.WSGIApp, request), timeout=self.QueueTimeout)
+                self.RequestQueue.add(RequestTask(self.WSGIApp, request, admission=self.RequestQueue), timeout=self.QueueTimeout)
             except RuntimeError:
-                # queue is full
+                # queue is full, the request will be logged as rejected
+                request.Timings = timings
+                request.RetryAfter = self.RequestQueue.retry_after()
                 return True, "service unavailable"
                 
             #print("Service", self, "   accepted")
@@ -246,19 +344,46 @@ class Service(Primitive, Logged):
         try:    return os.path.getmtime(path)
         except: return None
 
-    def reloadIfNeeded(self):
+    def reloadNeeded(self):
         for path, old_timestamp in self.ReloadFileTimestamps.items():
             mt = self.mtime(path)
             if mt is not None and mt != old_timestamp:
                 ct = time.ctime(mt)
                 self.log(f"file {path} was modified at {ct}")
-                break
-        else:
+                return True
+        return False
+
+    def reloadIfNeeded(self):
+        if not self.reloadNeeded():
             return False
         self.Initialized = self.initialize()
         
+class LogFlusher(PyThread):
+
+    def __init__(self, mplogger, interval):
+        PyThread.__init__(self, name="LogFlusher", daemon=True)
+        self.MPLogger = mplogger
+        self.Interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.Interval)
+            self.MPLogger.flush()
+
 class MPLogger(PyThread, Logged):
     
+    #
+    # Subprocesses send log messages to the master process in batches, which are sent when BatchSize messages
+    # are accumulated or after FlushInterval seconds. The timer thread is started on the first message logged
+    # by each process.
+    # With "per_process_logs: true", each subprocess writes its own requests and access log files,
+    # <path>.<pid>, directly instead of sending the messages to the master.
+    #
+
+    BatchSize = 100
+    FlushInterval = 0.1
+    ServerWho = "(server)"      # sender of the access records of requests, which were not dispatched to a service
+
     def __init__(self, config_file, queue_size=-1, log_path = None, debug = None, requests_path = None, name=None):
         import multiprocessing
         name = name or "MPLogger"
@@ -271,8 +396,20 @@ class MPLogger(PyThread, Logged):
         self.LogPath = log_path
         self.RequestsPath = requests_path
         self.ForceDebug = debug
+        self.PerProcessLogs = False
+        self.DirectPaths = {}       # {(service, channel) -> path}
+        self.ServerAccess = None    # LogChannel for the access records of requests rejected before dispatch
         #print("MPLogger: force debug:", debug)
         self.reconfigure()
+        self.forked()
+        os.register_at_fork(after_in_child=self.forked)
+
+    def forked(self):
+        # subprocess side state, not inherited from the parent process
+        self.Batch = []
+        self.BatchLock = threading.Lock()
+        self.Flusher = None
+        self.DirectChannels = {}    # {(service, channel) -> LogChannel}
 
     def reconfigure(self):
         #
@@ -282,6 +419,10 @@ class MPLogger(PyThread, Logged):
         config = expand(yaml.load(open(self.ConfigFile, 'r'), Loader=yaml.SafeLoader))
         log_config = config.get("logger", {})
         split_by_servrce = log_config.get("split", False)
+        self.BatchSize = log_config.get("batch_size", self.BatchSize)
+        self.FlushInterval = log_config.get("flush_interval", self.FlushInterval)
+        self.PerProcessLogs = log_config.get("per_process_logs", False)
+        self.DirectPaths = {}
         logs_dir = log_config.get("logs_dir", "logs")
         if not os.path.isdir(logs_dir):
             raise ValueError(f"Logs directory {logs_dir} not found")
@@ -308,20 +449,45 @@ class MPLogger(PyThread, Logged):
             logger = Logger(log_path, debug=debug)
             #print(f"Service {name}: adding requests channel ->", requests_path)
             logger.add_channel("requests", path=requests_path)
+            self.DirectPaths[(name, "requests")] = requests_path
+            access_path = service_cfg.get("access_log")
+            if access_path:
+                if not access_path.startswith('/') and access_path != "-":
+                    access_path = logs_dir + "/" + access_path
+                logger.add_channel("access", path=access_path, timestamps=False, show_who=False)
+                self.DirectPaths[(name, "access")] = access_path
             self.Loggers[name] = logger
             #print(f"MPLogger: added logger for service '{name}'")
 
+        # requests rejected before they were dispatched to a service (invalid, no matching service, service queue full)
+        access_path = config.get("access_log")
+        if access_path is None and any(key[1] == "access" for key in self.DirectPaths):
+            access_path = "server.access.jsonl"
+        self.ServerAccess = None
+        if access_path:
+            if not access_path.startswith('/') and access_path != "-":
+                access_path = logs_dir + "/" + access_path
+            self.ServerAccess = LogChannel(access_path, timestamps=False, show_who=False)
+            self.DirectPaths[(self.ServerWho, "access")] = access_path
+
     def run(self):
         while True:
             self.process_message()
     
     def process_message(self):
-        msg = self.Queue.get()
+        batch = self.Queue.get()
+        for msg in batch:
+            self.process_one(msg)
+
+    def process_one(self, msg):
         who, channel, t = msg[:3]
         parts = msg[3:]
         #print("MPLogger: message:", who, channel, t, parts)
         if who in self.Loggers:
             self.Loggers[who].log(*parts, who=f"[{who}]", t=t, channel=channel)
+        elif channel == "access":
+            if self.ServerAccess is not None:
+                self.ServerAccess.log(None, *parts, t=t)
         else:
             Logged.log(self, *parts, who=who, t=t, channel=channel)
     
@@ -330,8 +496,40 @@ class MPLogger(PyThread, Logged):
     #
     def log(self, *message, sep=" ", who=None, t=None, channel="log"):
         #print("MPLogger(subprocess side).log: channel:", channel, "  message:", *message)
-        message = tuple(str(p) for p in message)
-        self.Queue.put((who, channel, time.time())+message)
+        message = sep.join([str(p) for p in message])
+        t = time.time()
+        if channel == "access" and who not in self.Loggers:
+            who = self.ServerWho
+        if self.PerProcessLogs and (who, channel) in self.DirectPaths:
+            return self.direct_channel(who, channel).log(f"[{who}]", message, t=t)
+        batch = None
+        with self.BatchLock:
+            self.Batch.append((who, channel, t, message))
+            if len(self.Batch) >= self.BatchSize:
+                batch, self.Batch = self.Batch, []
+            elif self.Flusher is None:
+                self.Flusher = LogFlusher(self, self.FlushInterval)
+                self.Flusher.start()
+        if batch:
+            self.Queue.put(batch)
+
+    def flush(self):
+        with self.BatchLock:
+            batch, self.Batch = self.Batch, []
+        if batch:
+            self.Queue.put(batch)
+
+    def direct_channel(self, who, channel):
+        key = (who, channel)
+        with self.BatchLock:
+            log_channel = self.DirectChannels.get(key)
+            if log_channel is None:
+                path = self.DirectPaths[key]
+                if path != "-":
+                    path = "%s.%d" % (path, os.getpid())
+                access = channel == "access"
+                log_channel = self.DirectChannels[key] = LogChannel(path, timestamps=not access, show_who=not access)
+        return log_channel
             
     def debug(self, who, *parts):
         if self.Debug.get(who):
@@ -371,12 +569,51 @@ class Monitor(PyThread, Logged):
                 break
             time.sleep(30)
 
+class Housekeeper(PyThread):
+
+    #
+    # Runs in the subprocess. Receives messages from the master, checks whether the master is still alive,
+    # adjusts the services' workers limits and periodically checks the configuration and the touch_reload files,
+    # so that the accept loop does not have to
+    #
+
+    def __init__(self, subprocess):
+        PyThread.__init__(self, name="Housekeeper", daemon=True)
+        self.Subprocess = subprocess
+
+    def run(self):
+        subprocess = self.Subprocess
+        next_check = time.monotonic() + subprocess.CheckConfigInterval
+        while not subprocess.Stop:
+            try:
+                if subprocess.ConnectionToMaster.poll(subprocess.MasterCheckInterval):
+                    subprocess.master_message(subprocess.ConnectionToMaster.recv())
+                if not subprocess.master_alive():
+                    print("master process died")
+                    subprocess.Stop = True
+                elif subprocess.recycle_needed():
+                    subprocess.request_recycle()
+                else:
+                    subprocess.adapt_workers()
+                    if time.monotonic() >= next_check:
+                        subprocess.check_config()
+                        next_check = time.monotonic() + subprocess.CheckConfigInterval
+            except EOFError:
+                # the pipe to the master is closed
+                subprocess.Stop = True
+            except Exception:
+                subprocess.error("Exception in housekeeping:\n", traceback.format_exc())
+                time.sleep(subprocess.MasterCheckInterval)
+
 class MultiServerSubprocess(Process, Logged):
     
-    def __init__(self, port, sock, config_file, logger=None):
+    def __init__(self, port, sock, config_file, logger=None, services=None):
+        # sock=None: the subprocess listens on its own SO_REUSEPORT socket
+        # services: Service objects created by the master before the fork, used instead of loading the applications
         Process.__init__(self, daemon=True)
         #print("MultiServerSubprocess.__init__: logger:", logger)
         self.Sock = sock
+        self.OwnSocket = sock is None
         self.Logger = logger
         self.Port = port
         self.Server = None
@@ -384,9 +621,12 @@ class MultiServerSubprocess(Process, Logged):
         self.ConfigFile = config_file   # path
         self.ReconfiguredTime = 0
         self.Services = []
+        self.Preloaded = services
         self.MasterSide = True
         self.Stop = False
         self.MasterPID = os.getpid()
+        self.Started = None
+        self.RecycleRequested = False
         Logged.__init__(self, f"[Subprocess {self.MasterPID}]", logger=logger)
         #for key, value in sorted(self.__dict__.items()):
         #    print(key, type(value), value)
@@ -395,25 +635,30 @@ class MultiServerSubprocess(Process, Logged):
         #print("MultiServerSubprocess.reconfigure()...")
         self.ReconfiguredTime = os.path.getmtime(self.ConfigFile)
         self.Config = config = expand(yaml.load(open(self.ConfigFile, 'r'), Loader=yaml.SafeLoader))
-        service_list = []
-        for svc_cfg in services_from_config(config):
-            svc = Service(svc_cfg, self.Logger)
-            if svc.Initialized:
-                service_list.append(svc)
-            else:
-                self.log(f'service "{svc.ServiceName}" failed to initialize - removing from service list')
+        preloaded, self.Preloaded = self.Preloaded, None
+        if preloaded is not None:
+            service_list = preloaded
+        else:
+            service_list = load_services(config, self.Logger, self)
         if self.Server is None:
             self.Server = HTTPServer.from_config(self.Config, service_list, logger=self.Logger)
         else:
             self.Server.setServices(service_list)
+        # timings are collected for all requests if rejected requests are logged, services without access log drop them
+        server_access = isinstance(self.Logger, MPLogger) and self.Logger.ServerAccess is not None
+        self.Server.AccessLog = server_access or any(svc.AccessLog for svc in service_list)
         self.log(f"Server configured with services:", ",\n".join([s.ServiceName for s in service_list]))
         self.Services = service_list
         #print("MultiServerSubprocess.reconfigure() done")
 
     CheckConfigInterval = 5.0
     MonitorInterval = 60.0
+    MasterCheckInterval = 1.0
+    AcceptPollInterval = 1.0        # how often the accept loop checks whether it should stop
+    MaxAcceptBatch = 16             # connections accepted per wakeup
         
     def run(self):
+        gc.enable()         # the master disables it while preloading and forking
         self.Monitor = Monitor(self.Logger)
 
         init_uid(tag="%03d" % (os.getpid() % 1000,))
@@ -424,47 +669,104 @@ class MultiServerSubprocess(Process, Logged):
         self.LogName = f"MultiServerSubprocess({pid})"
         self.reconfigure()
         self.MasterSide = False
-        self.Sock.settimeout(5.0)
+        if self.OwnSocket:
+            self.Sock = listen_socket(self.Port, self.Config.get("listen_backlog", DefaultBacklog), reuse_port=True)
+        self.Sock.setblocking(False)
+        self.Started = time.monotonic()
+        self.MaxRequests = self.Config.get("max_requests")
+        self.MaxAge = self.Config.get("max_age")
+        if self.MaxAge:
+            self.MaxAge *= 1.0 + random.random()*0.1        # do not recycle all the workers at once
+        # with preload, configuration changes are applied by the master, see MPMultiServer
+        self.RollingRestart = self.Config.get("rolling_restart", False) or self.Config.get("preload", False)
+        self.ConnectionToMaster.send("ready")
 
         #self.Scheduler = Scheduler(max_concurrent = 2, daemon = True)
         #self.Scheduler.add(self.check_config, interval = self.CheckConfigInterval, t0 = time.time() + self.CheckConfigInterval)
         #self.Scheduler.add(self.run_monitor, interval = self.MonitorInterval)
 
-        while not self.Stop:
-            
-            self.check_config()
-            
-            # see if the parent process is still alive
-            try:    os.kill(self.MasterPID, 0)
-            except:
-                print("master process died")
-                break
+        Housekeeper(self).start()
+        selector = selectors.DefaultSelector()
+        selector.register(self.Sock, selectors.EVENT_READ)
+        try:
+            while not self.Stop:
+                if selector.select(self.AcceptPollInterval):
+                    self.accept_pending()
+        finally:
+            selector.close()
 
-            try:    csock, caddr = self.Sock.accept()
-            except socket.timeout:
-                pass
-            else:
-                #print("run(): services:", [str(s) for s in self.Services])
-                self.Server.connection_accepted(csock, caddr)
-
-            if self.ConnectionToMaster.poll(0):
-                msg = self.ConnectionToMaster.recv()
-                self.log("message from master:", msg)
-                if msg == "stop":
-                    self.Stop = True
-                elif msg == "reconfigure":
-                    self.reconfigure()
+        if self.OwnSocket:
+            # the kernel keeps distributing new connections to this SO_REUSEPORT socket until it is closed,
+            # and resets the ones left in its queue on close:
+            # accept everything queued and close the socket before finishing the requests
+            self.accept_pending(all=True)
+            self.Sock.close()
 
         #self.Scheduler.stop()
-        self.Server.close()
-        self.Server.join()
+        # finish the requests already accepted
+        self.Server.drain()
+        for svc in self.Services:
+            svc.join()
+        self.Server.drain()         # in case a request processor handed a persistent connection back
         for svc in self.Services:
-            svc.close()
             svc.join()
+            svc.close()
+        if isinstance(self.Logger, MPLogger):
+            self.Logger.flush()         # send the messages still batched
     
+    def accept_pending(self, all=False):
+        # accepts up to MaxAcceptBatch connections waiting in the listen queue, or all of them
+        n = 0
+        while all or n < self.MaxAcceptBatch:
+            n += 1
+            try:    csock, caddr = self.Sock.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                # e.g. too many open files, give the request processors a chance to close some
+                self.error("Error accepting connection:", e)
+                time.sleep(0.1)
+                break
+            #print("run(): services:", [str(s) for s in self.Services])
+            self.Server.connection_accepted(csock, caddr)
+
+    def master_alive(self):
+        try:    os.kill(self.MasterPID, 0)
+        except: return False
+        return True
+
+    def master_message(self, msg):
+        self.log("message from master:", msg)
+        if msg == "stop":
+            self.Stop = True
+        elif msg == "reconfigure":
+            self.reconfigure()
+
+    def recycle_needed(self):
+        return not self.RecycleRequested and (
+            self.MaxRequests and self.Server.RequestCount >= self.MaxRequests
+            or self.MaxAge and time.monotonic() - self.Started >= self.MaxAge
+        )
+
+    def request_recycle(self):
+        # asks the master to start a new subprocess, which will replace this one
+        if not self.RecycleRequested:
+            self.log("requesting recycling after %d requests" % (self.Server.RequestCount,))
+            self.RecycleRequested = True
+            self.ConnectionToMaster.send("recycle")
+
+    def adapt_workers(self):
+        for svc in self.Services:
+            if isinstance(svc, Service):
+                svc.adapt_workers()
+
     def check_config(self):
         try:
-            if os.path.getmtime(self.ConfigFile) > self.ReconfiguredTime:
+            if self.RollingRestart:
+                # configuration changes are handled by the master, which replaces the subprocesses
+                if any(isinstance(svc, Service) and svc.reloadNeeded() for svc in self.Services):
+                    self.request_recycle()
+            elif os.path.getmtime(self.ConfigFile) > self.ReconfiguredTime:
                 self.reconfigure()
             else:
                 for svc in self.Services:
@@ -491,7 +793,27 @@ class MultiServerSubprocess(Process, Logged):
         self.ConnectionToSubprocess.send("reconfigure")
             
 class MPMultiServer(PyThread, Logged):
-            
+
+    #
+    # With "rolling_restart: true", configuration changes are applied by replacing the subprocesses one by one:
+    # a new subprocess is started with the new configuration and, once it is ready to accept connections,
+    # the old one stops accepting, finishes the requests it has and exits.
+    # Subprocesses are replaced the same way after they have received "max_requests" requests or have been
+    # running for "max_age" seconds, or when a touch_reload file of a service changes in rolling restart mode
+    # The master does not wait for the new subprocess while holding its lock: the replacement is started and
+    # the old subprocess is swapped for it when the "ready" message from the new one is processed.
+    #
+    # With "preload: true", the master loads the service applications and the subprocesses inherit them,
+    # sharing the memory copy-on-write, instead of loading them after the fork.
+    # Running subprocesses can not use the services loaded by the master after a configuration change,
+    # so "preload: true" implies "rolling_restart: true": the subprocesses are replaced with new ones,
+    # forked from the master with the new services
+    #
+
+    CheckInterval = 5.0
+    StartTimeout = 60.0         # time to wait for a new subprocess to become ready
+    DrainTimeout = 60.0         # time to wait for a replaced subprocess to finish its requests
+
     def __init__(self, config_file, log_path, requests_path, debug_enabled):
         PyThread.__init__(self)
         Logged.__init__(self, "[Multiserver]")
@@ -500,6 +822,10 @@ class MPMultiServer(PyThread, Logged):
         self.Port = None
         self.ReconfiguredTime = 0
         self.Subprocesses = []
+        self.Retiring = []          # [(subprocess, deadline)] replaced subprocesses, finishing their requests
+        self.ToReplace = []         # subprocesses waiting to be replaced, one at a time
+        self.Replacement = None     # (new subprocess, old subprocess, deadline) replacement being started
+        self.Preloaded = None       # services loaded by the master, inherited by the subprocesses
         self.Sock = None
         self.Stop = False
         #print(f"MPMultiServer: log_path:", log_path, "requests_path:", requests_path)
@@ -515,43 +841,172 @@ class MPMultiServer(PyThread, Logged):
         port = self.Config["port"]
         if self.Port is None:
             self.Port = port
-            self.Sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.Sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.Sock.bind(('', self.Port))
-            self.Sock.listen(10)
+            # reuse_port: each subprocess listens on its own socket and the kernel balances the connections,
+            # otherwise the subprocesses accept connections from the shared socket
+            # neither option can be changed without restarting the server
+            if not config.get("reuse_port", False):
+                self.Sock = listen_socket(self.Port, config.get("listen_backlog", DefaultBacklog))
         elif port != self.Port:
             print("Can not change port number")
             sys.exit(1)
+        # the services preloaded here are used only by new subprocesses, so preload implies rolling restart
+        self.RollingRestart = config.get("rolling_restart", False) or config.get("preload", False)
+        self.DrainTimeout = config.get("drain_timeout", self.DrainTimeout)
+        if self.Preloaded is not None:
+            # the services have reference cycles, free the old ones before loading new
+            self.Preloaded = None
+            gc.collect()
+        if config.get("preload", False):
+            # avoid freed holes in the memory pages holding the preloaded objects, see start_subprocess()
+            gc.disable()
+            try:
+                self.Preloaded = load_services(config, self.MPLogger, self)
+            finally:
+                gc.enable()
         
         new_nprocesses = self.Config.get("processes", 1)
         if new_nprocesses > len(self.Subprocesses):
-            for p in self.Subprocesses:
-                p.request_reconfigure()
+            for p in self.Subprocesses[:]:
+                self.update_subprocess(p)
             for _ in range(new_nprocesses - len(self.Subprocesses)):
-                p = MultiServerSubprocess(self.Port, self.Sock, self.ConfigFile, logger=self.MPLogger)
-                p.start()
+                p = self.start_subprocess()
                 self.Subprocesses.append(p)
                 #self.log("started new subprocess")
         elif new_nprocesses < len(self.Subprocesses):
             while new_nprocesses < len(self.Subprocesses):
                 p = self.Subprocesses.pop()
                 p.stop()
+                self.Retiring.append((p, time.monotonic() + self.DrainTimeout))
                 #self.log("stopped a subprocess")
-            for p in self.Subprocesses:
-                p.request_reconfigure()
+            for p in self.Subprocesses[:]:
+                self.update_subprocess(p)
         else:
-            for p in self.Subprocesses:
-                p.request_reconfigure()
+            for p in self.Subprocesses[:]:
+                self.update_subprocess(p)
         #self.log("subprocesses running now:", len(self.Subprocesses))
-        
+
+    @synchronized
+    def reload_preloaded(self):
+        # reloads the preloaded services once after their touch_reload files changed,
+        # the subprocesses started after that inherit the new ones
+        if self.Preloaded is not None and any(svc.reloadNeeded() for svc in self.Preloaded):
+            self.log("reloading preloaded services")
+            self.Preloaded = None
+            gc.collect()
+            gc.disable()
+            try:
+                self.Preloaded = load_services(self.Config, self.MPLogger, self)
+            finally:
+                gc.enable()
+
+    def start_subprocess(self):
+        p = MultiServerSubprocess(self.Port, self.Sock, self.ConfigFile, logger=self.MPLogger, services=self.Preloaded)
+        if self.Preloaded is None:
+            p.start()
+            return p
+        # keep the garbage collector from touching the objects inherited by the subprocess,
+        # so that their memory pages stay shared. The subprocess re-enables the collector.
+        # The master unfreezes its objects after the fork, so that replaced services can be collected
+        gc.disable()
+        gc.freeze()
+        try:
+            p.start()
+        finally:
+            gc.unfreeze()
+            gc.enable()
+        return p
+
+    def update_subprocess(self, p):
+        if self.RollingRestart:
+            self.replace_subprocess(p)
+        else:
+            p.request_reconfigure()
+
+    @synchronized
+    def replace_subprocess(self, p):
+        # schedules the replacement, does not wait for the new subprocess to become ready
+        replacing = self.Replacement is not None and self.Replacement[1] is p
+        if p in self.Subprocesses and p not in self.ToReplace and not replacing:
+            self.ToReplace.append(p)
+        self.start_replacement()
+
+    @synchronized
+    def start_replacement(self):
+        while self.Replacement is None and self.ToReplace and not self.Stop:
+            p = self.ToReplace.pop(0)
+            if p in self.Subprocesses:
+                new = self.start_subprocess()
+                self.Replacement = (new, p, time.monotonic() + self.StartTimeout)
+
+    @synchronized
+    def finish_replacement(self, ready):
+        new, p, _ = self.Replacement
+        self.Replacement = None
+        if ready:
+            if p in self.Subprocesses:
+                self.Subprocesses[self.Subprocesses.index(p)] = new
+                p.stop()
+                self.Retiring.append((p, time.monotonic() + self.DrainTimeout))
+                self.log("subprocess %s replaced with %s" % (p.pid, new.pid))
+            else:
+                # the old subprocess died meanwhile
+                self.Subprocesses.append(new)
+        else:
+            self.log("new subprocess did not become ready in time, keeping the old one")
+            new.terminate()
+            self.Retiring.append((new, time.monotonic()))
+            if p not in self.Subprocesses and not self.Stop:
+                self.Subprocesses.append(self.start_subprocess())
+        self.start_replacement()
+
+    @synchronized
+    def check_replacement(self):
+        if self.Replacement is None:
+            return
+        new, p, deadline = self.Replacement
+        try:
+            while new.ConnectionToSubprocess.poll():
+                if new.ConnectionToSubprocess.recv() == "ready":
+                    return self.finish_replacement(True)
+        except (EOFError, OSError):
+            return self.finish_replacement(False)      # the new subprocess died
+        if time.monotonic() > deadline:
+            self.finish_replacement(False)
+
+    @synchronized
+    def process_messages(self):
+        self.check_replacement()
+        for p in self.Subprocesses[:]:
+            try:
+                while p.ConnectionToSubprocess.poll():
+                    msg = p.ConnectionToSubprocess.recv()
+                    if msg == "recycle":
+                        self.reload_preloaded()         # the subprocess may be asking because of a touch_reload file
+                        self.replace_subprocess(p)
+                    # "ready" from subprocesses, which are not replacing others, needs no action
+            except (EOFError, OSError):
+                pass        # the subprocess died, check_children will restart it
+
     def run(self):
         if setproctitle is not None:
             setproctitle("multiserver %s master" % (self.Port,))
+        next_check = time.monotonic() + self.CheckInterval
         while not self.Stop:
-            time.sleep(5)
-            if os.path.getmtime(self.ConfigFile) > self.ReconfiguredTime:
-                self.reconfigure()
-            self.check_children()
+            connections = [p.ConnectionToSubprocess for p in self.Subprocesses]
+            if self.Replacement is not None:
+                connections.append(self.Replacement[0].ConnectionToSubprocess)
+            if connections:
+                wait_for_messages(connections, max(0.0, next_check - time.monotonic()))
+            else:
+                time.sleep(max(0.0, next_check - time.monotonic()))
+            self.process_messages()
+            if time.monotonic() >= next_check:
+                if os.path.getmtime(self.ConfigFile) > self.ReconfiguredTime:
+                    self.reconfigure()
+                else:
+                    self.reload_preloaded()
+                self.check_children()
+                next_check = time.monotonic() + self.CheckInterval
                 
     @synchronized
     def check_children(self, *ignore):
@@ -562,16 +1017,24 @@ class MPMultiServer(PyThread, Logged):
             if not p.is_alive():
                 print("subprocess died with status", p.exitcode, file=sys.stderr)
                 self.log("subprocess died with status", p.exitcode)
-                n_died += 1
+                if self.Replacement is None or self.Replacement[1] is not p:
+                    n_died += 1         # otherwise the replacement being started takes its place
             else:
                 alive.append(p)
         self.Subprocesses = alive
+        retiring = []
+        for p, deadline in self.Retiring:
+            if p.is_alive():
+                if time.monotonic() > deadline:
+                    self.log("subprocess %s did not finish its requests in time, terminating" % (p.pid,))
+                    p.terminate()
+                retiring.append((p, deadline))
+        self.Retiring = retiring
         if n_died and not self.Stop:
             #time.sleep(5)   # do not restart subprocesses too often
             for _ in range(n_died):
                 time.sleep(1)   # do not restart subprocesses too often
-                p = MultiServerSubprocess(self.Port, self.Sock, self.ConfigFile, logger=self.MPLogger)
-                p.start()
+                p = self.start_subprocess()
                 self.Subprocesses.append(p)
                 print("subprocess died with status", p.exitcode, file=sys.stderr)
                 self.log("started new subprocess")
@@ -582,6 +1045,8 @@ class MPMultiServer(PyThread, Logged):
         self.Stop = True
         for p in self.Subprocesses:
             p.stop()
+        if self.Replacement is not None:
+            self.Replacement[0].stop()
         
 Usage = """
 python multiserver.py [options] <config.yaml>
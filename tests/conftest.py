@@ -0,0 +1,4 @@
+import sys, os
+
+# run the tests against the source tree
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
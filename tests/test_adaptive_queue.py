@@ -0,0 +1,61 @@
+import time, threading
+from pythreader import Task
+from multiserver.multiserver import AdaptiveTaskQueue
+
+class Job(Task):
+
+    def __init__(self, gate):
+        Task.__init__(self)
+        self.Gate = gate
+
+    def run(self):
+        self.Gate.wait(5)
+
+class Delegate(object):
+
+    def __init__(self):
+        self.Changes = []
+
+    def workersChanged(self, queue, nworkers):
+        self.Changes.append(nworkers)
+
+def test_grows_with_backlog():
+    gate = threading.Event()
+    delegate = Delegate()
+    queue = AdaptiveTaskQueue(2, 6, delegate=delegate, target_wait=0.1)
+    for _ in range(10):
+        queue.add(Job(gate))
+    # the run time is unknown yet, so the limit grows to serve the backlog
+    assert queue.NWorkers == 6
+    assert queue.counts() == (4, 6)
+    assert delegate.Changes[-1] == 6
+    gate.set()
+    queue.join()
+
+def test_does_not_grow_for_short_tasks():
+    gate = threading.Event()
+    queue = AdaptiveTaskQueue(2, 6, target_wait=1.0)
+    queue.RunTime = 0.01
+    for _ in range(4):
+        queue.add(Job(gate))
+    # 2 waiting tasks would wait about 0.01 seconds
+    assert queue.NWorkers == 2
+    gate.set()
+    queue.join()
+    assert queue.RunTime is not None
+
+def test_shrinks_when_idle():
+    delegate = Delegate()
+    queue = AdaptiveTaskQueue(2, 6, delegate=delegate, idle_time=0.1)
+    queue.NWorkers = 4
+    assert not queue.adapt()
+    assert queue.NWorkers == 4              # not idle long enough yet
+    time.sleep(0.15)
+    queue.adapt()
+    assert queue.NWorkers == 3
+    time.sleep(0.15)
+    queue.adapt()
+    time.sleep(0.15)
+    queue.adapt()
+    assert queue.NWorkers == 2              # never below min_workers
+    assert delegate.Changes == [3, 2]
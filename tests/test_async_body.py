@@ -0,0 +1,39 @@
+import socket, time
+import pytest
+from webpie import WPApp, WPHandler, AsyncHTTPServer
+
+class Handler(WPHandler):
+
+    def upload(self, request, relpath, **args):
+        return "%d %s" % (len(request.body), request.body[-10:].decode())
+
+@pytest.fixture(params=[None, 8])
+def server(request):
+    # body_spool_threshold=8: the bodies are spooled to a temporary file
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(10)
+    port = sock.getsockname()[1]
+    srv = AsyncHTTPServer(port, WPApp(Handler), sock=sock, timeout=0.5, body_spool_threshold=request.param, daemon=True)
+    srv.start()
+    yield port
+    srv.close()
+
+def test_slow_upload(server):
+    # the timeout applies to each read, not to the whole body
+    c = socket.create_connection(("127.0.0.1", server), timeout=10)
+    c.sendall(b"POST /upload HTTP/1.1\r\nHost: x\r\nContent-Length: 30\r\nConnection: close\r\n\r\n")
+    for i in range(10):
+        c.sendall(b"abc")
+        time.sleep(0.15)
+    response = c.makefile("rb").read()
+    assert response.startswith(b"HTTP/1.1 200")
+    assert response.endswith(b"30 cabcabcabc")
+    c.close()
+
+def test_stalled_upload(server):
+    c = socket.create_connection(("127.0.0.1", server), timeout=10)
+    c.sendall(b"POST /upload HTTP/1.1\r\nHost: x\r\nContent-Length: 30\r\n\r\nabc")
+    response = c.makefile("rb").read()
+    assert response.startswith(b"HTTP/1.1 408")
+    c.close()
@@ -0,0 +1,118 @@
+import pytest
+from webpie.HTTPServer import ChunkedDecoder, BodyFile
+
+def decode(data, piece=None):
+    # feeds data to a new decoder, all at once or in pieces of the given size
+    decoder = ChunkedDecoder()
+    piece = piece or len(data)
+    out = b"".join(decoder.feed(data[i:i+piece]) for i in range(0, len(data), piece))
+    return decoder, out
+
+@pytest.mark.parametrize("piece", [None, 1, 2, 3, 7])
+def test_split_anywhere(piece):
+    body = b"5\r\nhello\r\n7\r\n, world\r\n0\r\n\r\n"
+    decoder, out = decode(body, piece)
+    assert out == b"hello, world"
+    assert decoder.done
+
+def test_hex_sizes():
+    decoder, out = decode(b"a\r\n0123456789\r\nF\r\n0123456789abcde\r\n0\r\n\r\n")
+    assert out == b"0123456789" + b"0123456789abcde"
+    assert decoder.done
+
+def test_extensions():
+    decoder, out = decode(b'5;name=value\r\nhello\r\n3 ; quoted="a;b"\r\nabc\r\n0;last\r\n\r\n')
+    assert out == b"helloabc"
+    assert decoder.done
+
+def test_trailers():
+    decoder, out = decode(b"5\r\nhello\r\n0\r\nX-Checksum: abc\r\nX-Other: 1\r\n\r\n")
+    assert out == b"hello"
+    assert decoder.done
+    assert decoder.rest() == b""
+
+def test_bare_lf():
+    decoder, out = decode(b"5\nhello\n0\n\n")
+    assert out == b"hello"
+    assert decoder.done
+
+def test_rest_after_body():
+    # the beginning of the next pipelined request stays in the decoder
+    decoder, out = decode(b"3\r\nabc\r\n0\r\n\r\nGET / HTTP/1.1\r\n")
+    assert out == b"abc"
+    assert decoder.done
+    assert decoder.rest() == b"GET / HTTP/1.1\r\n"
+    assert decoder.rest() == b""
+
+def test_not_done_until_last_line():
+    decoder, out = decode(b"3\r\nabc\r\n0\r\n")
+    assert out == b"abc"
+    assert not decoder.done
+    decoder.feed(b"\r\n")
+    assert decoder.done
+
+@pytest.mark.parametrize("size", [b"", b"x", b"-5", b"+5", b"0x5", b"5_0", b"1" * 17])
+def test_malformed_size(size):
+    with pytest.raises(ValueError):
+        decode(size + b"\r\nhello\r\n0\r\n\r\n")
+
+def test_missing_crlf_after_data():
+    with pytest.raises(ValueError):
+        decode(b"5\r\nhelloXX\r\n0\r\n\r\n")
+
+def test_line_too_long():
+    decoder = ChunkedDecoder()
+    with pytest.raises(ValueError):
+        decoder.feed(b"5;" + b"x" * (ChunkedDecoder.MAXLINE + 1))
+
+class PiecewiseSocket(object):
+
+    def __init__(self, pieces):
+        self.Pieces = list(pieces)
+
+    def recv(self, n):
+        if not self.Pieces:
+            return b""
+        piece = self.Pieces.pop(0)
+        if len(piece) > n:
+            piece, self.Pieces[0:0] = piece[:n], [piece[n:]]
+        return piece
+
+CHUNKED = b"4\r\nline\r\n5\r\n one\n\r\n9\r\nline two\n\r\n0\r\n\r\n"
+
+@pytest.mark.parametrize("split", [0, 5, 13, len(CHUNKED)])
+def test_body_file_chunked(split):
+    # part of the body was received with the header, the rest comes from the socket
+    sock = PiecewiseSocket([CHUNKED[split:] + b"NEXT"])
+    body = BodyFile(CHUNKED[:split], sock, None, chunked=True)
+    assert body.readline() == b"line one\n"
+    assert body.read() == b"line two\n"
+    assert body.read() == b""
+    # the next pipelined request is either returned by drain() or not received yet
+    assert body.drain() + b"".join(sock.Pieces) == b"NEXT"
+    assert body.BytesIn == len(CHUNKED)
+
+def test_body_file_content_length():
+    sock = PiecewiseSocket([b"456789NEXT"])
+    body = BodyFile(b"0123", sock, 10)
+    assert body.read(3) == b"012"
+    assert body.read(5) == b"34567"
+    assert body.read() == b"89"
+    assert body.drain() == b""
+    assert sock.Pieces == [b"NEXT"]         # not read beyond the body
+
+def test_body_file_drain_unread():
+    body = BodyFile(b"", PiecewiseSocket([CHUNKED, b"NEXT"]), None, chunked=True)
+    assert body.read(2) == b"li"
+    assert body.drain() == b""
+
+def test_body_file_spool():
+    body = BodyFile(CHUNKED, None, None, chunked=True)
+    assert body.spool(4) == len(b"line one\nline two\n")
+    assert list(body) == [b"line one\n", b"line two\n"]
+    body.close()
+
+def test_body_file_truncated():
+    body = BodyFile(b"4\r\nli", PiecewiseSocket([]), None, chunked=True)
+    with pytest.raises(ValueError):
+        body.read()
@@ -0,0 +1,66 @@
+from webpie.HTTPServer import ServiceDispatcher
+
+class PrefixService(object):
+
+    def __init__(self, name, prefix=None):
+        self.Name = name
+        if prefix is not None:
+            self.Prefix = prefix
+
+    def __repr__(self):
+        return self.Name
+
+def names(dispatcher, uri):
+    return [s.Name for s in dispatcher.candidates(uri)]
+
+def test_longest_prefix_first():
+    dispatcher = ServiceDispatcher([
+        PrefixService("root", "/"),
+        PrefixService("a", "/a/"),
+        PrefixService("ab", "/a/b/"),
+        PrefixService("abc", "/a/b/c/"),
+    ])
+    assert names(dispatcher, "/a/b/c/d") == ["abc", "ab", "a", "root"]
+    assert names(dispatcher, "/a/b/x") == ["ab", "a", "root"]
+    assert names(dispatcher, "/a/x") == ["a", "root"]
+    assert names(dispatcher, "/x") == ["root"]
+
+def test_list_order_does_not_matter():
+    services = [PrefixService("a", "/a/"), PrefixService("ab", "/a/b/"), PrefixService("root", "/")]
+    for order in (services, services[::-1]):
+        assert names(ServiceDispatcher(order), "/a/b/c") == ["ab", "a", "root"]
+
+def test_same_prefix_in_list_order():
+    dispatcher = ServiceDispatcher([PrefixService("first", "/a/"), PrefixService("second", "/a/")])
+    assert names(dispatcher, "/a/x") == ["first", "second"]
+
+def test_partial_segment():
+    # same as uri.startswith(prefix)
+    dispatcher = ServiceDispatcher([
+        PrefixService("app", "/app"),
+        PrefixService("application", "/application"),
+        PrefixService("app_dir", "/app/"),
+    ])
+    assert names(dispatcher, "/application/x") == ["application", "app"]
+    assert names(dispatcher, "/app/x") == ["app_dir", "app"]
+    assert names(dispatcher, "/apple") == ["app"]
+    assert names(dispatcher, "/ap") == []
+
+def test_prefix_is_whole_uri():
+    dispatcher = ServiceDispatcher([PrefixService("a", "/a/"), PrefixService("ab", "/a/b")])
+    assert names(dispatcher, "/a/b") == ["ab", "a"]
+    assert names(dispatcher, "/a/") == ["a"]
+    assert names(dispatcher, "/a") == []
+
+def test_services_without_prefix_last():
+    dispatcher = ServiceDispatcher([PrefixService("any"), PrefixService("a", "/a/"), PrefixService("empty", "")])
+    assert names(dispatcher, "/a/x") == ["a", "empty", "any"]
+    assert names(dispatcher, "/b") == ["empty", "any"]
+
+def test_matches_startswith():
+    prefixes = ["/", "/a", "/a/", "/a/b", "/a/b/", "/ab/", "/a/bc", "/x/y/z/", ""]
+    services = [PrefixService(p or "empty", p) for p in prefixes]
+    dispatcher = ServiceDispatcher(services)
+    for uri in ["/", "/a", "/a/", "/a/b", "/a/bcd/e", "/ab/c", "/abc", "/x/y/z/w", "/x/y", "/q"]:
+        expected = sorted((p for p in prefixes if uri.startswith(p)), key=len, reverse=True)
+        assert names(dispatcher, uri) == [p or "empty" for p in expected], uri
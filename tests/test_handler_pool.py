@@ -0,0 +1,88 @@
+import threading, time
+from webpie import WPApp, WPHandler
+from webpie.webob import Request
+
+class Sub(WPHandler):
+
+    def n(self, request, relpath, **args):
+        return self.Request.GET["n"]
+
+class Handler(WPHandler):
+
+    Created = 0
+
+    def __init__(self, request, app):
+        WPHandler.__init__(self, request, app)
+        Handler.Created += 1
+        self.State = []
+        self.sub = Sub(request, app)
+        self.same = self.sub            # the same handler reachable twice
+        self.Resets = 0
+
+    def reset(self, request):
+        self.State = []
+        self.Resets += 1
+
+    def add(self, request, relpath, n, **args):
+        self.State.append(n)
+        time.sleep(0.01)
+        return "%s %s" % (",".join(self.State), self.Request.GET["n"])
+
+    def stream(self, request, relpath, **args):
+        def body():
+            yield b"a"
+            yield b"b"
+        return body()
+
+def get(app, path):
+    response = Request.blank(path).get_response(app)
+    return response.status_int, response.body.decode()
+
+def test_reused():
+    Handler.Created = 0
+    app = WPApp(Handler, reuse_handlers=True)
+    for i in range(5):
+        assert get(app, "/add?n=%d" % (i,)) == (200, "%d %d" % (i, i))
+    assert Handler.Created == 1
+    root, handlers = app.Handlers.Free[0]
+    assert root.Resets == 4
+    assert len(handlers) == 2           # root and sub, counted once
+    assert get(app, "/sub/n?n=7") == (200, "7")
+
+def test_streaming_response_returns_tree_on_close():
+    app = WPApp(Handler, reuse_handlers=True)
+    assert get(app, "/stream") == (200, "ab")
+    assert len(app.Handlers.Free) == 1
+
+def test_concurrent_requests_do_not_share_trees():
+    Handler.Created = 0
+    app = WPApp(Handler, reuse_handlers=True)
+    errors = []
+
+    def client(i):
+        for j in range(20):
+            n = "%d.%d" % (i, j)
+            result = get(app, "/add?n=" + n)
+            if result != (200, "%s %s" % (n, n)):
+                errors.append(result)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(8)]
+    for t in threads:  t.start()
+    for t in threads:  t.join()
+    assert not errors
+    assert Handler.Created <= 8
+    assert len(app.Handlers.Free) == Handler.Created
+
+def test_subhandlers_shared_references():
+    class Node(WPHandler):
+        pass
+    root = Node(None, None)
+    children = [Node(None, None) for _ in range(500)]
+    for i, child in enumerate(children):
+        setattr(root, "c%d" % (i,), child)
+        child.root = root                           # cycles and handlers reachable many times
+        child.neighbour = children[i-1]
+    handlers = root._subhandlers()
+    assert handlers[0] is root
+    assert len(handlers) == 501
+    assert {id(h) for h in handlers} == {id(h) for h in [root] + children}
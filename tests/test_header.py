@@ -0,0 +1,113 @@
+import pytest
+from webpie.HTTPServer import HTTPHeader, BufferedHTTPHeader
+
+class PiecewiseSocket(object):
+    # delivers the data in the given pieces, one piece per recv call
+
+    def __init__(self, pieces):
+        self.Pieces = list(pieces)
+        self.Timeout = None
+
+    def gettimeout(self):
+        return self.Timeout
+
+    def settimeout(self, timeout):
+        self.Timeout = timeout
+
+    def recv(self, n):
+        if not self.Pieces:
+            return b""
+        piece = self.Pieces.pop(0)
+        if len(piece) > n:
+            piece, self.Pieces[0:0] = piece[:n], [piece[n:]]
+        return piece
+
+    def recv_into(self, buf):
+        piece = self.recv(len(buf))
+        buf[:len(piece)] = piece
+        return len(piece)
+
+REQUEST = (
+    b"POST /path/to?x=1&y=2 HTTP/1.1\r\n"
+    b"Host: example.com\r\n"
+    b"Content-Length: 4\r\n"
+    b"Cookie: a=1\r\n"
+    b"X-Multi: one\r\n"
+    b"Cookie: b=2\r\n"
+    b"X-Multi: two\r\n"
+    b"\r\n"
+    b"body"
+)
+
+END = REQUEST.index(b"\r\n\r\n")
+
+def split_at(data, *positions):
+    positions = [0] + list(positions) + [len(data)]
+    return [data[i:j] for i, j in zip(positions, positions[1:])]
+
+@pytest.mark.parametrize("header_class", [HTTPHeader, BufferedHTTPHeader])
+@pytest.mark.parametrize("pieces", [
+    [REQUEST],
+    split_at(REQUEST, 5),                           # inside the headline
+    split_at(REQUEST, END + 1),                     # inside the end of header
+    split_at(REQUEST, END + 2),
+    split_at(REQUEST, END + 3),
+    split_at(REQUEST, END, END + 2),
+    [REQUEST[i:i+1] for i in range(len(REQUEST))],  # byte by byte
+])
+def test_split_recv(header_class, pieces):
+    header = header_class()
+    received, body = header.recv(PiecewiseSocket(pieces))
+    assert received and header.is_valid() and header.is_client()
+    assert header.Method == "POST"
+    assert header.URI == "/path/to?x=1&y=2"
+    assert header.path() == "/path/to"
+    assert header.query() == "x=1&y=2"
+    assert header.get("content-length") == "4"
+    # the body bytes received with the header are returned, the rest stays in the socket
+    assert b"body".startswith(body)
+
+def test_buffered_repeated_headers():
+    header = BufferedHTTPHeader()
+    received, body = header.recv(PiecewiseSocket([REQUEST]))
+    assert header.get("Cookie") == "a=1; b=2"
+    assert header.get("X-Multi") == "one, two"
+    assert header.Headers["X-Multi"] == "one, two"
+
+@pytest.mark.parametrize("header_class", [HTTPHeader, BufferedHTTPHeader])
+def test_buffered_data_first(header_class):
+    # the header of a pipelined request, received together with the previous one
+    header = header_class()
+    received, body = header.recv(PiecewiseSocket([b"Host: x\r\n\r\n"]), buffered=b"GET / HTTP/1.1\r\n")
+    assert received and header.is_valid()
+    assert header.get("Host") == "x"
+
+@pytest.mark.parametrize("header_class", [HTTPHeader, BufferedHTTPHeader])
+def test_bare_lf(header_class):
+    header = header_class()
+    received, body = header.recv(PiecewiseSocket([b"GET / HTTP/1.0\nHost: x\n", b"\nrest"]))
+    assert received and header.is_valid()
+    assert header.get("Host") == "x"
+    assert body == b"rest"
+
+@pytest.mark.parametrize("header_class", [HTTPHeader, BufferedHTTPHeader])
+def test_eof_before_end_of_header(header_class):
+    header = header_class()
+    received, body = header.recv(PiecewiseSocket([b"GET / HTTP/1.1\r\nHost: x\r\n"]))
+    assert not received
+    assert not header.Complete
+
+@pytest.mark.parametrize("header_class", [HTTPHeader, BufferedHTTPHeader])
+def test_malformed_headline(header_class):
+    header = header_class()
+    received, body = header.recv(PiecewiseSocket([b"GARBAGE\r\n\r\n"]))
+    assert received
+    assert not header.is_valid()
+
+@pytest.mark.parametrize("header_class", [HTTPHeader, BufferedHTTPHeader])
+def test_too_long(header_class):
+    header = header_class()
+    line = b"X-Long: " + b"x" * 1000 + b"\r\n"
+    received, body = header.recv(PiecewiseSocket([b"GET / HTTP/1.1\r\n"] + [line] * (header_class.MAXREAD // len(line) + 2)))
+    assert not received
+    assert header.Error is not None
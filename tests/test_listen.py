@@ -0,0 +1,46 @@
+import socket
+import pytest
+from webpie.HTTPServer import listen_socket
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def test_listen_socket():
+    port = free_port()
+    sock = listen_socket(port, backlog=5)
+    try:
+        c = socket.create_connection(("127.0.0.1", port), timeout=5)
+        csock, _ = sock.accept()
+        csock.close()
+        c.close()
+        with pytest.raises(OSError):
+            listen_socket(port)             # without reuse_port the port is taken
+    finally:
+        sock.close()
+
+@pytest.mark.skipif(not hasattr(socket, "SO_REUSEPORT"), reason="SO_REUSEPORT not supported")
+def test_reuse_port():
+    port = free_port()
+    socks = [listen_socket(port, reuse_port=True) for _ in range(2)]
+    try:
+        for s in socks:
+            s.settimeout(0.1)
+        clients = [socket.create_connection(("127.0.0.1", port), timeout=5) for _ in range(20)]
+        accepted = 0
+        for s in socks:
+            while True:
+                try:    csock, _ = s.accept()
+                except socket.timeout:
+                    break
+                csock.close()
+                accepted += 1
+        assert accepted == 20
+        for c in clients:
+            c.close()
+    finally:
+        for s in socks:
+            s.close()
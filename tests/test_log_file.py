@@ -0,0 +1,63 @@
+import time
+from webpie.logs import LogFile
+
+def lines(path):
+    with open(path) as f:
+        return f.read().splitlines()
+
+def test_background_close_writes_queued(tmp_path):
+    path = str(tmp_path / "log")
+    log = LogFile(path, append=False, background=True, flush_interval=60)
+    for i in range(100):
+        log.log("message %d" % (i,), t=False)
+    log.close()
+    assert lines(path) == ["message %d" % (i,) for i in range(100)]
+
+def test_background_batch_size(tmp_path):
+    path = str(tmp_path / "log")
+    log = LogFile(path, append=False, background=True, flush_interval=60, batch_size=100)
+    for i in range(20):
+        log.log("message %d" % (i,), t=False)
+    # the batch size was reached long before the flush interval
+    deadline = time.time() + 5
+    while len(lines(path)) < 10 and time.time() < deadline:
+        time.sleep(0.05)
+    assert len(lines(path)) >= 10
+    log.close()
+    assert len(lines(path)) == 20
+
+def test_background_flush_interval(tmp_path):
+    path = str(tmp_path / "log")
+    log = LogFile(path, append=False, background=True, flush_interval=0.1)
+    log.log("hello", t=False)
+    time.sleep(0.5)
+    assert lines(path) == ["hello"]
+    log.close()
+
+def test_flush_drains_queue(tmp_path):
+    path = str(tmp_path / "log")
+    log = LogFile(path, append=False, background=True, flush_interval=60)
+    log.log("hello", t=False)
+    log.flush()
+    assert lines(path) == ["hello"]
+    log.close()
+
+def test_log_after_close_discarded(tmp_path):
+    for background in (False, True):
+        path = str(tmp_path / ("log.%s" % (background,)))
+        log = LogFile(path, append=False, background=background)
+        log.log("before", t=False)
+        log.close()
+        log.log("after", t=False)
+        log.close()
+        assert lines(path) == ["before"]
+
+def test_background_rollover(tmp_path):
+    path = str(tmp_path / "log")
+    log = LogFile(path, interval=1000, append=False, background=True, flush_interval=60, compress_from=None)
+    t0 = log.CurLogBegin
+    log.log("old", t=t0 + 1, raw=True)
+    log.log("new\n", t=t0 + 2000, raw=True)
+    log.close()
+    assert lines(path + ".1") == ["old"]
+    assert lines(path) == ["new"]
@@ -0,0 +1,55 @@
+import os, time
+from multiserver.multiserver import MPLogger
+
+def make_logger(tmp_path, **logger_config):
+    logs = tmp_path / "logs"
+    logs.mkdir()
+    options = "".join("    %s: %s\n" % item for item in logger_config.items())
+    config = tmp_path / "config.yaml"
+    config.write_text(
+        "logger:\n"
+        "    logs_dir: %s\n%s"
+        "services:\n"
+        "    - name: svc\n" % (logs, options)
+    )
+    return MPLogger(str(config)), logs
+
+def read(path, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if os.path.exists(path):
+            with open(path) as f:
+                text = f.read()
+            if text:
+                return text
+        time.sleep(0.05)
+    return ""
+
+def test_batches(tmp_path):
+    logger, logs = make_logger(tmp_path, batch_size=3, flush_interval=60)
+    logger.log("one", who="svc")
+    logger.log("two", who="svc")
+    assert logger.Queue.empty()
+    logger.log("three", who="svc")
+    batch = logger.Queue.get(timeout=5)
+    assert [m[3] for m in batch] == ["one", "two", "three"]
+    assert all(m[:2] == ("svc", "log") for m in batch)
+
+def test_flush_interval(tmp_path):
+    logger, logs = make_logger(tmp_path, batch_size=100, flush_interval=0.05)
+    logger.log("GET /", who="svc", channel="requests")
+    batch = logger.Queue.get(timeout=5)
+    assert [m[:2] + m[3:] for m in batch] == [("svc", "requests", "GET /")]
+
+def test_master_writes(tmp_path):
+    logger, logs = make_logger(tmp_path, batch_size=1)
+    logger.log("hello", who="svc")
+    logger.process_message()                # master side
+    assert read(str(logs / "svc.log")).rstrip().endswith("[svc]: hello")
+
+def test_per_process_logs(tmp_path):
+    logger, logs = make_logger(tmp_path, per_process_logs="true")
+    logger.log("GET /", who="svc", channel="requests")
+    assert logger.Queue.empty()
+    text = read(str(logs / ("svc.requests.%d" % (os.getpid(),))))
+    assert text.rstrip().endswith("[svc]: GET /")
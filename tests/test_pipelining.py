@@ -0,0 +1,81 @@
+import socket, time
+import pytest
+from webpie import WPApp, WPHandler, HTTPServer, AsyncHTTPServer
+
+class Handler(WPHandler):
+
+    def echo(self, request, relpath, **args):
+        return "%s %s %s" % (request.method, relpath, request.body.decode())
+
+def read_response(f):
+    # reads one response with Content-Length framing, returns (status, headers, body)
+    status = int(f.readline().split()[1])
+    headers = {}
+    while True:
+        line = f.readline().strip()
+        if not line:
+            break
+        name, _, value = line.decode().partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = f.read(int(headers.get("content-length", 0)))
+    return status, headers, body
+
+@pytest.fixture(params=[HTTPServer, AsyncHTTPServer])
+def server(request):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(10)
+    port = sock.getsockname()[1]
+    srv = request.param(port, WPApp(Handler), sock=sock, keep_alive=True, daemon=True)
+    srv.start()
+    yield port
+    srv.close()
+
+def connect(port):
+    c = socket.create_connection(("127.0.0.1", port), timeout=10)
+    return c, c.makefile("rb")
+
+def test_pipelined_requests(server):
+    c, f = connect(server)
+    c.sendall(
+        b"GET /echo/1 HTTP/1.1\r\nHost: x\r\n\r\n"
+        b"POST /echo/2 HTTP/1.1\r\nHost: x\r\nContent-Length: 5\r\n\r\nhello"
+        b"POST /echo/3 HTTP/1.1\r\nHost: x\r\nTransfer-Encoding: chunked\r\n\r\n3\r\nabc\r\n2;ext=1\r\nde\r\n0\r\nX-T: 1\r\n\r\n"
+        b"GET /echo/4 HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n"
+    )
+    responses = [read_response(f) for _ in range(4)]
+    assert [(status, body) for status, headers, body in responses] == [
+        (200, b"GET 1 "),
+        (200, b"POST 2 hello"),
+        (200, b"POST 3 abcde"),
+        (200, b"GET 4 "),
+    ]
+    assert f.read() == b""          # closed after the last request
+    c.close()
+
+def test_pipelined_in_pieces(server):
+    # pipelined requests split at arbitrary points, including inside the end of a header
+    c, f = connect(server)
+    data = (
+        b"GET /echo/a HTTP/1.1\r\nHost: x\r\n\r\n"
+        b"POST /echo/b HTTP/1.1\r\nHost: x\r\nContent-Length: 3\r\n\r\nxyz"
+        b"GET /echo/c HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n"
+    )
+    for i in range(0, len(data), 17):
+        c.sendall(data[i:i+17])
+        time.sleep(0.01)
+    bodies = [read_response(f)[2] for _ in range(3)]
+    assert bodies == [b"GET a ", b"POST b xyz", b"GET c "]
+    c.close()
+
+def test_connection_close_stops_pipeline(server):
+    c, f = connect(server)
+    c.sendall(
+        b"GET /echo/1 HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n"
+        b"GET /echo/2 HTTP/1.1\r\nHost: x\r\n\r\n"
+    )
+    status, headers, body = read_response(f)
+    assert body == b"GET 1 "
+    assert f.read() == b""
+    c.close()
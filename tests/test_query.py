@@ -0,0 +1,55 @@
+import socket
+import pytest
+from webpie import WPApp, WPHandler, HTTPServer
+from webpie.WPApp import query_pairs, query_dict
+from webpie.webob import Request
+
+class Handler(WPHandler):
+
+    def args(self, request, relpath, **args):
+        return repr(sorted(args.items()))
+
+    def env(self, request, relpath, **args):
+        q = request.environ["query_dict"]
+        return "%s %s" % (type(q).__name__, sorted(q.items()))
+
+class UpperApp(WPApp):
+
+    def parseQuery(self, query):
+        return {k.upper(): v for k, v in WPApp.parseQuery(self, query).items()}
+
+def get(app, path):
+    return Request.blank(path).get_response(app).text
+
+def test_query_args():
+    app = WPApp(Handler)
+    assert get(app, "/args?a=1&b=x+y%21&a=2") == repr([("a", ["1", "2"]), ("b", "x y!")])
+    app.UnquoteArgs = False
+    assert get(app, "/args?b=x+y%21") == repr([("b", "x+y%21")])
+
+def test_parse_query_override():
+    assert get(UpperApp(Handler), "/args?a=1") == repr([("A", "1")])
+
+def test_pairs_cached():
+    env = {"QUERY_STRING": "a=1&b"}
+    pairs = query_pairs(env)
+    assert pairs == [("a", "1"), ("b", None)]
+    assert query_pairs(env) is pairs
+    env["QUERY_STRING"] = "c=2"
+    assert query_dict(query_pairs(env)) == {"c": "2"}
+
+def test_server_query_dict_is_dict():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(10)
+    port = sock.getsockname()[1]
+    srv = HTTPServer(port, WPApp(Handler), sock=sock, daemon=True)
+    srv.start()
+    try:
+        c = socket.create_connection(("127.0.0.1", port), timeout=10)
+        c.sendall(b"GET /env?x=1&y=2 HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+        response = c.makefile("rb").read()
+        c.close()
+        assert response.endswith(b"dict [('x', '1'), ('y', '2')]")
+    finally:
+        srv.close()
@@ -0,0 +1,123 @@
+import time, threading
+from multiprocessing import Pipe
+from pythreader import PyThread
+from webpie.logs import Logged
+from multiserver.multiserver import MPMultiServer
+
+class FakeSubprocess(object):
+
+    Count = 0
+
+    def __init__(self):
+        FakeSubprocess.Count += 1
+        self.pid = FakeSubprocess.Count
+        self.ConnectionToMaster, self.ConnectionToSubprocess = Pipe()
+        self.Stopped = self.Terminated = False
+        self.exitcode = None
+
+    def stop(self):
+        self.Stopped = True
+
+    def terminate(self):
+        self.Terminated = True
+
+    def request_reconfigure(self):
+        self.ConnectionToSubprocess.send("reconfigure")
+
+    def is_alive(self):
+        return not self.Terminated
+
+class Master(MPMultiServer):
+
+    StartTimeout = 0.5
+
+    def __init__(self, nprocesses):
+        # does not read the configuration and does not start the logger
+        PyThread.__init__(self)
+        Logged.__init__(self, "[Multiserver]")
+        self.Stop = False
+        self.DrainTimeout = 10
+        self.Retiring = []
+        self.ToReplace = []
+        self.Replacement = None
+        self.Started = []
+        self.Subprocesses = [self.start_subprocess() for _ in range(nprocesses)]
+
+    def start_subprocess(self):
+        p = FakeSubprocess()
+        self.Started.append(p)
+        return p
+
+def test_replacement_does_not_hold_the_lock():
+    master = Master(2)
+    old = list(master.Subprocesses)
+    master.replace_subprocess(old[0])
+    master.replace_subprocess(old[1])
+    new = master.Started[-1]
+    assert master.Replacement[:2] == (new, old[0])
+    assert len(master.Started) == 3         # one replacement at a time
+
+    # the master lock is free while the new subprocess is starting
+    t = threading.Thread(target=master.process_messages)
+    t.start()
+    t.join(1)
+    assert not t.is_alive()
+    assert master.Subprocesses == old
+
+    new.ConnectionToMaster.send("ready")
+    master.process_messages()
+    assert master.Subprocesses == [new, old[1]]
+    assert old[0].Stopped
+    # the next replacement has started
+    assert master.Replacement[:2] == (master.Started[-1], old[1])
+    master.Started[-1].ConnectionToMaster.send("ready")
+    master.process_messages()
+    assert master.Subprocesses == master.Started[2:]
+    assert master.Replacement is None
+
+def test_replacement_timeout():
+    master = Master(1)
+    old = master.Subprocesses[0]
+    master.replace_subprocess(old)
+    new = master.Replacement[0]
+    time.sleep(0.6)
+    master.process_messages()
+    assert new.Terminated
+    assert master.Subprocesses == [old] and not old.Stopped
+    assert master.Replacement is None
+
+def test_replaced_subprocess_died():
+    master = Master(1)
+    old = master.Subprocesses[0]
+    master.replace_subprocess(old)
+    new = master.Replacement[0]
+    old.Terminated = True
+    master.check_children()
+    assert master.Subprocesses == [] and len(master.Started) == 2     # not restarted, the replacement is coming
+    new.ConnectionToMaster.send("ready")
+    master.process_messages()
+    assert master.Subprocesses == [new]
+
+def reconfigure(master, tmp_path, **config):
+    path = tmp_path / "config.yaml"
+    path.write_text("".join("%s: %s\n" % (k, str(v).lower() if isinstance(v, bool) else v) for k, v in config.items()))
+    master.ConfigFile = str(path)
+    master.Port = config["port"]
+    master.Preloaded = None
+    master.MPLogger = None
+    master.reconfigure()
+
+def test_preload_replaces_subprocesses(tmp_path):
+    master = Master(2)
+    old = list(master.Subprocesses)
+    reconfigure(master, tmp_path, port=8888, processes=2, preload=True, services="[]")
+    assert master.RollingRestart
+    assert master.Preloaded == []
+    assert master.Replacement[1] is old[0]
+
+def test_reconfigure_in_place(tmp_path):
+    master = Master(1)
+    old = master.Subprocesses[0]
+    reconfigure(master, tmp_path, port=8888, processes=1, services="[]")
+    assert master.Replacement is None
+    assert old.ConnectionToMaster.recv() == "reconfigure"
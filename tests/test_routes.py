@@ -0,0 +1,68 @@
+import threading, time
+import pytest
+from webpie import WPApp, WPHandler, webmethod
+from webpie.webob import Request
+
+class Sub(WPHandler):
+
+    def whoami(self, request, relpath, **args):
+        time.sleep(0.01)
+        return "%s %s" % (self.Request.GET["n"], relpath)
+
+class Root(WPHandler):
+
+    Created = 0
+
+    def __init__(self, request, app):
+        WPHandler.__init__(self, request, app)
+        Root.Created += 1
+        self.Home = request.application_url         # the constructor can use the request
+        self.sub = Sub(request, app)
+
+    def hello(self, request, relpath, x=None, **args):
+        return "hello %s" % (x,)
+
+    def whoami(self, request, relpath, **args):
+        time.sleep(0.01)
+        # self.Request is the request of this thread, even though the handler is shared
+        return "%s %s" % (self.Request.GET["n"], request.GET["n"])
+
+    def _private(self, request, relpath, **args):
+        return "private"
+
+def get(app, path):
+    response = Request.blank(path).get_response(app)
+    return response.status_int, response.text
+
+@pytest.mark.parametrize("compile_routes", [False, True])
+def test_dispatch(compile_routes):
+    app = WPApp(Root, compile_routes=compile_routes)
+    assert get(app, "/hello?x=1") == (200, "hello 1")
+    assert get(app, "/sub/whoami/a/b?n=5") == (200, "5 a/b")
+    assert get(app, "/_private")[0] == 404
+    assert get(app, "/nothere")[0] == 404
+
+def test_tree_created_once():
+    Root.Created = 0
+    app = WPApp(Root, compile_routes=True)
+    assert Root.Created == 0                # created with the first request
+    for i in range(5):
+        get(app, "/hello")
+    assert Root.Created == 1
+
+def test_request_bound_per_thread():
+    app = WPApp(Root, compile_routes=True)
+    errors = []
+
+    def client(i):
+        for j in range(20):
+            n = "%d.%d" % (i, j)
+            for path, expected in [("/whoami?n=" + n, "%s %s" % (n, n)), ("/sub/whoami/p?n=" + n, n + " p")]:
+                status, text = get(app, path)
+                if (status, text) != (200, expected):
+                    errors.append((path, status, text))
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(8)]
+    for t in threads:  t.start()
+    for t in threads:  t.join()
+    assert not errors
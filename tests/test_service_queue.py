@@ -0,0 +1,149 @@
+import time, threading, socket
+import pytest
+from pythreader import Task
+from webpie.HTTPServer import ServiceQueue
+from webpie import WPApp, WPHandler, HTTPServer
+
+class Job(Task):
+
+    def __init__(self, name, order, gate=None):
+        Task.__init__(self)
+        self.JobName = name
+        self.Order = order
+        self.Gate = gate
+
+    def run(self):
+        if self.Gate is not None:
+            self.Gate.wait(5)
+        self.Order.append(self.JobName)
+
+class Delegate(object):
+
+    def __init__(self):
+        self.Ended = []
+        self.Failed = []
+
+    def taskEnded(self, queue, task, result):
+        self.Ended.append(task)
+
+    def taskFailed(self, queue, task, exc_type, exc_value, tb):
+        self.Failed.append(task)
+
+def run_queue(discipline):
+    order = []
+    gate = threading.Event()
+    queue = ServiceQueue(1, discipline=discipline)
+    queue.add(Job("first", order, gate))        # occupies the only worker
+    for i in range(3):
+        queue.add(Job(i, order))
+    assert queue.counts() == (3, 1)
+    gate.set()
+    queue.join()
+    return order
+
+def test_fifo():
+    assert run_queue("fifo") == ["first", 0, 1, 2]
+
+def test_lifo():
+    assert run_queue("lifo") == ["first", 2, 1, 0]
+
+def test_unknown_discipline():
+    with pytest.raises(ValueError):
+        ServiceQueue(1, discipline="random")
+
+def test_capacity_timeout():
+    gate = threading.Event()
+    order = []
+    queue = ServiceQueue(1, capacity=2)
+    queue.add(Job("a", order, gate))
+    queue.add(Job("b", order))
+    t0 = time.monotonic()
+    with pytest.raises(RuntimeError):
+        queue.add(Job("c", order), timeout=0.2)
+    assert time.monotonic() - t0 >= 0.2
+    with pytest.raises(RuntimeError):
+        queue.add(Job("c", order), timeout=0)
+    # a blocked add() continues when a task ends
+    threading.Timer(0.1, gate.set).start()
+    queue.add(Job("c", order), timeout=5)
+    queue.join()
+    assert order == ["a", "b", "c"]
+
+def test_delegate_and_hold():
+    delegate = Delegate()
+    order = []
+    queue = ServiceQueue(2, delegate=delegate)
+    queue.hold()
+    jobs = [queue.add(Job(i, order)) for i in range(4)]
+    time.sleep(0.1)
+    assert order == [] and queue.counts() == (4, 0)
+    queue.release()
+    queue.join()
+    assert sorted(order) == [0, 1, 2, 3]
+    assert set(delegate.Ended) == set(jobs)
+    assert len(queue) == 0
+
+class FakeRequest(object):
+
+    def __init__(self, age):
+        self.Received = time.monotonic() - age
+
+def test_deadline():
+    queue = ServiceQueue(1, deadline=1.0)
+    assert queue.shed(FakeRequest(0.1)) is None
+    assert queue.shed(FakeRequest(2.0)) == "deadline expired"
+
+def test_codel():
+    order = []
+    gate = threading.Event()
+    queue = ServiceQueue(1, discipline="codel", codel_target=0.01, codel_interval=0.1)
+    assert queue.shed(FakeRequest(1.0)) is None             # the queue is empty
+    queue.add(Job("a", order, gate))
+    queue.add(Job("b", order))
+    time.sleep(0.2)
+    # the queue has not been empty for longer than codel_interval
+    assert queue.shed(FakeRequest(0.0)) is None
+    assert queue.shed(FakeRequest(1.0)) == "queue overloaded"
+    gate.set()
+    queue.join()
+
+def test_retry_after():
+    queue = ServiceQueue(1)
+    assert queue.retry_after() == 1
+    queue.DoneInterval = 0.5
+    for i in range(10):
+        queue.Waiting.append(None)
+    assert queue.retry_after() == 5
+    queue.DoneInterval = 100.0
+    assert queue.retry_after() == queue.MaxRetryAfter
+
+class Slow(WPHandler):
+
+    def sleep(self, request, relpath, **args):
+        time.sleep(0.5)
+        return "ok"
+
+def test_deadline_503_with_retry_after():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(10)
+    port = sock.getsockname()[1]
+    srv = HTTPServer(port, WPApp(Slow), sock=sock, request_deadline=0.2, daemon=True)
+    srv.start()
+    try:
+        # the service runs 5 requests at a time, the 6th one waits longer than the deadline
+        connections = [socket.create_connection(("127.0.0.1", port), timeout=10) for _ in range(6)]
+        for c in connections:
+            c.sendall(b"GET /sleep HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+            time.sleep(0.01)
+        responses = []
+        for c in connections:
+            f = c.makefile("rb")
+            responses.append(f.read())
+            c.close()
+        statuses = sorted(r.split(None, 2)[1] for r in responses)
+        assert statuses == [b"200"]*5 + [b"503"]
+        rejected = [r for r in responses if r.split(None, 2)[1] == b"503"][0]
+        assert b"Retry-After: " in rejected
+    finally:
+        srv.close()
@@ -0,0 +1,87 @@
+import time
+import pytest
+from webpie import SessionStorage, MemorySessionStorage, SQLiteSessionStorage
+
+@pytest.fixture(params=["files", "memory", "sqlite"])
+def storage(request, tmp_path):
+    if request.param == "files":
+        return SessionStorage(str(tmp_path), session_timeout=3600)
+    elif request.param == "memory":
+        return MemorySessionStorage(session_timeout=3600)
+    else:
+        return SQLiteSessionStorage(str(tmp_path / "sessions.db"), session_timeout=3600)
+
+def test_crud(storage):
+    assert not storage.sessionExists("abcd")
+    assert storage.load("abcd") is None
+    storage.save("abcd", {"a": 1})
+    assert storage.sessionExists("abcd")
+    assert storage.load("abcd") == {"a": 1}
+    storage.save("abcd", {"a": 2})
+    assert storage.load("abcd") == {"a": 2}
+    storage.delete("abcd")
+    assert not storage.sessionExists("abcd")
+    assert storage.load("abcd") is None
+
+def test_bulk_values(storage):
+    storage.save("abcd", {})
+    storage.bulkSave("abcd", "x", [1, 2, 3])
+    storage.bulkSave("abcd", "y", "why")
+    assert storage.bulkLoad("abcd", "x") == [1, 2, 3]
+    storage.bulkDelete("abcd", "x")
+    assert storage.bulkLoad("abcd", "x") is None
+    assert storage.bulkLoad("abcd", "y") == "why"
+    storage.delete("abcd")
+    assert storage.bulkLoad("abcd", "y") is None
+
+def test_rename(storage):
+    storage.save("abcd", {"a": 1})
+    storage.bulkSave("abcd", "x", "value")
+    storage.rename("abcd", "ef01")
+    assert not storage.sessionExists("abcd")
+    assert storage.load("ef01") == {"a": 1}
+    assert storage.bulkLoad("ef01", "x") == "value"
+
+def test_data_is_not_shared(storage):
+    data = {"a": [1]}
+    storage.save("abcd", data)
+    data["a"].append(2)
+    assert storage.load("abcd") == {"a": [1]}
+
+def test_memory_expiration():
+    storage = MemorySessionStorage(session_timeout=0.1)
+    storage.save("abcd", {"a": 1})
+    assert storage.load("abcd") == {"a": 1}
+    time.sleep(0.2)
+    assert storage.load("abcd") is None
+
+def test_memory_lru():
+    storage = MemorySessionStorage(max_sessions=2)
+    storage.save("0001", 1)
+    storage.save("0002", 2)
+    storage.load("0001")                # now 0002 is least recently used
+    storage.save("0003", 3)
+    assert storage.sessionExists("0001") and storage.sessionExists("0003")
+    assert not storage.sessionExists("0002")
+
+def test_sqlite_shared(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    s1 = SQLiteSessionStorage(path)
+    s2 = SQLiteSessionStorage(path)
+    s1.save("abcd", {"a": 1})
+    s1.bulkSave("abcd", "x", "value")
+    assert s2.load("abcd") == {"a": 1}
+    assert s2.bulkLoad("abcd", "x") == "value"
+    s2.delete("abcd")
+    assert not s1.sessionExists("abcd")
+
+def test_sqlite_cleanup(tmp_path):
+    storage = SQLiteSessionStorage(str(tmp_path / "sessions.db"), session_timeout=0.1)
+    storage.save("abcd", {"a": 1})
+    storage.bulkSave("abcd", "x", "value")
+    time.sleep(0.2)
+    assert storage.load("abcd") is None
+    assert storage.bulkLoad("abcd", "x") is None
+    storage.cleanUp()
+    assert storage.execute("select count(*) from sessions", fetch=True) == (0,)
+    assert storage.execute("select count(*) from bulk", fetch=True) == (0,)
@@ -0,0 +1,78 @@
+import pytest
+from webpie import WPHandler, WPSessionApp, MemorySessionStorage
+from webpie.webob import Request
+
+class Handler(WPHandler):
+
+    def read(self, request, relpath, **args):
+        return "value=%s" % (self.session.get("x"),)
+
+    def write(self, request, relpath, x="1", **args):
+        self.session["x"] = x
+        return "ok"
+
+    def logout(self, request, relpath, **args):
+        self.session.invalidate()
+        return "bye"
+
+    def stream(self, request, relpath, x="1", **args):
+        def generate():
+            yield "a"
+            self.session["x"] = x               # changed while the body is generated
+            yield "b"
+        return generate()
+
+def get(app, path, sid=None):
+    req = Request.blank(path)
+    if sid:
+        req.headers["Cookie"] = "webpie_session_id=%s" % (sid,)
+    response = req.get_response(app)
+    return response, response.headers.get("Set-Cookie")
+
+def sid_from(cookie):
+    return cookie.split(";")[0].split("=", 1)[1]
+
+@pytest.fixture
+def storage():
+    return MemorySessionStorage()
+
+def test_read_only_request_creates_no_session(storage):
+    app = WPSessionApp(Handler, storage)
+    response, cookie = get(app, "/read")
+    assert response.text == "value=None"
+    assert cookie is None
+    assert len(storage.Sessions) == 0
+
+def test_write_sets_cookie_once(storage):
+    app = WPSessionApp(Handler, storage)
+    response, cookie = get(app, "/write?x=7")
+    assert cookie is not None and "HttpOnly" in cookie
+    sid = sid_from(cookie)
+    assert storage.load(sid) == {"x": "7"}
+
+    response, cookie = get(app, "/read", sid)
+    assert response.text == "value=7"
+    assert cookie is None
+
+def test_invalidate_expires_cookie(storage):
+    app = WPSessionApp(Handler, storage)
+    _, cookie = get(app, "/write")
+    sid = sid_from(cookie)
+    response, cookie = get(app, "/logout", sid)
+    assert cookie is not None and sid_from(cookie) == ""
+    assert not storage.sessionExists(sid)
+
+def test_streaming_changes_saved_on_close(storage):
+    app = WPSessionApp(Handler, storage)
+    _, cookie = get(app, "/write?x=1")
+    sid = sid_from(cookie)
+    response, cookie = get(app, "/stream?x=2", sid)
+    assert response.text == "ab"
+    assert storage.load(sid) == {"x": "2"}
+
+def test_session_created_while_streaming_not_stored(storage):
+    app = WPSessionApp(Handler, storage)
+    response, cookie = get(app, "/stream?x=2")
+    assert response.text == "ab"
+    assert cookie is None
+    assert len(storage.Sessions) == 0
@@ -0,0 +1,65 @@
+import os, glob
+import pytest
+from webpie import WPHandler, WPSessionApp, SessionStorage, SessionSerializer
+from webpie.WPSessionApp import Session
+from webpie.webob import Request
+
+@pytest.fixture
+def storage(tmp_path):
+    return SessionStorage(str(tmp_path), cleanup_frequency=3600)
+
+def files(storage):
+    return sorted(os.path.relpath(p, storage.RootPath)
+        for p in glob.glob(storage.RootPath + "/**/*", recursive=True) if os.path.isfile(p))
+
+def test_save_load(storage):
+    storage.save("abcd", {"a": 1})
+    assert storage.load("abcd") == {"a": 1}
+    assert files(storage) == ["d/c/abcd.data"]
+
+def test_failed_write_leaves_no_tmp_file(storage):
+    class Unwritable(object):
+        def dumps(self, data, bulk=False):
+            return "not bytes"
+    storage.save("abcd", {"a": 1})
+    storage.Serializer = Unwritable()
+    with pytest.raises(TypeError):
+        storage.save("abcd", {"a": 2})
+    assert files(storage) == ["d/c/abcd.data"]
+    storage.Serializer = SessionSerializer()
+    assert storage.load("abcd") == {"a": 1}
+
+def test_compressed_bulk_values(storage):
+    storage.Serializer = SessionSerializer(compress_bulk=True, compress_threshold=100)
+    big = "x" * 10000
+    storage.bulkSave("abcd", "big", big)
+    storage.bulkSave("abcd", "small", "y")
+    assert os.path.getsize(storage.bulkFilePath("abcd", "big")) < 1000
+    assert storage.bulkLoad("abcd", "big") == big
+    assert storage.bulkLoad("abcd", "small") == "y"
+
+def test_rotate_moves_bulk_values(storage):
+    session = Session(storage, None, 3600)
+    session["a"] = 1
+    session.save()
+    session.bulk["blob"] = b"data"
+    old_sid = session.SessionID
+    session.rotate()
+    assert session.SessionID != old_sid
+    assert not storage.sessionExists(old_sid)
+    assert storage.load(session.SessionID) == {"a": 1}
+    assert storage.bulkLoad(session.SessionID, "blob") == b"data"
+    assert storage.bulkLoad(old_sid, "blob") is None
+
+def test_storage_args_forwarded(tmp_path):
+    class Handler(WPHandler):
+        def hello(self, request, relpath, **args):
+            self.session["a"] = 1
+            return "ok"
+    serializer = SessionSerializer(protocol=2)
+    path = str(tmp_path / "sessions")
+    app = WPSessionApp(Handler, path, serializer=serializer, fsync=True)
+    response = Request.blank("/hello").get_response(app)
+    assert response.status_int == 200
+    storage = SessionStorage.storage(path)
+    assert storage.Serializer is serializer and storage.FSync
@@ -0,0 +1,51 @@
+import os, time, threading
+from webpie import SessionStorage
+
+def test_concurrent_sessions(tmp_path):
+    storage = SessionStorage(str(tmp_path))
+    errors = []
+
+    def worker(i):
+        sid = "%04x" % (i,)
+        try:
+            for n in range(50):
+                storage.save(sid, {"n": n})
+                assert storage.load(sid) == {"n": n}
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(16)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert errors == []
+    assert all(storage.load("%04x" % (i,)) == {"n": 49} for i in range(16))
+
+def test_other_sessions_not_blocked(tmp_path):
+    storage = SessionStorage(str(tmp_path))
+    sid = "0001"
+    # string hashes are randomized, pick a session with another lock
+    other = next(o for o in ("%04x" % (i,) for i in range(2, 100)) if storage.lock(o) is not storage.lock(sid))
+    with storage.lock(sid):
+        t = threading.Thread(target=storage.save, args=(other, {"a": 1}))
+        t.start()
+        t.join(5)
+        assert not t.is_alive()
+    assert storage.load(other) == {"a": 1}
+
+def test_cleanup_in_batches(tmp_path):
+    storage = SessionStorage(str(tmp_path), session_timeout=100)
+    storage.CleanUpBatchSize = 3
+    storage.CleanUpBatchPause = 0.01
+    old = time.time() - 1000
+    for i in range(10):
+        sid = "%04x" % (i,)
+        storage.save(sid, {})
+        storage.bulkSave(sid, "x", i)
+        if i % 2:
+            for path in [storage.dataFilePath(sid), storage.bulkFilePath(sid, "x")]:
+                os.utime(path, (old, old))
+    storage.cleanUp()
+    for i in range(10):
+        sid = "%04x" % (i,)
+        assert storage.sessionExists(sid) == (i % 2 == 0)
+        assert (storage.bulkLoad(sid, "x") is None) == (i % 2 == 1)
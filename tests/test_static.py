@@ -0,0 +1,86 @@
+import os, gzip, time
+import pytest
+from webpie import WPApp, WPHandler, WPStaticHandler, StaticFileCache
+from webpie.webob import Request
+
+TEXT = b"hello world " * 200
+
+@pytest.fixture(params=[True, False], ids=["cached", "uncached"])
+def app(request, tmp_path):
+    (tmp_path / "page.html").write_bytes(TEXT)
+    (tmp_path / "data.bin").write_bytes(bytes(range(256)) * 4)
+    cache = StaticFileCache(check_interval=0) if request.param else None
+
+    class Handler(WPHandler):
+        def __init__(self, req, app):
+            WPHandler.__init__(self, req, app)
+            self.static = WPStaticHandler(req, app, root=str(tmp_path), cache=cache)
+
+    return WPApp(Handler)
+
+def get(app, path, **headers):
+    return Request.blank(path, headers=headers).get_response(app)
+
+def test_get(app):
+    response = get(app, "/static/page.html")
+    assert response.status_int == 200
+    assert response.body == TEXT
+    assert response.content_type == "text/html"
+    assert response.etag and response.last_modified
+
+def test_not_found(app):
+    assert get(app, "/static/nothere").status_int == 404
+    assert get(app, "/static/../etc/passwd").status_int in (403, 404)
+
+def test_if_none_match(app):
+    etag = get(app, "/static/page.html").etag
+    response = get(app, "/static/page.html", **{"If-None-Match": '"%s"' % (etag,)})
+    assert response.status_int == 304
+    assert response.body == b""
+
+def test_if_modified_since(app):
+    last_modified = get(app, "/static/page.html").headers["Last-Modified"]
+    assert get(app, "/static/page.html", **{"If-Modified-Since": last_modified}).status_int == 304
+
+def test_range(app):
+    response = get(app, "/static/data.bin", Range="bytes=10-19")
+    assert response.status_int == 206
+    assert response.body == bytes(range(10, 20))
+    assert response.headers["Content-Range"] == "bytes 10-19/1024"
+    assert get(app, "/static/data.bin", Range="bytes=5000-").status_int == 416
+
+def test_etag_changes_with_file(app, tmp_path):
+    etag = get(app, "/static/page.html").etag
+    path = tmp_path / "page.html"
+    path.write_bytes(TEXT + b"more")
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    response = get(app, "/static/page.html")
+    assert response.body == TEXT + b"more"
+    assert response.etag != etag
+
+def test_same_etag_cached_and_uncached(tmp_path):
+    (tmp_path / "page.html").write_bytes(TEXT)
+    etags = []
+    for cache in (StaticFileCache(), None):
+        class Handler(WPHandler):
+            def __init__(self, req, app):
+                WPHandler.__init__(self, req, app)
+                self.static = WPStaticHandler(req, app, root=str(tmp_path), cache=cache)
+        etags.append(get(WPApp(Handler), "/static/page.html").etag)
+    assert etags[0] == etags[1]
+
+def test_gzip_cached(tmp_path):
+    (tmp_path / "page.html").write_bytes(TEXT)
+    cache = StaticFileCache()
+
+    class Handler(WPHandler):
+        def __init__(self, req, app):
+            WPHandler.__init__(self, req, app)
+            self.static = WPStaticHandler(req, app, root=str(tmp_path), cache=cache)
+
+    response = get(WPApp(Handler), "/static/page.html", **{"Accept-Encoding": "gzip"})
+    assert response.content_encoding == "gzip"
+    assert gzip.decompress(response.body) == TEXT
+    assert response.etag.endswith("-gzip")
+    assert cache.Memory > 0
@@ -0,0 +1,62 @@
+import socket, time
+from multiserver.multiserver import MultiServerSubprocess, Housekeeper
+
+class FakeServer(object):
+
+    def __init__(self):
+        self.Accepted = []
+        self.RequestCount = 0
+
+    def connection_accepted(self, csock, caddr):
+        self.Accepted.append(csock)
+
+def make_subprocess(tmp_path):
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(50)
+    sock.setblocking(False)
+    p = MultiServerSubprocess(sock.getsockname()[1], sock, str(tmp_path / "config.yaml"))
+    p.MasterSide = False
+    p.Server = FakeServer()
+    return p
+
+def connect(p, n):
+    clients = [socket.create_connection(("127.0.0.1", p.Port), timeout=5) for _ in range(n)]
+    time.sleep(0.1)
+    return clients
+
+def test_accept_batches(tmp_path):
+    p = make_subprocess(tmp_path)
+    p.MaxAcceptBatch = 4
+    clients = connect(p, 10)
+    p.accept_pending()
+    assert len(p.Server.Accepted) == 4
+    p.accept_pending(all=True)
+    assert len(p.Server.Accepted) == 10
+    p.accept_pending()                      # nothing left, does not block
+    assert len(p.Server.Accepted) == 10
+    for s in p.Server.Accepted + clients:
+        s.close()
+    p.Sock.close()
+
+def test_housekeeper_messages(tmp_path):
+    p = make_subprocess(tmp_path)
+    p.MasterCheckInterval = 0.05
+    p.CheckConfigInterval = 1000
+    p.MaxRequests = 10
+    p.MaxAge = None
+    housekeeper = Housekeeper(p)
+    housekeeper.start()
+    try:
+        # recycling is requested once when max_requests is reached
+        p.Server.RequestCount = 10
+        assert p.ConnectionToSubprocess.poll(5)
+        assert p.ConnectionToSubprocess.recv() == "recycle"
+        assert not p.ConnectionToSubprocess.poll(0.2)
+        # "stop" from the master stops the subprocess
+        p.ConnectionToSubprocess.send("stop")
+        housekeeper.join(5)
+        assert p.Stop and not housekeeper.is_alive()
+    finally:
+        p.Stop = True
+        p.Sock.close()
@@ -0,0 +1,27 @@
+import time, datetime
+from webpie.logs.log_file import TimestampFormatter, make_timestamp, next_midnight
+
+def reference(t):
+    d = datetime.datetime.fromtimestamp(t)
+    return d.strftime("%m/%d/%Y %H:%M:%S") + ".%03d" % (d.microsecond//1000)
+
+def test_same_as_datetime():
+    formatter = TimestampFormatter()
+    t0 = time.time()
+    for i in range(5000):
+        t = t0 + i*0.0007
+        assert formatter.format(t) == reference(t)
+
+def test_rounding_to_next_second():
+    formatter = TimestampFormatter()
+    t = 1700000000.9999997
+    assert formatter.format(t) == reference(t)
+    assert formatter.format(t).endswith(".000")
+
+def test_datetime_argument():
+    d = datetime.datetime(2024, 2, 3, 4, 5, 6, 789000)
+    assert make_timestamp(d) == "02/03/2024 04:05:06.789"
+
+def test_next_midnight():
+    t = time.mktime((2024, 3, 5, 13, 30, 0, 0, 0, -1))
+    assert datetime.datetime.fromtimestamp(next_midnight(t)) == datetime.datetime(2024, 3, 6)
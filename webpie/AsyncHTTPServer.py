@@ -0,0 +1,294 @@
+import asyncio, ssl, traceback, tempfile, io, time
+
+from .HTTPServer import HTTPServer, Request, ChunkedDecoder
+
+#
+# AsyncHTTPServer accepts connections, performs TLS handshakes and reads request headers and bodies
+# on a single asyncio event loop thread. Only completely received requests are dispatched to the services,
+# so idle and slow clients do not occupy threads. After the response is sent, persistent connections
+# are returned back to the event loop.
+#
+
+class AsyncHTTPServer(HTTPServer):
+
+    RecvSize = 64*1024
+    DefaultKeepAlive = True             # idle connections wait in the event loop and do not occupy threads
+    DefaultIdleTimeout = 10.0
+    MaxBufferedBody = 1024*1024         # larger bodies are spooled to a temporary file, unless body_spool_threshold is set
+
+    def __init__(self, port, *params, **args):
+        HTTPServer.__init__(self, port, *params, **args)
+        self.Loop = None
+        self.AcceptTask = None
+        self.Connections = set()        # asyncio tasks reading requests
+
+    def connectionCount(self):
+        return len(self.Connections)
+
+    def run(self):
+        self.Loop = loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.serve())
+        finally:
+            for task in list(self.Connections):
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*self.Connections, return_exceptions=True))
+            loop.close()
+            self.Loop = None
+        self.debug("stopped")
+
+    async def serve(self):
+        sock = self.listen()
+        sock.setblocking(False)
+        self.AcceptTask = asyncio.current_task()
+        try:
+            while not self.Stop:
+                try:
+                    csock, caddr = await self.Loop.sock_accept(sock)
+                except asyncio.CancelledError:
+                    break
+                except Exception as exc:
+                    if not self.Stop:
+                        self.error("Error accepting connection: %s" % (exc,))
+                    continue
+                self.start_connection(Request(self.Port, csock, caddr, server=self))
+        finally:
+            try:    sock.close()
+            except: pass
+            self.Sock = None
+
+    def start_connection(self, request):
+        # runs in the event loop thread
+        if self.Stop:
+            return request.close()
+        task = self.Loop.create_task(self.read_request(request))
+        self.Connections.add(task)
+        task.add_done_callback(self.Connections.discard)
+
+    def connection_accepted(self, csock, caddr):        # called externally by multiserver
+        request = Request(self.Port, csock, caddr, server=self)
+        self.Loop.call_soon_threadsafe(self.start_connection, request)
+
+    def connection_reused(self, request):
+        # called by the request processor thread after the response was sent over a persistent connection
+        loop = self.Loop
+        if loop is None or self.Stop:
+            return request.close()
+        loop.call_soon_threadsafe(self.start_connection, request)
+
+    def close(self):
+        self.Stop = True
+        loop = self.Loop
+        if loop is not None and self.AcceptTask is not None:
+            loop.call_soon_threadsafe(self.AcceptTask.cancel)
+
+    stop = close
+
+    #
+    # non-blocking I/O
+    #
+
+    def wait_io(self, sock, write=False):
+        loop = self.Loop
+        fd = sock.fileno()
+        future = loop.create_future()
+        if write:
+            loop.add_writer(fd, lambda: future.done() or future.set_result(None))
+            future.add_done_callback(lambda _: loop.remove_writer(fd))
+        else:
+            loop.add_reader(fd, lambda: future.done() or future.set_result(None))
+            future.add_done_callback(lambda _: loop.remove_reader(fd))
+        return future
+
+    async def recv(self, sock, n):
+        while True:
+            try:
+                return sock.recv(n)
+            except (BlockingIOError, InterruptedError, ssl.SSLWantReadError):
+                await self.wait_io(sock)
+            except ssl.SSLWantWriteError:
+                await self.wait_io(sock, write=True)
+
+    async def sendall(self, sock, data):
+        data = memoryview(data)
+        while data:
+            try:
+                n = sock.send(data)
+            except (BlockingIOError, InterruptedError, ssl.SSLWantWriteError):
+                await self.wait_io(sock, write=True)
+            except ssl.SSLWantReadError:
+                await self.wait_io(sock)
+            else:
+                data = data[n:]
+
+    async def handshake(self, csock):
+        ssl_sock = self.SocketWrapper.SSLContext.wrap_socket(csock, server_side=True, do_handshake_on_connect=False)
+        while True:
+            try:
+                ssl_sock.do_handshake()
+                return ssl_sock
+            except ssl.SSLWantReadError:
+                await self.wait_io(ssl_sock)
+            except ssl.SSLWantWriteError:
+                await self.wait_io(ssl_sock, write=True)
+
+    #
+    # request reading
+    #
+
+    async def read_request(self, request):
+        dispatched = False
+        header = None
+        dispatch_status = None
+        csock = request.CSock
+        timings = request.Timings
+        try:
+            if timings is not None:
+                timings.ReadStarted = time.monotonic()
+            csock.setblocking(False)
+            if request.RequestCount == 1 and self.SocketWrapper is not None:
+                try:
+                    csock = await asyncio.wait_for(self.handshake(csock), self.Timeout)
+                except Exception as e:
+                    self.debug("Error wrapping socket: %s" % (e,))
+                    return
+                request.CSock = request.SSLInfo = csock
+                if timings is not None:
+                    timings.Handshake = time.monotonic()
+
+            header = self.HeaderClass()
+            timeout = self.Timeout if request.RequestCount == 1 else self.IdleTimeout
+            try:
+                body = await asyncio.wait_for(self.read_header(csock, header, request.Body), timeout)
+            except asyncio.TimeoutError:
+                header.Error = "timeout"
+                body = b''
+            request.Received = time.monotonic()
+            if timings is not None and header.Complete:
+                timings.HeaderReceived = time.monotonic()
+                timings.BytesIn = len(header.Raw) + 4
+
+            if not header.Complete or not header.is_valid() or not header.is_client():
+                if request.RequestCount > 1 and not header.Complete and not header.Buffer:
+                    self.debug("persistent connection closed after %d requests" % (request.RequestCount - 1,))
+                    dispatch_status = "closed"
+                else:
+                    dispatch_status = "invalid request"
+                return
+
+            request.HTTPHeader = header
+            try:
+                request.Body = await self.read_body(request, header, body)
+            except asyncio.TimeoutError:
+                dispatch_status = "request timeout"
+                return
+            except ValueError as e:
+                self.debug("Error reading request body: %s" % (e,))
+                dispatch_status = "invalid request"
+                return
+
+            csock.setblocking(True)
+            if timings is not None:
+                timings.Dispatched = time.monotonic()
+            dispatched, service, dispatch_status = self.dispatch(request)
+        except asyncio.CancelledError:
+            dispatch_status = "closed"
+        except Exception as exc:
+            dispatch_status = "error"
+            self.error("Error reading request: %s" % (traceback.format_exc(),))
+        finally:
+            if not dispatched:
+                if header is not None and header.Complete and request.CSock is not None:
+                    try:
+                        request.CSock.setblocking(True)
+                        request.reject(dispatch_status)
+                    except Exception:
+                        pass
+                    self.log('%s %s:%s :%s %s %s -> (%s)' %
+                        (   request.Id, request.CAddr[0], request.CAddr[1], request.ServerPort,
+                            header.Method, header.OriginalURI, dispatch_status
+                        )
+                    )
+                elif dispatch_status != "closed":
+                    self.log('%s:%s :%s (request reading error)' %
+                        (   request.CAddr[0], request.CAddr[1], request.ServerPort)
+                    )
+                if timings is not None and dispatch_status != "closed":
+                    timings.Ended = time.monotonic()
+                    self.log(request.access_record(dispatch_status=dispatch_status, header=header), channel="access")
+                request.close()
+
+    async def read_header(self, csock, header, buffered):
+        received, error, body = False, False, b''
+        if buffered:
+            received, error, body = header.consume(buffered)
+        while not received and not error:
+            data = await self.recv(csock, self.RecvSize)
+            if not data:
+                break
+            received, error, body = header.consume(data)
+        return body
+
+    async def read_body(self, request, header, body):
+        # receives and decodes the request body, returns the data received after the body
+        # bodies larger than the spool threshold are stored in a temporary file, written in the default executor
+        # so that the disk I/O does not block the event loop
+        # raises asyncio.TimeoutError if the client sends nothing for Timeout seconds, however long the whole body takes
+        chunked = "chunked" in header.get("Transfer-Encoding", "").lower()
+        content_length = 0 if chunked else int(header.get("Content-Length", 0))
+        threshold = self.BodySpoolThreshold if self.BodySpoolThreshold is not None else self.MaxBufferedBody
+        if not chunked and len(body) >= content_length and content_length <= threshold:
+            return body
+
+        if header.get("Expect") == "100-continue":
+            await self.sendall(request.CSock, b'HTTP/1.1 100 Continue\r\n\r\n')
+            request.ContinueSent = True
+
+        loop = self.Loop
+        decoder = ChunkedDecoder() if chunked else None
+        remaining = content_length
+        parts = []
+        size = 0
+        spool = None
+        data = body
+        rest = b''
+        received = 0                    # bytes on the wire
+        while True:
+            received += len(data)
+            if chunked:
+                decoded = decoder.feed(data)
+                done = decoder.done
+            else:
+                decoded, rest = data[:remaining], data[remaining:]
+                remaining -= len(decoded)
+                done = remaining <= 0
+            if decoded:
+                size += len(decoded)
+                if spool is not None:
+                    await loop.run_in_executor(None, spool.write, decoded)
+                else:
+                    parts.append(decoded)
+                    if size > threshold:
+                        spool = await loop.run_in_executor(None, tempfile.TemporaryFile)
+                        await loop.run_in_executor(None, spool.writelines, parts)
+                        parts = []
+            if done:
+                break
+            data = await asyncio.wait_for(self.recv(request.CSock, self.RecvSize), self.Timeout)
+            if not data:
+                raise ValueError("unexpected end of request body")
+
+        if chunked:
+            rest = decoder.rest()
+        elif spool is None:
+            # the body is small, keep it in the buffer
+            return b''.join(parts) + rest
+        if spool is None:
+            spool = io.BytesIO(b''.join(parts))
+            spool.seek(0)
+        else:
+            await loop.run_in_executor(None, spool.seek, 0)
+        request.BodySpool = spool
+        request.BodyBytesIn = received - len(rest)
+        return rest
@@ -1,10 +1,12 @@
-import fnmatch, traceback, sys, time, os.path, stat, pprint, re, signal, importlib, platform, os
+import fnmatch, traceback, sys, time, json, math, os.path, stat, pprint, re, signal, importlib, platform, os, itertools
 
 from socket import *
+import socket as socket_module
+from collections import deque
 from pythreader import PyThread, synchronized, Task, TaskQueue, Primitive
 from webpie import Response
 from .uid import uid
-from .WPApp import WPApp
+from .WPApp import WPApp, query_dict, query_pairs, split_query
 from .logs import Logged, Logger
 
 from .py3 import PY2, PY3, to_str, to_bytes
@@ -13,46 +15,274 @@ import pythreader
 
 macos = sys.platform.lower().startswith("darwin")
 
+class ChunkedDecoder(object):
+    
+    # incremental decoder of the "chunked" transfer coding
+    
+    MAXLINE = 4096
+    SIZE_RE = re.compile(rb"[0-9A-Fa-f]{1,16}")      # chunk size: hex digits only, no sign, "0x" or "_"
+    
+    def __init__(self):
+        self.Buffer = b''           # received, but not decoded yet
+        self.State = "size"         # "size", "data", "data_end", "trailer" or "done"
+        self.ChunkRemaining = 0
+        
+    @property
+    def done(self):
+        return self.State == "done"
+        
+    def rest(self):
+        # data received after the end of the body
+        rest, self.Buffer = self.Buffer, b''
+        return rest
+        
+    def line(self):
+        i = self.Buffer.find(b"\n")
+        if i < 0:
+            if len(self.Buffer) > self.MAXLINE:
+                raise ValueError("chunked body: line is too long")
+            return None
+        line, self.Buffer = self.Buffer[:i+1], self.Buffer[i+1:]
+        return line.strip()
+        
+    def feed(self, data):
+        # returns decoded data
+        self.Buffer = self.Buffer + data if self.Buffer else data
+        out = []
+        while self.Buffer and self.State != "done":
+            if self.State == "data":
+                n = min(self.ChunkRemaining, len(self.Buffer))
+                out.append(self.Buffer[:n])
+                self.Buffer = self.Buffer[n:]
+                self.ChunkRemaining -= n
+                if not self.ChunkRemaining:
+                    self.State = "data_end"
+            else:
+                line = self.line()
+                if line is None:
+                    break
+                if self.State == "size":
+                    size = line.split(b";", 1)[0].strip()
+                    if not self.SIZE_RE.fullmatch(size):
+                        raise ValueError("chunked body: invalid chunk size: %s" % (line[:100],))
+                    size = int(size, 16)
+                    if size:
+                        self.ChunkRemaining = size
+                        self.State = "data"
+                    else:
+                        self.State = "trailer"
+                elif self.State == "data_end":
+                    if line:
+                        raise ValueError("chunked body: CRLF expected after chunk data")
+                    self.State = "size"
+                elif self.State == "trailer":
+                    if not line:
+                        self.State = "done"
+        return b''.join(out)
+
 class BodyFile(object):
     
-    def __init__(self, buf, sock, length):
+    def __init__(self, buf, sock, length, chunked=False, spool=None):
         #print("BodyFile: buf:", buf)
-        self.Buffer = buf
+        self.Buffer = buf                   # received from the socket, not consumed yet
         self.Sock = sock
-        self.Remaining = length
+        self.Remaining = length             # Content-Length framing: bytes of the body not received yet
+        self.Decoder = ChunkedDecoder() if chunked else None
+        self.Data = b''                     # decoded, not read yet
+        self.Spool = spool                  # file with the whole body, already received
+        self.EOF = False
+        self.BytesIn = 0                    # received from the socket or the buffer, before decoding
         
     def get_chunk(self, n):
         #print("get_chunk: Buffer:", self.Buffer)
+        out = b''
         if self.Buffer:
             out = self.Buffer[:n]
             self.Buffer = self.Buffer[n:]
         elif self.Sock is not None:
             out = self.Sock.recv(n)
             if not out: self.Sock = None
+        self.BytesIn += len(out)
         return out
         
     MAXMSG = 8192
     
+    def next_chunk(self, n):
+        # returns up to n bytes of the body or b'' at the end of the body
+        if self.Data:
+            out = self.Data[:n]
+            self.Data = self.Data[n:]
+            return out
+        if self.EOF:
+            return b''
+        if self.Spool is not None:
+            out = self.Spool.read(n)
+        elif self.Decoder is not None:
+            out = b''
+            while not out and not self.Decoder.done:
+                data = self.get_chunk(max(n, self.MAXMSG))
+                if not data:
+                    raise ValueError("chunked body: unexpected end of data")
+                out = self.Decoder.feed(data)
+            if self.Decoder.done:
+                rest = self.Decoder.rest()
+                self.BytesIn -= len(rest)
+                self.Buffer = rest + self.Buffer
+            if len(out) > n:
+                out, self.Data = out[:n], out[n:]
+        else:
+            if self.Remaining is not None:
+                n = min(n, self.Remaining)
+            out = self.get_chunk(n) if n > 0 else b''
+            if self.Remaining is not None:
+                self.Remaining -= len(out)
+        if not out:
+            self.EOF = True
+        return out
+    
     def read(self, N = None):
         #print ("read({})".format(N))
         #print ("Buffer:", self.Buffer)
-        if N is None:   N = self.Remaining
+        if N is not None and N < 0:
+            N = None
         out = []
         n = 0
-        eof = False
-        while not eof and (N is None or n < N):
+        while N is None or n < N:
             ntoread = self.MAXMSG if N is None else N - n
-            chunk = self.get_chunk(ntoread)
+            chunk = self.next_chunk(ntoread)
             if not chunk:
-                eof = True
-            else:
-                n += len(chunk)
-                out.append(chunk)
+                break
+            n += len(chunk)
+            out.append(chunk)
         out = b''.join(out)
-        if self.Remaining is not None:
-            self.Remaining -= len(out)
         #print ("returning:[{}]".format(out))
         return out
+        
+    def readline(self, limit = -1):
+        out = []
+        n = 0
+        while limit is None or limit < 0 or n < limit:
+            chunk = self.next_chunk(self.MAXMSG if limit is None or limit < 0 else limit - n)
+            if not chunk:
+                break
+            i = chunk.find(b"\n")
+            if i >= 0:
+                self.Data = chunk[i+1:] + self.Data
+                out.append(chunk[:i+1])
+                break
+            out.append(chunk)
+            n += len(chunk)
+        return b''.join(out)
+        
+    def readlines(self, hint = -1):
+        lines = []
+        n = 0
+        while hint is None or hint <= 0 or n < hint:
+            line = self.readline()
+            if not line:
+                break
+            lines.append(line)
+            n += len(line)
+        return lines
+        
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            yield line
+            
+    def spool(self, threshold):
+        # reads the rest of the body into a temporary file, which stays in memory until it grows over the threshold
+        # returns the length of the body
+        if self.Spool is None:
+            import tempfile
+            spool = tempfile.SpooledTemporaryFile(max_size=threshold)
+            chunk_size = max(self.MAXMSG, threshold//16)
+            data, self.Data = self.Data, b''
+            if not data:
+                data = self.next_chunk(chunk_size)
+            while data:
+                spool.write(data)
+                data = self.next_chunk(chunk_size)
+            spool.seek(0)
+            self.Spool = spool
+            self.EOF = False
+        pos = self.Spool.tell()
+        size = self.Spool.seek(0, 2)
+        self.Spool.seek(pos)
+        return size - pos
+
+    MAXDRAIN = 1024*1024
+
+    def drain(self):
+        # reads and discards the unread portion of the body
+        # returns the data received after the end of the body or None if the connection can not be reused
+        if self.Spool is None and self.Decoder is None and (self.Remaining is None or self.Remaining > self.MAXDRAIN):
+            return None
+        if self.Spool is None:
+            try:
+                n = 0
+                while n <= self.MAXDRAIN:
+                    chunk = self.next_chunk(self.MAXMSG)
+                    if not chunk:
+                        break
+                    n += len(chunk)
+                else:
+                    return None
+            except Exception:
+                return None
+        rest, self.Buffer = self.Buffer, b''
+        return rest
+        
+    def close(self):
+        if self.Spool is not None:
+            self.Spool.close()
+            self.Spool = None
+
+class FileWrapper(object):
+    
+    # wsgi.file_wrapper implementation. The server sends the file with os.sendfile(), if possible
+    
+    def __init__(self, filelike, block_size=8192, offset=None, length=None):
+        self.File = filelike
+        self.BlockSize = block_size
+        self.Offset = offset
+        self.Length = length            # None - to the end of the file
+        
+    def __iter__(self):
+        if self.Offset is not None:
+            self.File.seek(self.Offset)
+        remaining = self.Length
+        while remaining is None or remaining > 0:
+            data = self.File.read(self.BlockSize if remaining is None else min(self.BlockSize, remaining))
+            if not data:
+                break
+            if remaining is not None:
+                remaining -= len(data)
+            yield data
+            
+    def app_iter_range(self, start, stop):
+        # used by webob Response to serve Range requests
+        offset = (self.Offset or 0) + (start or 0)
+        length = None if stop is None else stop - (start or 0)
+        return FileWrapper(self.File, self.BlockSize, offset=offset, length=length)
+        
+    def close(self):
+        if hasattr(self.File, "close"):
+            self.File.close()
+
+_CGINames = {}              # header name -> WSGI environ key, e.g. "User-Agent" -> "HTTP_USER_AGENT"
+
+def cgi_name(name):
+    key = _CGINames.get(name)
+    if key is None:
+        key = name.upper().replace("-", "_")
+        if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = "HTTP_" + key
+        if len(_CGINames) < 1000:
+            _CGINames[name] = key
+    return key
 
 class HTTPHeader(object):
 
@@ -65,6 +295,7 @@ class HTTPHeader(object):
         self.URI = None
         self.OriginalURI = None
         self.Headers = {}
+        self.CGIHeaders = {}            # headers keyed by WSGI environ names
         self.Raw = b""
         self.Buffer = b""
         self.Complete = False
@@ -75,13 +306,16 @@ class HTTPHeader(object):
         
     __repr__ = __str__
 
-    def recv(self, sock):
+    def recv(self, sock, timeout=15.0, buffered=b''):
+        # buffered: data already received from the socket, e.g. pipelined after the previous request
         tmo = sock.gettimeout()
-        sock.settimeout(15.0)
+        sock.settimeout(timeout)
         received = eof = False
         self.Error = None
         try:
             body = b''
+            if buffered:
+                received, error, body = self.consume(buffered)
             while not received and not self.Error and not eof:       # shutdown() will set it to None
                 try:    
                     data = sock.recv(1024)
@@ -133,32 +367,50 @@ class HTTPHeader(object):
         header = to_str(header)
         lines = [l.strip() for l in header.split("\n")]
         if lines:
-            self.Headline = headline = lines[0]
-            
-            words = headline.split(" ", 2)
-            #print ("HTTPHeader: headline:", headline, "    words:", words)
-            if len(words) != 3:
-                self.Error = "Can not parse headline. len(words)=%d" % (len(words),)
+            if not self.parseHeadline(lines[0]):
                 return True, True, b''      # malformed headline
-            if words[0].lower().startswith("http/"):
-                self.StatusCode = int(words[1])
-                self.StatusMessage = words[2]
-                self.Protocol = words[0].upper()
-            else:
-                self.Method = words[0].upper()
-                self.Protocol = words[2].upper()
-                self.URI = self.OriginalURI = words[1]
-                    
+            cgi_headers = {}
             for l in lines[1:]:
                 if not l:   continue
                 try:   
                     h, b = tuple(l.split(':', 1))
-                    headers[h.strip()] = b.strip()
+                    h, b = h.strip(), b.strip()
+                    headers[h] = cgi_headers[cgi_name(h)] = b
                 except: pass
             self.Headers = headers
+            self.CGIHeaders = cgi_headers
         self.Buffer = b""
         return True, False, rest
 
+    def parseHeadline(self, headline):
+        self.Headline = headline
+        words = headline.split(" ", 2)
+        #print ("HTTPHeader: headline:", headline, "    words:", words)
+        if len(words) != 3:
+            self.Error = "Can not parse headline. len(words)=%d" % (len(words),)
+            return False
+        if words[0].lower().startswith("http/"):
+            self.StatusCode = int(words[1])
+            self.StatusMessage = words[2]
+            self.Protocol = words[0].upper()
+        else:
+            self.Method = words[0].upper()
+            self.Protocol = words[2].upper()
+            self.URI = self.OriginalURI = words[1]
+        return True
+
+    def get(self, name, default=None):
+        # case-insensitive header lookup
+        return self.CGIHeaders.get(cgi_name(name), default)
+
+    def keepAlive(self):
+        # whether the client wants the connection to stay open after the response
+        connection = self.get("Connection", "").lower()
+        if self.Protocol == "HTTP/1.1":
+            return "close" not in connection
+        else:
+            return "keep-alive" in connection
+
     def path(self):
         return self.URI.split("?",1)[0]
 
@@ -170,10 +422,10 @@ class HTTPHeader(object):
 
     def removeKeepAlive(self):
         if "Connection" in self.Headers:
-            self.Headers["Connection"] = "close"
+            self.Headers["Connection"] = self.CGIHeaders["HTTP_CONNECTION"] = "close"
 
     def forceConnectionClose(self):
-        self.Headers["Connection"] = "close"
+        self.Headers["Connection"] = self.CGIHeaders["HTTP_CONNECTION"] = "close"
 
     def headersAsText(self):
         headers = []
@@ -197,29 +449,130 @@ class HTTPHeader(object):
     def as_bytes(self, original=False):
         return to_bytes(self.as_text(original))
 
+class BufferedHTTPHeader(HTTPHeader):
+    #
+    # Receives the header into a preallocated buffer with recv_into and searches only the newly received bytes
+    # for the end of the header. Repeated headers are kept, joined with ", " ("; " for Cookie)
+    #
+
+    RecvSize = 16*1024
+
+    def __init__(self):
+        HTTPHeader.__init__(self)
+        self.Buffer = bytearray()
+
+    def recv(self, sock, timeout=15.0, buffered=b''):
+        tmo = sock.gettimeout()
+        sock.settimeout(timeout)
+        received = eof = False
+        self.Error = None
+        view = memoryview(bytearray(self.RecvSize))
+        try:
+            body = b''
+            if buffered:
+                received, error, body = self.consume(buffered)
+            while not received and not self.Error and not eof:
+                try:
+                    n = sock.recv_into(view)
+                except Exception as e:
+                    self.Error = "Error in recv(): %s" % (e,)
+                    n = 0
+                if n:
+                    received, error, body = self.consume(view[:n])
+                else:
+                    eof = True
+        finally:
+            sock.settimeout(tmo)
+        return received, body
+
+    def consume(self, inp):
+        buf = self.Buffer
+        start = max(len(buf) - 3, 0)        # the end of header may span the old and new data
+        buf += inp
+        match = self.EOH_RE.search(buf, start)
+        if not match:
+            error = False
+            if len(buf) > self.MAXREAD:
+                self.Error = "Request is too long: %d" % (len(buf),)
+                error = True
+            return False, error, b''
+        i1, i2 = match.span()
+        self.Complete = True
+        self.Raw = bytes(buf[:i1])
+        rest = bytes(buf[i2:])
+        self.Buffer = b""
+        lines = to_str(self.Raw).split("\n")
+        if not self.parseHeadline(lines[0].strip()):
+            return True, True, b''
+        headers = {}
+        cgi_headers = {}
+        names = {}              # environ key -> header name as first received
+        for l in lines[1:]:
+            h, colon, v = l.partition(":")
+            if not colon:   continue
+            h, v = h.strip(), v.strip()
+            key = cgi_name(h)
+            if key in cgi_headers:
+                v = cgi_headers[key] + ("; " if key == "HTTP_COOKIE" else ", ") + v
+                h = names[key]
+            else:
+                names[key] = h
+            headers[h] = cgi_headers[key] = v
+        self.Headers = headers
+        self.CGIHeaders = cgi_headers
+        return True, False, rest
+
+HeaderParsers = {
+    "simple":       HTTPHeader,
+    "buffered":     BufferedHTTPHeader
+}
+
 class RequestProcessor(Task):
     
-    def __init__(self, wsgi_app, request):
+    def __init__(self, wsgi_app, request, admission=None):
+        # admission: ServiceQueue, which can reject the request before it is processed
         Task.__init__(self, name=f"[RequestProcessor {request.Id}]")
         #print("RequestTask: wsgi_app:", wsgi_app)
         self.WSGIApp = wsgi_app
         self.Request = request
+        self.Admission = admission
         self.OutBuffer = ""
         self.StatusCode = None
         self.ByteCount = 0
+        self.ContentLength = None
+        self.KeepAlive = False
+        self.Chunked = False
         self.Error = None
 
     def run(self):       
         request = self.Request
+        timings = request.Timings
+        if timings is not None:
+            timings.Started = time.monotonic()
+        complete = False
         #print("Task: request:", request)
         try:
-            env = request.wsgi_env() 
             header = request.HTTPHeader
             csock = request.CSock
 
-            if env["WebPie.headers"].get("Expect") == "100-continue":
+            admission = self.Admission
+            if admission is not None:
+                reason = admission.shed(request)
+                if reason is not None:
+                    request.RetryAfter = admission.retry_after()
+                    self.StatusCode = 503
+                    request.send_response(503, "Service unavailable")
+                    return self.error(reason)
+
+            if header.get("Expect") == "100-continue" and not request.ContinueSent:
                 csock.sendall(b'HTTP/1.1 100 Continue\n\n')
-                    
+
+            try:
+                env = request.wsgi_env() 
+            except ValueError as e:
+                request.send_response(400, "Invalid request")
+                return self.error("invalid request: %s" % (e,))
+
             out = []
             
             try:
@@ -235,56 +588,325 @@ class RequestProcessor(Task):
             
 
             #print("RequestProcessor.run: out:", out)
-            if self.OutBuffer:      # from start_response
-                #print("RequestProcessor.run: OutBuffer:", self.OutBuffer)
-                csock.sendall(to_bytes(self.OutBuffer))
-                
             self.ByteCount = 0
+            try:
+                if isinstance(out, FileWrapper) and not self.Chunked:
+                    self.send_file(csock, out)
+                else:
+                    self.send_body(csock, out)
+            except OSError as e:
+                return self.error("error sending body: %s" % (e,))
+            finally:
+                if hasattr(out, "close"):
+                    out.close()
 
-            for line in out:
-                line = to_bytes(line)
-                try:
-                    #print("sending line:", line)    
-                    csock.sendall(line)
-                    #print("HTTPServer: sent:", line)
-                except Exception as e:
-                    return self.error("error sending body: %s" % (e,))
-                self.ByteCount += len(line)
+            if self.ContentLength is not None and self.ContentLength != self.ByteCount:
+                # the response is not framed correctly, the client can only detect its end by the connection close
+                self.KeepAlive = False
+            complete = True
         finally:
             #print("HTTPServer: closing request...")
-            request.close()
+            if timings is not None:
+                timings.Ended = time.monotonic()
+            body = request.BodyFile
+            if complete and self.KeepAlive and self.Error is None:
+                request.keep_alive()        # reads the rest of the body
+            else:
+                request.close()
+            if timings is not None:
+                # request body bytes as received, e.g. including the chunked encoding
+                if request.BodyBytesIn is not None:
+                    timings.BytesIn += request.BodyBytesIn
+                elif body is not None:
+                    timings.BytesIn += body.BytesIn
+            self.OutBuffer = None
+            self.WSGIApp = self.Admission = None
+
+    CoalesceSize = 16*1024          # body pieces are accumulated up to this size before they are sent
+
+    def send_body(self, csock, out):
+        # small pieces of the body are sent with a single write, the headers are sent together with the first piece
+        pending = []
+        pending_size = 0
+        for data in out:
+            data = to_bytes(data)
+            if not data:
+                continue
+            self.ByteCount += len(data)
+            if pending_size + len(data) >= self.CoalesceSize:
+                if pending and len(data) >= self.CoalesceSize:
+                    # do not copy large pieces
+                    self.write(csock, pending, pending_size)
+                    pending, pending_size = [], 0
+                pending.append(data)
+                self.write(csock, pending, pending_size + len(data))
+                pending, pending_size = [], 0
+            else:
+                pending.append(data)
+                pending_size += len(data)
+        self.write(csock, pending, pending_size, last=True)
+
+    def send_file(self, csock, wrapper):
+        # socket.sendfile() uses os.sendfile() for plain sockets and falls back to send() for TLS sockets
+        timings = self.Request.Timings
+        if self.OutBuffer:
+            out = to_bytes(self.OutBuffer)
+            csock.sendall(out)
+            self.OutBuffer = None
+            if timings is not None:
+                timings.FirstByte = time.monotonic()
+                timings.BytesOut += len(out)
+        n = csock.sendfile(wrapper.File, wrapper.Offset or 0, wrapper.Length)
+        self.ByteCount += n
+        if timings is not None:
+            timings.BytesOut += n
+
+    def write(self, csock, parts, size, last=False):
+        if self.Chunked:
+            if size:
+                parts = [b"%x\r\n" % (size,)] + parts + [b"\r\n"]
+            if last:
+                parts.append(b"0\r\n\r\n")
+        if self.OutBuffer:      # from start_response
+            parts.insert(0, to_bytes(self.OutBuffer))
             self.OutBuffer = None
-            self.WSGIApp = None
+        if len(parts) == 1:
+            data = parts[0]
+        elif parts:
+            data = b"".join(parts)
+        else:
+            return
+        csock.sendall(data)
+        timings = self.Request.Timings
+        if timings is not None:
+            if timings.FirstByte is None:
+                timings.FirstByte = time.monotonic()
+            timings.BytesOut += len(data)
 
     def error(self, error):
         self.Error = error
 
-    def start_response(self, status, headers):
+    def start_response(self, status, headers, exc_info=None):
         self.StatusCode = int(status.split(None, 1)[0])
+        request = self.Request
+        header = request.HTTPHeader
+        framed = self.StatusCode // 100 == 1 or self.StatusCode in (204, 304) or header.Method == "HEAD"
         out = ["HTTP/1.1 " + status]
         for h,v in headers:
-            if h != "Connection":
-                out.append("%s: %s" % (h, v))
-        out.append("Connection: close")     # can not handle keep-alive
+            hl = h.lower()
+            if hl == "connection":
+                continue
+            if hl == "content-length" and not framed:
+                self.ContentLength = int(v)
+            elif hl == "transfer-encoding" and "chunked" in v.lower():
+                framed = True
+            out.append("%s: %s" % (h, v))
+        if not framed and self.ContentLength is None and header.Protocol == "HTTP/1.1":
+            # the length of the body is unknown
+            out.append("Transfer-Encoding: chunked")
+            self.Chunked = framed = True
+        self.KeepAlive = (framed or self.ContentLength is not None) and request.persistent()
+        if not self.KeepAlive:
+            out.append("Connection: close")
+        elif header.Protocol != "HTTP/1.1":
+            out.append("Connection: keep-alive")
         out.append(f"X-WebPie-Request-Id: {self.Request.Id}")
         self.OutBuffer = "\r\n".join(out) + "\r\n\r\n"
 
+class ServiceQueue(Primitive):
+
+    #
+    # Request queue of a service with admission control:
+    #   discipline = "fifo" - requests are processed in the order they were queued
+    #                "lifo" - the most recently queued requests are processed first
+    #                "codel" - FIFO, but while the queue has not been empty for codel_interval seconds,
+    #                          requests, which waited longer than codel_target, are rejected
+    #   deadline - requests, which are not started within this time after their headers were received, are rejected.
+    #              The time is counted from the header receipt, not from the connection accept, so that the time
+    #              a persistent connection was idle between requests is not counted against the next request.
+    #              Time spent in the listen queue and reading the header is not counted either.
+    # Rejected requests get 503 response with Retry-After estimated from the observed queue drain rate
+    #
+    # Waiting tasks are kept in a deque in the order they were added. When fewer than nworkers tasks are running,
+    # the next task is taken from the head for fifo and codel, and from the tail for lifo, and is given to
+    # the Executor TaskQueue, which runs each task in its own thread. The Executor callbacks are forwarded
+    # to the delegate of the ServiceQueue.
+    # capacity limits the number of waiting and running tasks, like the TaskQueue capacity does.
+    #
+
+    Disciplines = ("fifo", "lifo", "codel")
+    MaxRetryAfter = 120
+
+    def __init__(self, nworkers, capacity=None, delegate=None, discipline="fifo", deadline=None,
+                codel_target=0.005, codel_interval=0.1):
+        if discipline not in self.Disciplines:
+            raise ValueError(f"Unknown queue discipline: {discipline}")
+        Primitive.__init__(self)
+        self.NWorkers = nworkers
+        self.Capacity = capacity
+        self.Delegate = delegate
+        self.Held = False
+        self.Waiting = deque()
+        self.NRunning = 0               # tasks given to the Executor, which have not ended yet
+        self.Executor = TaskQueue(delegate=self)
+        self.LIFO = discipline == "lifo"
+        self.CoDel = discipline == "codel"
+        self.Deadline = deadline
+        self.CoDelTarget = codel_target
+        self.CoDelInterval = codel_interval
+        self.LastEmpty = time.monotonic()
+        self.LastDone = None
+        self.DoneInterval = None        # moving average of the time between request completions
+
+    def add(self, task, timeout=None):
+        # blocks while the queue is full, raises RuntimeError if it is still full after timeout seconds
+        t1 = None if timeout is None else time.monotonic() + timeout
+        with self:
+            while self.Capacity is not None and len(self) >= self.Capacity:
+                dt = None if t1 is None else t1 - time.monotonic()
+                if dt is not None and dt <= 0:
+                    raise RuntimeError("queue is full")
+                self.sleep(dt)
+            self.Waiting.append(task)
+        self.start_tasks()
+        return task
+
+    @synchronized
+    def start_tasks(self):
+        waiting = self.Waiting
+        while not self.Held and waiting and (self.NWorkers is None or self.NRunning < self.NWorkers):
+            task = waiting.pop() if self.LIFO else waiting.popleft()
+            self.NRunning += 1
+            self.Executor.addTask(task)
+
+    def call_delegate(self, cb, *params):
+        if self.Delegate is not None and hasattr(self.Delegate, cb):
+            try:
+                return getattr(self.Delegate, cb)(*params)
+            except:
+                traceback.print_exc(file=sys.stderr)
+
+    #
+    # Executor delegate interface
+    #
+
+    def taskIsStarting(self, executor, task, thread):
+        self.call_delegate("taskIsStarting", self, task, thread)
+
+    def taskStarted(self, executor, task, thread):
+        self.call_delegate("taskStarted", self, task, thread)
+
+    def taskEnded(self, executor, task, result):
+        try:
+            self.call_delegate("taskEnded", self, task, result)
+        finally:
+            self.taskDone(task)
+
+    def taskFailed(self, executor, task, exc_type, exc_value, tb):
+        try:
+            self.call_delegate("taskFailed", self, task, exc_type, exc_value, tb)
+        finally:
+            self.taskDone(task)
+
+    def taskDone(self, task):
+        # called by the Executor thread after the task ended or failed
+        now = time.monotonic()
+        with self:
+            if self.LastDone is not None:
+                dt = min(now - self.LastDone, 10.0)
+                self.DoneInterval = dt if self.DoneInterval is None else self.DoneInterval*0.9 + dt*0.1
+            self.LastDone = now
+            self.NRunning -= 1
+            self.wakeup()               # wake up add() and join() waiting for the queue
+        self.start_tasks()
+
+    def hold(self):
+        # running tasks continue, waiting tasks do not start
+        self.Held = True
+
+    def release(self):
+        self.Held = False
+        self.start_tasks()
+
+    @synchronized
+    def join(self):
+        # waits until no tasks are waiting or running
+        while self.Waiting or self.NRunning:
+            self.sleep()
+
+    waitUntilEmpty = join
+
+    def nwaiting(self):
+        return len(self.Waiting)
+
+    def nrunning(self):
+        return self.NRunning
+
+    @synchronized
+    def counts(self):
+        # (waiting, running)
+        return len(self.Waiting), self.NRunning
+
+    def __len__(self):
+        return len(self.Waiting) + self.NRunning
+
+    def shed(self, request):
+        # called when the request processing is about to start
+        # returns the reason to reject the request or None
+        received = request.Received
+        if received is None:
+            return None
+        now = time.monotonic()
+        waited = now - received
+        if self.Deadline is not None and waited > self.Deadline:
+            return "deadline expired"
+        if self.CoDel:
+            if not self.nwaiting():
+                self.LastEmpty = now
+            elif now > self.LastEmpty + self.CoDelInterval and waited > self.CoDelTarget:
+                return "queue overloaded"
+        return None
+
+    def retry_after(self):
+        # seconds, estimated time to process the requests in the queue
+        interval = self.DoneInterval
+        if interval is None:
+            return 1
+        return max(1, min(self.MaxRetryAfter, math.ceil(len(self) * interval)))
+
+    @staticmethod
+    def config_args(config):
+        # constructor arguments from the service configuration
+        return dict(
+            discipline = config.get("queue_discipline", "fifo"),
+            deadline = config.get("request_deadline"),
+            codel_target = config.get("codel_target", 0.005),
+            codel_interval = config.get("codel_interval", 0.1)
+        )
+
 class Service(Logged):
-    
-    def __init__(self, app, capacity=100, logger=None):
+
+    def __init__(self, app, capacity=100, logger=None, queue_discipline="fifo", request_deadline=None):
         Logged.__init__(self, f"[{app.__class__.__name__}]", logger=logger)
         self.Name = app.__class__.__name__
         self.WPApp = app
-        self.ProcessorQueue = TaskQueue(5, capacity=capacity, delegate=self)
+        self.ProcessorQueue = ServiceQueue(5, capacity=capacity, delegate=self,
+                discipline=queue_discipline, deadline=request_deadline)
+
+    @property
+    def Prefix(self):
+        # used by ServiceDispatcher, same as WPApp.match()
+        return self.WPApp.Prefix or ""
 
     def accept(self, request):
         if not self.WPApp.match(request.HTTPHeader.URI):
             return False, "no match"
-        p = RequestProcessor(self.WPApp, request)
+        p = RequestProcessor(self.WPApp, request, admission=self.ProcessorQueue)
         request.AppName = self.Name
         try:
             self.ProcessorQueue.add(p, timeout=0)
         except RuntimeError:
+            request.RetryAfter = self.ProcessorQueue.retry_after()
             return True, "service unavailable"
         else:
             return True, "accepted"
@@ -306,20 +928,90 @@ class Service(Logged):
                         task.StatusCode, task.ByteCount
                     )
         self.log(log_line)
+        if request.Timings is not None:
+            self.log(request.access_record(task), channel="access")
+
+class RequestTimings(object):
+    #
+    # Monotonic timestamps of the request processing stages. Collected only when the access log is enabled.
+    # For a request received over a persistent connection, Accepted is the time the connection was handed
+    # back to the server, so the "header" phase includes the time the connection was idle
+    #
+
+    def __init__(self):
+        self.Accepted = time.monotonic()
+        self.ReadStarted = None         # reader task started
+        self.Handshake = None           # TLS handshake done
+        self.HeaderReceived = None
+        self.Dispatched = None          # passed to the service queue
+        self.Started = None             # request processor started
+        self.FirstByte = None           # first byte of the response sent
+        self.Ended = None
+        self.BytesIn = 0
+        self.BytesOut = 0
+
+    def phases(self):
+        # durations of the stages in milliseconds
+        def ms(t1, t0):
+            return None if t1 is None or t0 is None else round((t1 - t0)*1000.0, 3)
+        read_started = self.ReadStarted
+        header_started = self.Handshake or read_started
+        last = self.Ended or time.monotonic()
+        return dict(
+            accept_ms   = ms(read_started, self.Accepted),
+            tls_ms      = ms(self.Handshake, read_started),
+            header_ms   = ms(self.HeaderReceived, header_started),
+            body_ms     = ms(self.Dispatched, self.HeaderReceived),
+            queue_ms    = ms(self.Started, self.Dispatched),
+            start_ms    = ms(self.FirstByte, self.Started),
+            send_ms     = ms(self.Ended, self.FirstByte),
+            ttfb_ms     = ms(self.FirstByte, self.Accepted),
+            total_ms    = ms(last, self.Accepted)
+        )
 
 class Request(object):
-    
-    def __init__(self, port, csock, caddr):
+
+    def __init__(self, port, csock, caddr, server=None, count=1):
         self.Id = uid()
         self.ServerPort = port
         self.CSock = csock
         self.CAddr = caddr
+        self.Server = server
+        self.RequestCount = count       # sequential number of the request on the connection
         self.HTTPHeader = None
         self.Body = b''
+        self.BodyFile = None
+        self.BodySpool = None           # file with the body, if it was received already
+        self.BodyBytesIn = None         # size of the body received into BodySpool, before decoding
         self.SSLInfo = None     
         self.AppName = None
         self.Environ = {}
-        
+        self.ContinueSent = False       # "100 Continue" was sent to the client already
+        self.Timings = RequestTimings() if server is not None and server.AccessLog else None
+        self.Received = None            # time.monotonic() when the header was received
+        self.RetryAfter = None          # for 503 responses
+
+    def persistent(self):
+        # whether the connection can be kept open after the response is sent
+        server = self.Server
+        header = self.HTTPHeader
+        return server is not None and server.KeepAlive \
+            and self.RequestCount < server.MaxRequestsPerConnection \
+            and header.keepAlive()
+
+    def keep_alive(self):
+        # hands the connection over to the next request and schedules reading its header
+        body_file = self.BodyFile
+        pending = body_file.drain() if body_file is not None else self.Body
+        if pending is None or self.CSock is None:
+            return self.close()
+        request = Request(self.ServerPort, self.CSock, self.CAddr, server=self.Server, count=self.RequestCount + 1)
+        request.SSLInfo = self.SSLInfo
+        request.Body = pending
+        self.CSock = self.SSLInfo = None
+        self.close()
+        self.Server.connection_reused(request)
+
     def close(self):
         if self.CSock is not None:
             try:
@@ -332,6 +1024,11 @@ class Request(object):
                 raise
             self.CSock = None
         self.SSLInfo = None
+        if self.BodyFile is not None:
+            self.BodyFile.close()
+        elif self.BodySpool is not None:
+            self.BodySpool.close()
+        self.BodyFile = self.BodySpool = None
 
     def wsgi_env(self):
         header = self.HTTPHeader
@@ -347,6 +1044,7 @@ class Request(object):
             QUERY_STRING = header.query(),
         )
         env.update(self.Environ)
+        env.update(header.CGIHeaders)          # HTTP_*, CONTENT_TYPE and CONTENT_LENGTH
         env["REQUEST_SCHEME"] = env["wsgi.url_scheme"] = "http"
         env["WebPie.request_id"] = self.Id
         env["WebPie.headers"] = header.Headers
@@ -357,45 +1055,39 @@ class Request(object):
             env["SSL_CLIENT_I_DN"] = issuer
             env["REQUEST_SCHEME"] = env["wsgi.url_scheme"] = "https"
         
-        env["query_dict"] = self.parseQuery(header.query())
-        
-        #print ("processRequest: env={}".format(env))
-        body_length = None
-        for h, v in header.Headers.items():
-            h = h.lower()
-            if h == "content-type": env["CONTENT_TYPE"] = v
-            elif h == "host":
-                words = v.split(":",1)
-                words.append("")    # default port number
-                env["HTTP_HOST"] = v
-                env["SERVER_NAME"] = words[0]
-                env["SERVER_PORT"] = words[1]
-            elif h == "content-length": 
-                env["CONTENT_LENGTH"] = body_length = int(v)
-            else:
-                env["HTTP_%s" % (h.upper().replace("-","_"),)] = v
+        if type(self).parseQuery is Request.parseQuery:
+            # the split query string is cached in the environ and reused by WPApp
+            env["query_dict"] = query_dict(query_pairs(env))
+        else:
+            env["query_dict"] = self.parseQuery(header.query())
+
+        host = env.get("HTTP_HOST")
+        if host is not None:
+            env["SERVER_NAME"], _, env["SERVER_PORT"] = host.partition(":")
+        body_length = 0
+        if "CONTENT_LENGTH" in env:
+            env["CONTENT_LENGTH"] = body_length = int(env["CONTENT_LENGTH"])
 
-        env["wsgi.input"] = BodyFile(self.Body, csock, body_length)
+        chunked = "chunked" in header.get("Transfer-Encoding", "").lower()
+        if self.BodySpool is not None:
+            # the body was received and decoded already
+            body = BodyFile(self.Body, csock, 0, spool=self.BodySpool)
+            env["CONTENT_LENGTH"] = body.spool(0)
+        elif chunked:
+            env.pop("CONTENT_LENGTH", None)     # Transfer-Encoding overrides Content-Length
+            body = BodyFile(self.Body, csock, None, chunked=True)
+        else:
+            body = BodyFile(self.Body, csock, body_length)
+        threshold = self.Server.BodySpoolThreshold if self.Server is not None else None
+        if threshold is not None and self.BodySpool is None and (chunked or body_length):
+            env["CONTENT_LENGTH"] = body.spool(threshold)
+        env["wsgi.input"] = self.BodyFile = body
+        env["wsgi.input_terminated"] = True
+        env["wsgi.file_wrapper"] = FileWrapper
         return env
 
     def parseQuery(self, query):
-        out = {}
-        for w in query.split("&"):
-            if w:
-                words = w.split("=", 1)
-                k = words[0]
-                if k:
-                    v = None
-                    if len(words) > 1:  v = words[1]
-                    if k in out:
-                        old = out[k]
-                        if type(old) != type([]):
-                            old = [old]
-                            out[k] = old
-                        out[k].append(v)
-                    else:
-                        out[k] = v
-        return out
+        return query_dict(split_query(query))
         
     def format_x509_name(self, x509_name):
         components = [(to_str(k), to_str(v)) for k, v in x509_name.get_components()]
@@ -414,8 +1106,50 @@ class Request(object):
         return subject, issuer
 
     def send_response(self, status, headline):
-        response = f"HTTP/1.1 {status} {headline}\n\n"
-        self.CSock.sendall(to_bytes(response))
+        retry_after = "" if self.RetryAfter is None else f"Retry-After: {self.RetryAfter}\n"
+        response = to_bytes(f"HTTP/1.1 {status} {headline}\n{retry_after}\n")
+        self.CSock.sendall(response)
+        if self.Timings is not None:
+            self.Timings.BytesOut += len(response)
+
+    ErrorResponses = {
+        "no match":             (404, "Service not found"),
+        "service unavailable":  (503, "Service unavailable"),
+        "invalid request":      (400, "Invalid request"),
+        "request timeout":      (408, "Request timeout")
+    }
+
+    def reject(self, dispatch_status):
+        # sends the error response for a request, which was not dispatched
+        status, headline = self.ErrorResponses.get(dispatch_status, (500, "Request dispatch error " + str(dispatch_status)))
+        self.send_response(status, headline)
+
+    def access_record(self, processor=None, dispatch_status=None, header=None):
+        # JSON line for the access log. processor is the RequestProcessor, if the request was dispatched
+        header = header or self.HTTPHeader
+        timings = self.Timings
+        record = dict(
+            time = round(time.time(), 3),
+            id = self.Id,
+            client = "%s:%s" % tuple(self.CAddr[:2]),
+            port = self.ServerPort,
+            n = self.RequestCount,
+            tls = self.Server is not None and self.Server.SocketWrapper is not None,
+            method = header and header.Method,
+            uri = header and header.OriginalURI,
+            app = self.AppName,
+            path = header.path() if header is not None and header.URI else None,
+            bytes_in = timings.BytesIn,
+            bytes_out = timings.BytesOut
+        )
+        if processor is not None:
+            record.update(status=processor.StatusCode, body_bytes=processor.ByteCount, error=processor.Error)
+        else:
+            rejected = header is not None and header.Complete         # the error response was sent
+            record.update(status=self.ErrorResponses.get(dispatch_status, (500,))[0] if rejected else None,
+                dispatch=dispatch_status)
+        record.update(timings.phases())
+        return json.dumps(record)
 
 class RequestReader(Task, Logged):
 
@@ -449,6 +1183,9 @@ class RequestReader(Task, Logged):
         try:
             #self.debug("started")
             self.Started = time.time()
+            timings = request.Timings
+            if timings is not None:
+                timings.ReadStarted = time.monotonic()
             csock.settimeout(self.Timeout) 
             error = False       
             if self.SocketWrapper is not None:
@@ -456,6 +1193,8 @@ class RequestReader(Task, Logged):
                     csock, ssl_info = self.SocketWrapper.wrap(self.Request.CSock)
                     self.Request.CSock = csock
                     self.Request.SSLInfo = ssl_info
+                    if timings is not None:
+                        timings.Handshake = time.monotonic()
                     self.debug("socket wrapped")
                 except Exception as e:
                     self.debug("Error wrapping socket: %s" % (e,))
@@ -463,9 +1202,17 @@ class RequestReader(Task, Logged):
             #self.debug("wrapped:", csock)
             if not error:
                 #print("no error")
-                header = HTTPHeader()
-                request_received, body = header.recv(csock)
+                header = self.Dispatcher.HeaderClass()
+                if request.RequestCount > 1:
+                    # persistent connection: wait for the next request for up to the idle timeout
+                    request_received, body = header.recv(csock, timeout=self.Dispatcher.IdleTimeout, buffered=request.Body)
+                else:
+                    request_received, body = header.recv(csock)
                 csock.settimeout(saved_timeout) 
+                request.Received = time.monotonic()
+                if timings is not None and header.Complete:
+                    timings.HeaderReceived = time.monotonic()
+                    timings.BytesIn = len(header.Raw) + 4
                 
                 if not request_received or not header.is_valid() or not header.is_client():
                     # header not received - end
@@ -475,6 +1222,12 @@ class RequestReader(Task, Logged):
                     #print("   header.is_client():", header.is_client())
                     #print("   header.Protocol:", header.Protocol)
                         
+                    if request.RequestCount > 1 and not header.Complete and not header.Buffer:
+                        # idle persistent connection closed by the client or timed out
+                        self.debug("persistent connection closed after %d requests" % (request.RequestCount - 1,))
+                        header = None
+                        dispatch_status = "closed"
+                        return None
                     self.debug("request not received or invalid or not client request: %s" % (request,))
                     if header.Error:
                         self.debug("request read error: %s" % (header.Error,))
@@ -484,28 +1237,26 @@ class RequestReader(Task, Logged):
                     request.HTTPHeader = header
                     request.Body = body
                     self.debug("request received")
+                    if timings is not None:
+                        timings.Dispatched = time.monotonic()
                     dispatched, service, dispatch_status = self.Dispatcher.dispatch(self.Request)
         finally:
             if not dispatched:
                 if header is not None and header.Complete:
                     #print("dispatch status:", dispatch_status)
-                    if dispatch_status == "no match":
-                        request.send_response(404, "Service not found")
-                    elif dispatch_status == "service unavailable":
-                        request.send_response(503, "Service unavailable")
-                    elif dispatch_status == "invalid request":
-                        request.send_response(400, "Invalid request")
-                    else:
-                        request.send_response(500, "Request dispatch error " + dispatch_status)
+                    request.reject(dispatch_status)
                     self.log('%s %s:%s :%s %s %s -> (%s)' % 
                         (   request.Id, request.CAddr[0], request.CAddr[1], request.ServerPort, 
                             header.Method, header.OriginalURI, dispatch_status
                         )
                     )
-                else:
+                elif dispatch_status != "closed":
                     self.log('%s:%s :%s (request reading error)' % 
                         (   request.CAddr[0], request.CAddr[1], request.ServerPort)
                     )
+                if request.Timings is not None and dispatch_status != "closed":
+                    request.Timings.Ended = time.monotonic()
+                    self.log(request.access_record(dispatch_status=dispatch_status, header=header), channel="access")
                 request.close()
                     
             self.SocketWrapper = self.Dispatcher = self.Logger = None
@@ -542,24 +1293,125 @@ class SSLSocketWrapper(object):
         ssl_socket = self.SSLContext.wrap_socket(sock, server_side=True)
         return ssl_socket, ssl_socket
 
+DefaultBacklog = 128
+
+def listen_socket(port, backlog=DefaultBacklog, reuse_port=False):
+    # reuse_port: several processes can listen on the same port with their own sockets, the kernel
+    # distributes incoming connections between them
+    sock = socket(AF_INET, SOCK_STREAM)
+    sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    if reuse_port:
+        if not hasattr(socket_module, "SO_REUSEPORT"):
+            raise ValueError("SO_REUSEPORT is not supported on this platform")
+        sock.setsockopt(SOL_SOCKET, socket_module.SO_REUSEPORT, 1)
+    sock.bind(('', port))
+    sock.listen(backlog)
+    return sock
+
+class ServiceDispatcher(object):
+
+    #
+    # Longest prefix match lookup of the services, compiled once from the service list.
+    # The service URI prefixes (the "Prefix" attribute) are stored in a trie of path segments. The prefix "/a/b/" ends at
+    # the node /a/b/, the prefix "/a/bc" is stored at the node /a/ as the partial segment "bc" and matches "/a/bcd/..." too,
+    # same as uri.startswith(prefix).
+    # For a request, the matching services are tried from the longest prefix to the shortest, services with the same prefix
+    # in the list order, until one of them accepts the request. Services without the Prefix attribute are tried last.
+    # The dispatcher is never modified, HTTPServer.setServices() replaces it as a whole.
+    #
+
+    class Node(object):
+
+        def __init__(self):
+            self.Children = {}          # segment -> Node
+            self.Services = []          # services with the prefix ending at this node
+            self.Partial = []           # [(partial segment, [service, ...]), ...], shorter segments first
+
+    def __init__(self, services):
+        self.Services = list(services)
+        self.Root = self.Node()
+        self.Other = []                 # services without prefix
+        partial = {}                    # node -> {segment: [service, ...]}
+        for service in self.Services:
+            prefix = getattr(service, "Prefix", None)
+            if prefix is None:
+                self.Other.append(service)
+                continue
+            segments = prefix.split("/")
+            node = self.Root
+            for segment in segments[:-1]:
+                child = node.Children.get(segment)
+                if child is None:
+                    child = node.Children[segment] = self.Node()
+                node = child
+            last = segments[-1]
+            if last:
+                partial.setdefault(node, {}).setdefault(last, []).append(service)
+            else:
+                node.Services.append(service)
+        for node, by_segment in partial.items():
+            node.Partial = sorted(by_segment.items(), key=lambda item: len(item[0]))
+
+    def candidates(self, uri):
+        parts = uri.split("/")
+        last = len(parts) - 1
+        matched = []                    # service lists, shorter prefixes first
+        node = self.Root
+        i = 0
+        while node is not None:
+            part = parts[i]
+            if node.Services:
+                matched.append(node.Services)
+            for segment, services in node.Partial:
+                if part.startswith(segment):
+                    matched.append(services)
+            if i == last:
+                break
+            node = node.Children.get(part)
+            i += 1
+        for services in reversed(matched):
+            yield from services
+        yield from self.Other
+
 class HTTPServer(PyThread, Logged):
 
+    # An idle persistent connection occupies a request reader thread and a max_connections slot
+    # until the client sends next request or idle_timeout expires, so keep-alive is opt-in here
+    DefaultKeepAlive = False
+    DefaultIdleTimeout = 2.0
+
     def __init__(self, port, app=None, services=[], sock=None, logger=None, max_connections = 100,
                 timeout = 20.0,
                 enabled = True, max_queued = 100,
-                logging = False, log_file = "-", debug=False,
+                keep_alive = None, idle_timeout = None, max_requests_per_connection = 100,
+                body_spool_threshold = None, header_parser = "buffered",
+                listen_backlog = DefaultBacklog, reuse_port = False,
+                queue_discipline = "fifo", request_deadline = None,
+                logging = False, log_file = "-", access_log = None, debug=False,
                 certfile=None, keyfile=None, verify="none", ca_file=None, password=None, allow_proxies=False, **pythread_kv
                 ):
         PyThread.__init__(self, **pythread_kv)
         self.Port = port
         self.Sock = sock
         assert self.Port is not None, "Port must be specified"
-        if logger is None and logging:
+        if logger is None and (logging or access_log):
             logger = Logger(log_file)
+            logger.Channels["log"].enable(logging)
             #print("logs sent to:", f)
+        if access_log and isinstance(logger, Logger) and "access" not in logger.Channels:
+            # JSON lines with the request timing breakdown, see RequestTimings
+            logger.add_channel("access", path=access_log, timestamps=False, show_who=False)
         Logged.__init__(self, f"[server {self.Port}]", logger=logger, debug=debug)
         self.Logger = logger
         self.Timeout = timeout
+        self.KeepAlive = self.DefaultKeepAlive if keep_alive is None else keep_alive
+        self.IdleTimeout = self.DefaultIdleTimeout if idle_timeout is None else idle_timeout
+        self.BodySpoolThreshold = body_spool_threshold
+        self.MaxRequestsPerConnection = max_requests_per_connection
+        self.ListenBacklog = listen_backlog
+        self.ReusePort = reuse_port
+        self.AccessLog = bool(access_log)          # collect request timings
+        self.HeaderClass = HeaderParsers[header_parser]         # "simple" - the original HTTPHeader parser
         max_connections =  max_connections
         queue_capacity = max_queued
         self.RequestReaderQueue = TaskQueue(max_connections, capacity=max_queued, delegate=self)
@@ -567,9 +1419,12 @@ class HTTPServer(PyThread, Logged):
                 allow_proxies=allow_proxies) if keyfile else None
         
         if app is not None:
-            services = [Service(app, logger=logger)]
+            services = [Service(app, logger=logger, queue_discipline=queue_discipline, request_deadline=request_deadline)]
             
         self.Services = services
+        self.Dispatcher = ServiceDispatcher(services)
+        self.RequestCounter = itertools.count(1)
+        self.RequestCount = 0           # requests received
         self.Stop = False
 
     def close(self):
@@ -581,13 +1436,23 @@ class HTTPServer(PyThread, Logged):
             pass
         self.Sock = None
 
-    @staticmethod
-    def from_config(config, services, logger=None, logging=False, log_file=None, debug=None):
+    @classmethod
+    def from_config(cls, config, services, logger=None, logging=False, log_file=None, debug=None):
         port = config["port"]
         
         timeout = config.get("timeout", 20.0)
         max_connections = config.get("max_connections", 100)
         queue_capacity = config.get("queue_capacity", 100)
+        keep_alive = config.get("keep_alive")
+        idle_timeout = config.get("idle_timeout")
+        max_requests_per_connection = config.get("max_requests_per_connection", 100)
+        body_spool_threshold = config.get("body_spool_threshold")
+        header_parser = config.get("header_parser", "buffered")
+        access_log = config.get("access_log")
+        listen_backlog = config.get("listen_backlog", DefaultBacklog)
+        reuse_port = config.get("reuse_port", False)
+        queue_discipline = config.get("queue_discipline", "fifo")
+        request_deadline = config.get("request_deadline")
 
         # TLS
         certfile = config.get("cert")
@@ -598,26 +1463,40 @@ class HTTPServer(PyThread, Logged):
         
         #print("HTTPServer.from_config: services:", services)
         
-        return HTTPServer(port, services=services, logger=logger, max_connections=max_connections,
+        return cls(port, services=services, logger=logger, max_connections=max_connections,
                 timeout = timeout, max_queued = queue_capacity, 
-                logging = logging, log_file=log_file, debug=debug,
+                keep_alive = keep_alive, idle_timeout = idle_timeout, 
+                max_requests_per_connection = max_requests_per_connection,
+                body_spool_threshold = body_spool_threshold, header_parser = header_parser,
+                listen_backlog = listen_backlog, reuse_port = reuse_port,
+                queue_discipline = queue_discipline, request_deadline = request_deadline,
+                logging = logging, log_file=log_file, access_log=access_log, debug=debug,
                 certfile=certfile, keyfile=keyfile, verify=verify, ca_file=ca_file, password=password
         )
     
     @synchronized
     def setServices(self, services):
+        # the dispatcher is replaced with a single assignment, so dispatch() does not need the lock
+        self.Dispatcher = ServiceDispatcher(services)
         self.Services = services
         
+    def drain(self):
+        # used after the server stopped accepting connections:
+        # closes persistent connections after the current requests and waits until all received requests are dispatched
+        self.KeepAlive = False
+        self.RequestReaderQueue.join()
+
     def connectionCount(self):
         return len(self.Connections)    
 
-    def run(self):
+    def listen(self):
         if self.Sock is None:
             # therwise use the socket supplied to the constructior
-            self.Sock = socket(AF_INET, SOCK_STREAM)
-            self.Sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-            self.Sock.bind(('', self.Port))
-            self.Sock.listen(10)
+            self.Sock = listen_socket(self.Port, self.ListenBacklog, self.ReusePort)
+        return self.Sock
+
+    def run(self):
+        self.listen()
         while not self.Stop:
             self.debug("--- accept loop port=%d start" % (self.Port,))
             csock = None
@@ -641,11 +1520,20 @@ class HTTPServer(PyThread, Logged):
         self.RequestReaderQueue.join()
 
     def connection_accepted(self, csock, caddr):        # called externally by multiserver
-        request = Request(self.Port, csock, caddr)
+        request = Request(self.Port, csock, caddr, server=self)
         self.debug("connection %s accepted from %s:%s" % (request.Id, caddr[0], caddr[1]))
         reader = RequestReader(self, request, self.SocketWrapper, self.Timeout, self)
         self.RequestReaderQueue << reader
         
+    def connection_reused(self, request):
+        # called by the request processor after the response was sent over a persistent connection
+        reader = RequestReader(self, request, None, self.Timeout, self)
+        try:
+            self.RequestReaderQueue.add(reader, timeout=0)
+        except RuntimeError:
+            # too many connections, do not wait for a reader slot
+            request.close()
+        
     @synchronized
     def stop(self):
         self.Stop = True
@@ -653,9 +1541,8 @@ class HTTPServer(PyThread, Logged):
         except: pass
 
     def dispatch(self, request):
-        with self:
-            services = self.Services[:]
-        for service in services:
+        self.RequestCount = next(self.RequestCounter)
+        for service in self.Dispatcher.candidates(request.HTTPHeader.URI):
             match, status = service.accept(request)
             if match:
                 return status == "accepted", service, status
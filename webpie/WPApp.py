@@ -1,12 +1,13 @@
 from .webob import Response
-from .webob.multidict import MultiDict
+from .webob.multidict import MultiDict, GetDict
 from .webob import Request as webob_request
 from .webob.exc import HTTPTemporaryRedirect, HTTPException, HTTPFound, HTTPForbidden, HTTPNotFound, HTTPBadRequest
 from . import Version as WebPieVersion
 from urllib.parse import unquote_plus, quote
 
-import os.path, os, stat, sys, traceback, fnmatch, datetime, inspect, json
-from threading import RLock
+import os.path, os, stat, sys, traceback, fnmatch, datetime, inspect, json, time, gzip
+from collections import OrderedDict
+from threading import RLock, local
 
 PY2 = sys.version_info[0] == 2
 PY3 = sys.version_info[0] == 3
@@ -106,23 +107,76 @@ def canonic_path(path):
         path = path[:-1]
     return path
 
+def split_query(query):
+    # splits the query string into a list of (name, value) pairs, without unquoting
+    # value is None for "name" without "="
+    pairs = []
+    for w in (query or "").split("&"):
+        if w:
+            k, eq, v = w.partition("=")
+            pairs.append((k, v if eq else None))
+    return pairs
+
+def query_pairs(environ, unquote=False):
+    # QUERY_STRING split into pairs, with values unquoted or not
+    # cached in the environ, so that the query string is parsed only once per request
+    query = environ.get("QUERY_STRING", "")
+    cached = environ.get("WebPie.query_pairs")
+    if cached is None or cached[0] != query:
+        cached = environ["WebPie.query_pairs"] = [query, split_query(query), None]
+    if not unquote:
+        return cached[1]
+    if cached[2] is None:
+        cached[2] = [(k, unquote_plus(v) if v else v) for k, v in cached[1]]
+    return cached[2]
+
+def query_dict(pairs):
+    # repeated arguments are collected into lists, arguments without name are ignored
+    out = {}
+    for k, v in pairs:
+        if not k:
+            continue
+        if k in out:
+            old = out[k]
+            if not isinstance(old, list):
+                old = out[k] = [old]
+            old.append(v)
+        else:
+            out[k] = v
+    return out
+
 class Request(webob_request):
     def __init__(self, *agrs, **kv):
         webob_request.__init__(self, *agrs, **kv)
         self.args = self.environ['QUERY_STRING']
-        self._response = Response()
+
+    @property
+    def GET(self):
+        env = self.environ
+        query = env.get("QUERY_STRING", "")
+        parsed = env.get("webob._parsed_query_vars")
+        if (parsed is None or parsed[1] != query) and ";" not in query:
+            # reuse the split query string, webob also splits it at ';'
+            data = [(unquote_plus(k), v or "") for k, v in query_pairs(env, unquote=True)]
+            env["webob._parsed_query_vars"] = (GetDict(data, env), query)
+        return webob_request.GET.fget(self)
 
     def write(self, txt):
-        self._response.write(txt)
+        self.getResponse().write(txt)
 
     def getResponse(self):
-        return self._response
+        # created on first use
+        try:
+            return self._response
+        except AttributeError:
+            response = self._response = Response()
+            return response
 
     def set_response_content_type(self, t):
-        self._response.content_type = t
+        self.getResponse().content_type = t
 
     def get_response_content_type(self):
-        return self._response.content_type
+        return self.getResponse().content_type
 
     def del_response_content_type(self):
         pass
@@ -211,10 +265,37 @@ def makeResponse(resp):
     if text is not None:  response.text = text
     return response
 
+class _RequestBound(object):
+    #
+    # WPHandler attribute holding per-request data (Request, AppURL).
+    # Handler trees shared by concurrent requests (WPApp(..., compile_routes=True)) keep the values per thread
+    #
+
+    def __init__(self, name):
+        self.Name = name
+
+    def __get__(self, handler, owner=None):
+        if handler is None:
+            return self
+        per_thread = handler.__dict__.get("_RequestLocal")
+        if per_thread is None:
+            return handler.__dict__.get(self.Name)
+        return getattr(per_thread, self.Name, None)
+
+    def __set__(self, handler, value):
+        per_thread = handler.__dict__.get("_RequestLocal")
+        if per_thread is None:
+            handler.__dict__[self.Name] = value
+        else:
+            setattr(per_thread, self.Name, value)
+
 class WPHandler(object):
 
     Version = ""
 
+    Request = _RequestBound("Request")
+    AppURL = _RequestBound("AppURL")
+
     _Strict = False
     _MethodNames = None
 
@@ -280,6 +361,31 @@ class WPHandler(object):
         # override me
         pass
 
+    def reset(self, request):
+        # override me
+        # called before a handler tree is reused for another request, when the app is created with reuse_handlers=True
+        pass
+
+    def _reset(self, request):
+        self.Request = request
+        self.Path = None
+        try:
+            self.AppURL = request.application_url
+        except:
+            self.AppURL = None
+        self.reset(request)
+
+    def _subhandlers(self, out=None, seen=None):
+        # returns flat list of this handler and all its subhandlers
+        if out is None:
+            out, seen = [], set()           # seen: ids of the handlers in out
+        out.append(self)
+        seen.add(id(self))
+        for o in self.__dict__.values():
+            if isinstance(o, WPHandler) and id(o) not in seen:
+                o._subhandlers(out, seen)
+        return out
+
     def initAtPath(self, path):
         # override me
         pass
@@ -445,15 +551,258 @@ class WPHandler(object):
         else:
             raise HTTPNotFound("invalid path: " + orig_path)
 
+class _RouteNode(object):
+
+    def __init__(self, handler, path):
+        self.Handler = handler
+        self.Path = path
+        self.Leaves = {}            # word -> web method, Response or tuple
+        self.Children = {}          # word -> _RouteNode
+
+class RouteTable(object):
+    #
+    # Dispatch table precompiled from a tree of WPHandler objects, used by WPApp(..., compile_routes=True)
+    # The handler objects are created once and shared by all requests. Their Request and AppURL attributes
+    # are bound to the current request per thread, other attributes must not keep per-request state.
+    # Words not found in the table are passed to WPHandler._handle_request of the deepest matched handler,
+    # so attributes added after the table was compiled are still found, the slow way.
+    # A callable root handler is called for all requests, as without the table.
+    #
+
+    def __init__(self, root_handler):
+        self.Handler = root_handler
+        self.PerThread = local()
+        for handler in root_handler._subhandlers():
+            handler._RequestLocal = self.PerThread
+        self.Root = None if callable(root_handler) else self.compile(root_handler, "", {})
+
+    def dispatch(self, request, path, path_down, args):
+        per_thread = self.PerThread
+        per_thread.Request = request
+        try:
+            per_thread.AppURL = request.application_url
+        except:
+            per_thread.AppURL = None
+        if self.Root is None:
+            return self.Handler(request, path, **args)
+        return self._handle_request(request, path_down, args)
+
+    def compile(self, handler, path, nodes):
+        node = nodes.get(id(handler))
+        if node is not None:
+            return node
+        node = nodes[id(handler)] = _RouteNode(handler, path)
+        handler.Path = path or "/"
+        for word in dir(handler):
+            try:
+                subhandler = getattr(handler, word)
+            except Exception:
+                continue            # e.g. a property which depends on the request
+            self.add(node, word, subhandler, not handler._Strict, nodes)
+        for word, method in handler._WebMethods.items():
+            if not hasattr(handler, word):
+                self.add(node, word, method, True, nodes)
+        return node
+
+    def add(self, node, word, subhandler, allowed, nodes):
+        # same rules as in WPHandler._handle_request
+        handler = node.Handler
+        if isinstance(subhandler, (Response, tuple)):
+            node.Leaves[word] = subhandler
+        elif callable(subhandler):
+            allowed = allowed and not word.startswith('_')
+            allowed = allowed or (
+                        (handler._MethodNames is not None
+                                and word in handler._MethodNames)
+                    or
+                        (hasattr(subhandler, "__doc__")
+                                and subhandler.__doc__ == _WebMethodSignature)
+            )
+            if allowed:
+                node.Leaves[word] = subhandler
+        elif isinstance(subhandler, WPHandler):
+            node.Children[word] = self.compile(subhandler, node.Path + "/" + word, nodes)
+
+    def _handle_request(self, request, path_down, args):
+        node = self.Root
+        i, n = 0, len(path_down)
+        while True:
+            start = i
+            word = ""
+            while i < n and not word:
+                word = path_down[i]
+                i += 1
+            if word:
+                if word in node.Leaves:
+                    leaf = node.Leaves[word]
+                    if isinstance(leaf, Response):
+                        return leaf
+                    elif isinstance(leaf, tuple):
+                        return makeResponse(leaf)
+                    return leaf(request, "/".join(path_down[i:]), **args)
+                child = node.Children.get(word)
+                if child is not None:
+                    node = child
+                    continue
+            return node.Handler._handle_request(request, node.Path, path_down[start:], args)
+
+class HandlerPool(object):
+    #
+    # Pool of reusable handler trees, used by WPApp(..., reuse_handlers=True)
+    # A tree is used by one request at a time and returned to the pool when the response is closed,
+    # so the pool grows up to the number of concurrently processed requests.
+    # The pool is one free list shared by all threads, not a pool per thread: the server runs each request
+    # in a new thread, so a per-thread pool would never be reused
+    #
+
+    def __init__(self, app, max_size=100):
+        self.App = app
+        self.MaxSize = max_size
+        self.Free = []                  # [(root handler, [all handlers in the tree]), ...]
+        self.Lock = RLock()
+
+    def get(self, request):
+        with self.Lock:
+            tree = self.Free.pop() if self.Free else None
+        if tree is None:
+            app = self.App
+            root = app.RootClass(request, app, *app.HandlerParams, **app.HandlerArgs)
+            tree = (root, root._subhandlers())
+        else:
+            for handler in tree[1]:
+                handler._reset(request)
+        return tree
+
+    def put(self, tree):
+        with self.Lock:
+            if len(self.Free) < self.MaxSize:
+                self.Free.append(tree)
+                return
+        root = tree[0]
+        root.destroy()
+        root._destroy()
+
+class _PooledResponseIterable(object):
+
+    def __init__(self, app_iter, release):
+        self.AppIter = app_iter
+        self.Release = release
+
+    def __iter__(self):
+        return iter(self.AppIter)
+
+    def close(self):
+        try:
+            if hasattr(self.AppIter, "close"):
+                self.AppIter.close()
+        finally:
+            release, self.Release = self.Release, None
+            if release is not None:
+                release()
+
+def static_etag(st):
+    # ETag of a static file, the same whether the file is served from the cache or not
+    return "%x-%x" % (st.st_mtime_ns, st.st_size)
+
+class StaticFile(object):
+
+    def __init__(self, path, st, body, mime_type, gzip_min_size):
+        self.Path = path
+        self.MTime = st.st_mtime_ns
+        self.Size = st.st_size
+        self.LastModified = int(st.st_mtime)
+        self.MimeType = mime_type
+        self.Body = body
+        self.ETag = static_etag(st)
+        self.GzipBody = None
+        if mime_type.startswith("text/") and len(body) >= gzip_min_size:
+            gzipped = gzip.compress(body, mtime=0)
+            if len(gzipped) < len(body):
+                self.GzipBody = gzipped
+        self.Checked = time.monotonic()
+
+    def memory(self):
+        return len(self.Body) + (len(self.GzipBody) if self.GzipBody is not None else 0)
+
+    def modified(self, st):
+        return st.st_mtime_ns != self.MTime or st.st_size != self.Size
+
+class StaticFileCache(object):
+    #
+    # Bounded LRU cache of small static files, shared by WPStaticHandler instances
+    # Entries are keyed by the requested path and revalidated with os.stat at most once every check_interval seconds
+    #
+
+    def __init__(self, max_memory=32*1024*1024, max_file_size=256*1024, check_interval=1.0, gzip_min_size=1024):
+        self.MaxMemory = max_memory
+        self.MaxFileSize = max_file_size
+        self.CheckInterval = check_interval
+        self.GzipMinSize = gzip_min_size
+        self.Entries = OrderedDict()        # requested path -> StaticFile
+        self.Memory = 0
+        self.Lock = RLock()
+
+    def get(self, key):
+        with self.Lock:
+            entry = self.Entries.get(key)
+            if entry is None:
+                return None
+            self.Entries.move_to_end(key)
+        now = time.monotonic()
+        if now >= entry.Checked + self.CheckInterval:
+            try:
+                st = os.stat(entry.Path)
+            except OSError:
+                st = None
+            if st is None or entry.modified(st):
+                self.remove(key, entry)
+                return None
+            entry.Checked = now
+        return entry
+
+    def load(self, key, path, st, mime_type):
+        # returns None if the file is too large to be cached
+        if st.st_size > self.MaxFileSize:
+            return None
+        with open(path, "rb") as f:
+            body = f.read()
+        if len(body) != st.st_size:
+            return None                     # the file is being modified
+        entry = StaticFile(path, st, body, mime_type, self.GzipMinSize)
+        with self.Lock:
+            old = self.Entries.pop(key, None)
+            if old is not None:
+                self.Memory -= old.memory()
+            self.Entries[key] = entry
+            self.Memory += entry.memory()
+            while self.Memory > self.MaxMemory and self.Entries:
+                _, old = self.Entries.popitem(last=False)
+                self.Memory -= old.memory()
+        return entry
+
+    def remove(self, key, entry=None):
+        with self.Lock:
+            if key in self.Entries and (entry is None or self.Entries[key] is entry):
+                self.Memory -= self.Entries.pop(key).memory()
+
+    def clear(self):
+        with self.Lock:
+            self.Entries.clear()
+            self.Memory = 0
+
+_StaticFileCache = StaticFileCache()
+
 class WPStaticHandler(WPHandler):
 
-    def __init__(self, request, app, root="static", default_file="index.html", cache_ttl=None):
+    def __init__(self, request, app, root="static", default_file="index.html", cache_ttl=None, cache=True):
+        # cache: True - use the cache shared by all static handlers, False or None - do not cache, or a StaticFileCache object
         WPHandler.__init__(self, request, app)
         self.DefaultFile = default_file
         if not (root.startswith(".") or root.startswith("/")):
             root = self.App.ScriptHome + "/" + root
         self.Root = root
         self.CacheTTL = cache_ttl
+        self.Cache = _StaticFileCache if cache is True else (cache or None)
 
     def __call__(self, request, relpath, **args):
 
@@ -464,8 +813,13 @@ class WPStaticHandler(WPHandler):
             self.redirect("./index.html")
 
         home = self.Root
-        path = os.path.join(home, relpath)
+        key = os.path.join(home, relpath)
 
+        entry = self.Cache.get(key) if self.Cache is not None else None
+        if entry is not None:
+            return self.cached_response(request, entry)
+
+        path = key
         if not os.path.exists(path):
             return Response("Not found", status=404)
 
@@ -476,32 +830,48 @@ class WPStaticHandler(WPHandler):
             #print "not a regular file"
             return Response("Not found", status=404)
 
-        mtime = os.path.getmtime(path)
-        mtime = datetime.datetime.utcfromtimestamp(mtime)
-
-        if "If-Modified-Since" in request.headers:
-            # <day-name>, <day> <month> <year> <hour>:<minute>:<second> GMT
-            dt_str = request.headers["If-Modified-Since"]
-            words = dt_str.split()
-            if len(words) == 6 and words[-1] == "GMT":
-                dt_str = " ".join(words[1:-1])      # keep only <day> <month> <year> <hour>:<minute>:<second>
-                dt = datetime.datetime.strptime(dt_str, '%d %b %Y %H:%M:%S')
-                if mtime < dt:
-                    return 304
-
-        size = os.path.getsize(path)
-
+        st = os.stat(path)
         ext = path.rsplit('.',1)[-1]
         mime_type = _MIME_TYPES_BASE.get(ext, "text/plain")
 
+        if self.Cache is not None:
+            entry = self.Cache.load(key, path, st, mime_type)
+            if entry is not None:
+                return self.cached_response(request, entry)
+
         def read_iter(f):
             while True:
                 data = f.read(8192)
                 if not data:    break
                 yield data
 
-        resp = Response(app_iter = read_iter(open(path, "rb")), content_length=size, content_type = mime_type)
-        #resp.headers["Last-Modified"] = mtime.strftime("%a, %d %b %Y %H:%M:%S GMT")
+        f = open(path, "rb")
+        file_wrapper = request.environ.get("wsgi.file_wrapper")
+        app_iter = file_wrapper(f, 65536) if file_wrapper is not None else read_iter(f)
+
+        # conditional_response handles If-None-Match, If-Modified-Since and Range
+        resp = Response(app_iter = app_iter, content_length=st.st_size, content_type = mime_type,
+                conditional_response=True)
+        resp.etag = static_etag(st)
+        resp.last_modified = int(st.st_mtime)
+        resp.accept_ranges = "bytes"
+        if self.CacheTTL is not None:
+            resp.cache_control.max_age = self.CacheTTL
+        return resp
+
+    def cached_response(self, request, entry):
+        body, etag = entry.Body, entry.ETag
+        if entry.GzipBody is not None:
+            if "Range" not in request.headers and "gzip" in request.headers.get("Accept-Encoding", ""):
+                body, etag = entry.GzipBody, etag + "-gzip"
+        resp = Response(body = body, content_type = entry.MimeType, conditional_response=True)
+        resp.etag = etag
+        resp.last_modified = entry.LastModified
+        resp.accept_ranges = "bytes"
+        if entry.GzipBody is not None:
+            resp.vary = ("Accept-Encoding",)
+            if body is entry.GzipBody:
+                resp.content_encoding = "gzip"
         if self.CacheTTL is not None:
             resp.cache_control.max_age = self.CacheTTL
         return resp
@@ -511,7 +881,7 @@ class WPApp(object):
     Version = "Undefined"
 
     def __init__(self, root_class_or_handler, strict=False, prefix=None, replace_prefix="",
-            environ={}, unquote_args=True):
+            environ={}, unquote_args=True, compile_routes=False, reuse_handlers=False):
 
         self.RootHandler = self.RootClass = None
         if inspect.isclass(root_class_or_handler):
@@ -529,6 +899,9 @@ class WPApp(object):
         self.HandlerArgs = {}
         self.Environ = environ
         self.UnquoteArgs = unquote_args
+        self.CompileRoutes = compile_routes     # create the handler tree once, with the first request, and dispatch requests using RouteTable
+        self.Routes = None
+        self.Handlers = HandlerPool(self) if reuse_handlers else None
 
     def match(self, uri):
         return not self.Prefix or uri.startswith(self.Prefix)
@@ -609,27 +982,22 @@ class WPApp(object):
     def handler_options(self, *params, **args):
         self.HandlerParams = params
         self.HandlerArgs = args
+        self.Routes = None              # will be compiled again with the new arguments
         return self
 
     def parseQuery(self, query):
-        out = {}
-        for w in (query or "").split("&"):
-            if w:
-                words = w.split("=", 1)
-                k = words[0]
-                if k:
-                    v = None
-                    if len(words) > 1:  v = unquote_plus(words[1]) if self.UnquoteArgs else words[1]
-                    if k in out:
-                        old = out[k]
-                        if not isinstance(old, list):
-                            old = out[k] = [old]
-                        old.append(v)
-                    else:
-                        out[k] = v
-        return out
-
-    def wsgi_call(self, root_handler, environ, start_response):
+        pairs = split_query(query)
+        if self.UnquoteArgs:
+            pairs = [(k, unquote_plus(v) if v else v) for k, v in pairs]
+        return query_dict(pairs)
+
+    def queryArgs(self, environ):
+        # uses the query string split once per request, unless parseQuery() is overridden by a subclass
+        if type(self).parseQuery is not WPApp.parseQuery:
+            return self.parseQuery(environ.get("QUERY_STRING", ""))
+        return query_dict(query_pairs(environ, unquote=self.UnquoteArgs))
+
+    def wsgi_call(self, root_handler, environ, start_response, destroy=True, request=None):
         path = canonic_path(environ.get('PATH_INFO', ''))
         #while "//" in path:
         #    path.replace("//", "/")
@@ -638,10 +1006,12 @@ class WPApp(object):
             path_down = path_down[1:]
         #while '' in path_down:
         #    path_down.remove('')
-        args = self.parseQuery(environ.get("QUERY_STRING", ""))
-        request = Request(environ)
+        args = self.queryArgs(environ)
+        request = request if request is not None else Request(environ)
         try:
-            if isinstance(root_handler, tuple):
+            if isinstance(root_handler, RouteTable):
+                response = root_handler.dispatch(request, path, path_down, args)
+            elif isinstance(root_handler, tuple):
                 response = makeResponse(root_handler)
             elif isinstance(root_handler, Response):
                 response = root_handler
@@ -664,7 +1034,7 @@ class WPApp(object):
         except ValueError as e:
             response = self.applicationErrorResponse(str(e), sys.exc_info())
         out = response(environ, start_response)
-        if isinstance(root_handler, WPHandler):
+        if destroy and isinstance(root_handler, WPHandler):
             root_handler.destroy()
             root_handler._destroy()
         return out
@@ -720,17 +1090,49 @@ class WPApp(object):
         environ["WebPie.path_replace_prefix"] = self.ReplacePrefix or None
         environ["WebPie.app_root_path"] = self.appRootPath()
 
-        root_handler = self.RootHandler or self.RootClass(req, self, *self.HandlerParams, **self.HandlerArgs)
+        if self.CompileRoutes:
+            root_handler = self.Routes or self.compileRoutes(req)
+        elif self.Handlers is not None and self.RootHandler is None:
+            return self.pooled_call(req, environ, start_response)
+        else:
+            root_handler = self.RootHandler or self.RootClass(req, self, *self.HandlerParams, **self.HandlerArgs)
         #print("root_handler:", root_handler)
 
         try:
-            out = self.wsgi_call(root_handler, environ, start_response)
+            out = self.wsgi_call(root_handler, environ, start_response, request=req)
             return out
         except:
             resp = self.applicationErrorResponse(
                 "Uncaught exception", sys.exc_info())
         return resp(environ, start_response)
 
+    def pooled_call(self, request, environ, start_response):
+        tree = None
+        try:
+            tree = self.Handlers.get(request)
+            out = self.wsgi_call(tree[0], environ, start_response, destroy=False, request=request)
+        except:
+            if tree is not None:
+                self.Handlers.put(tree)
+            resp = self.applicationErrorResponse(
+                "Uncaught exception", sys.exc_info())
+            return resp(environ, start_response)
+        file_wrapper = environ.get("wsgi.file_wrapper")
+        if isinstance(out, (list, tuple)) or inspect.isclass(file_wrapper) and isinstance(out, file_wrapper):
+            # the response body does not depend on the handlers, return them to the pool now
+            self.Handlers.put(tree)
+            return out
+        return _PooledResponseIterable(out, lambda: self.Handlers.put(tree))
+
+    @app_synchronized
+    def compileRoutes(self, request):
+        # called with the first request. The handler constructors get this request, but the tree is shared by all requests,
+        # the handlers see the current request through their Request and AppURL attributes
+        if self.Routes is None:
+            root = self.RootHandler or self.RootClass(request, self, *self.HandlerParams, **self.HandlerArgs)
+            self.Routes = RouteTable(root) if isinstance(root, WPHandler) else root
+        return self.Routes
+
     def init(self):
         # overraidable. will be called once after self.ScriptName, self.ScriptHome, self.Script are initialized
         # and app.externalPath() is ready to be used
@@ -1,7 +1,8 @@
 from .webob import Response, Request
-import time, os, pickle, logging, sys
+import time, os, pickle, logging, sys, sqlite3, zlib, threading
 from .WPApp import WPApp
 from threading import Thread, RLock
+from collections import OrderedDict
 import glob, uuid, hashlib
 
 _hash_algorithm = None
@@ -223,68 +224,164 @@ def parse_cookie_header(cookie_string, unquote=url_unquote):
             cookies[c.name] = c
     return cookies
 
+def session_synchronized(method):
+    # holds the lock of the session, whose id is the first argument of the method
+    def f(self, sid, *params, **args):
+        with self.lock(sid):
+            out = method(self, sid, *params, **args)
+        return out
+    return f
+
 class CleanerThread(Thread):
+    #
+    # Calls cleanUp() method of the session storage every cleanup_frequency seconds
+    # to remove expired sessions outside of the request processing threads
+    #
 
-    def __init__(self, data_root,
+    def __init__(self, storage,
                         cleanup_frequency,
-                        session_timeout,
-                        lock         
+                        session_timeout
         ):
-        Thread.__init__(self)
-        self.DataRoot = data_root
+        Thread.__init__(self, daemon=True)
+        self.Storage = storage
         self.CleanUpFrequency = cleanup_frequency
         self.SessionTimeout = session_timeout
-        self.Lock = lock
 
     def run(self):
         while True:
             time.sleep(self.CleanUpFrequency)
-            #print "Cleaner(%s) run. Session timeout=%d..." % (self.DataRoot, self.SessionTimeout)
-            with self.Lock:
-                try:
-                    dirs = os.walk(self.DataRoot)
-                    for path, subdirs, files in dirs:
-                        for f in files:
-                            f = path + '/' + f
-                            st = os.stat(f)
-                            if st.st_atime < time.time() - self.SessionTimeout:
-                                try:    
-                                    #print "Deleting %s. Access time=%s now=%s..." % (f, st.st_atime, time.time())
-                                    os.unlink(f)
-                                except:
-                                    print("Can not delete file %s: %s %s" % (
-                                            f, sys.exc_info()[0], sys.exc_info()[1])) 
-                except:
-                    print("Error in clean-up thread: %s %s" % (
-                            sys.exc_info()[0], sys.exc_info()[1])) 
-
-class SessionStorage:
+            try:
+                self.Storage.cleanUp()
+            except:
+                print("Error in clean-up thread: %s %s" % (
+                        sys.exc_info()[0], sys.exc_info()[1])) 
+
+class SessionSerializer(object):
+    #
+    # Pickles session data. Bulk values larger than compress_threshold bytes are compressed with zlib
+    # if compress_bulk is True. Compressed and uncompressed values are told apart by the first byte:
+    # zlib streams start with 'x', pickles of protocol 2 and above start with the PROTO opcode.
+    #
+
+    def __init__(self, protocol=min(5, pickle.HIGHEST_PROTOCOL), compress_bulk=False, compress_threshold=1024, compress_level=1):
+        self.Protocol = protocol
+        self.CompressBulk = compress_bulk
+        self.CompressThreshold = compress_threshold
+        self.CompressLevel = compress_level
+
+    def dumps(self, data, bulk=False):
+        out = pickle.dumps(data, self.Protocol)
+        if bulk and self.CompressBulk and len(out) > self.CompressThreshold:
+            out = zlib.compress(out, self.CompressLevel)
+        return out
+
+    def loads(self, data):
+        if data[:1] == b'x':
+            data = zlib.decompress(data)
+        return pickle.loads(data)
+
+DefaultSerializer = SessionSerializer()
+
+class SessionBackend(object):
+    #
+    # Session storage interface. Session data and bulk values are arbitrary picklable objects.
+    # Storage objects are shared by concurrently running requests and must be thread-safe.
+    #
+
+    def sessionExists(self, sid):
+        raise NotImplementedError()
+
+    def load(self, sid):
+        # returns None if the session does not exist
+        raise NotImplementedError()
+
+    def save(self, sid, data):
+        raise NotImplementedError()
+
+    def delete(self, sid):
+        # deletes the session data and its bulk values
+        raise NotImplementedError()
+
+    def rename(self, sid, new_sid):
+        # moves the session data and its bulk values to the new session id
+        raise NotImplementedError()
+
+    def bulkLoad(self, sid, key, default=None):
+        raise NotImplementedError()
+
+    def bulkSave(self, sid, key, value):
+        raise NotImplementedError()
+
+    def bulkDelete(self, sid, key):
+        raise NotImplementedError()
+
+class SessionStorage(SessionBackend):
+    #
+    # Stores each session in its own pickle file under root_path
+    #
 
     GlobalLock = RLock()
     Storages = {}               # root path -> storage object
+    NLocks = 64
 
     @staticmethod
     def storage(root_path, 
                         cleanup_frequency = 3600,   # 1/hour
-                        session_timeout = 24*3600   # 24 hours             
+                        session_timeout = 24*3600,  # 24 hours             
+                        **args                      # serializer, fsync
                         ):
         with SessionStorage.GlobalLock:
             if root_path not in SessionStorage.Storages:
                 SessionStorage.Storages[root_path] = SessionStorage(root_path, 
                         cleanup_frequency,
-                        session_timeout)
+                        session_timeout, **args)
             return SessionStorage.Storages[root_path]
 
     def __init__(self, root_path, 
-                        cleanup_frequency,
-                        session_timeout           
+                        cleanup_frequency = 3600,
+                        session_timeout = 24*3600,
+                        serializer = None,
+                        fsync = False               # fsync files before they replace the old versions
                         ):
         self.RootPath = root_path
         self.CleanUpFrequency = cleanup_frequency
         self.SessionTimeout = session_timeout
-        self.Lock = RLock()
-        self.CleanerThread = CleanerThread(root_path, self.CleanUpFrequency, self.SessionTimeout, self.Lock)
+        self.Serializer = serializer or DefaultSerializer
+        self.FSync = fsync
+        self.CreatedDirs = set()
+        self.Locks = [RLock() for _ in range(self.NLocks)]        # striped session locks
+        self.CleanerThread = CleanerThread(self, self.CleanUpFrequency, self.SessionTimeout)
         self.CleanerThread.start()
+
+    def lock(self, sid):
+        return self.Locks[hash(sid) % self.NLocks]
+
+    CleanUpBatchSize = 100
+    CleanUpBatchPause = 0.1             # seconds between batches
+
+    def cleanUp(self):
+        # removes expired session files. The storage tree is scanned incrementally, in batches of CleanUpBatchSize files,
+        # only the lock of the session being checked is held
+        nchecked = 0
+        for path, subdirs, files in os.walk(self.RootPath):
+            for f in files:
+                sid = f.split(":", 1)[0].split(".", 1)[0]
+                f = path + '/' + f
+                with self.lock(sid):
+                    try:
+                        st = os.stat(f)
+                    except OSError:
+                        continue
+                    if st.st_atime < time.time() - self.SessionTimeout:
+                        try:    
+                            #print "Deleting %s. Access time=%s now=%s..." % (f, st.st_atime, time.time())
+                            os.unlink(f)
+                        except:
+                            print("Can not delete file %s: %s %s" % (
+                                    f, sys.exc_info()[0], sys.exc_info()[1])) 
+                nchecked += 1
+                if nchecked % self.CleanUpBatchSize == 0:
+                    time.sleep(self.CleanUpBatchPause)
         
     def dataFilePath(self, sid):
         c1 = sid[-1]
@@ -297,30 +394,50 @@ class SessionStorage:
         return "%s/%s/%s/%s:%s.data" % (self.RootPath, c1, c2, 
                 sid, key)
 
-    @synchronized
+    def bulkFiles(self, sid):
+        # {key: path} of the bulk values of the session
+        prefix = self.bulkFilePath(sid, "")[:-len(".data")]
+        return {path[len(prefix):-len(".data")]: path for path in glob.glob(glob.escape(prefix) + "*.data")}
+
+    def createDir(self, dirpath):
+        if dirpath not in self.CreatedDirs:
+            try:
+                os.makedirs(dirpath, exist_ok=True)
+            except OSError:
+                # Path cannot be created. The error will be
+                # picked up later :)
+                pass
+            else:
+                self.CreatedDirs.add(dirpath)
+
+    @session_synchronized
     def sessionExists(self, sid):
         try:    os.stat(self.dataFilePath(sid))
         except OSError:
             return False
         return True
                 
-    def saveData(self, path, data):
+    def saveData(self, path, data, bulk=False):
         #print ("saveData:", type(data), data)
-        try:
-            os.makedirs(os.path.dirname(path))
-        except OSError:
-            # Path exists or cannot be created. The latter error will be
-            # picked up later :)
-            pass
+        data = self.Serializer.dumps(data, bulk)
+        self.createDir(os.path.dirname(path))
 
-        f = open(path, 'wb')
+        # write to a temporary file and rename it, so that readers, possibly in other processes, never see partial data
+        tmp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
         try:
-            pickle.dump(data, f)
-        finally:
-            f.close()
+            with open(tmp, 'wb') as f:
+                f.write(data)
+                if self.FSync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            # do not leave the partially written file behind, e.g. when the disk is full
+            try:    os.unlink(tmp)
+            except OSError: pass
+            raise
         #print "saveData(%s) done" % (path,)
 
-
     def loadData(self, path):
         try:
             f = open(path, 'rb')
@@ -328,40 +445,254 @@ class SessionStorage:
             return None
         try:
             try:
-                return pickle.load(f)
-            except (EOFError, IOError):
+                return self.Serializer.loads(f.read())
+            except (EOFError, IOError, pickle.UnpicklingError, zlib.error):
                 logging.exception("Could not read data from: %s" % (path,))
                 return None
         finally:
             f.close()
 
-    @synchronized
+    @session_synchronized
     def bulkLoad(self, sid, key, default=None):
         return self.loadData(self.bulkFilePath(sid, key))
         
-    @synchronized
+    @session_synchronized
     def bulkSave(self, sid, key, value):
-        self.saveData(self.bulkFilePath(sid, key), value)
+        self.saveData(self.bulkFilePath(sid, key), value, bulk=True)
         
-    @synchronized
+    @session_synchronized
     def bulkDelete(self, sid, key):
         try:    os.unlink(self.bulkFilePath(sid, key))
         except: pass
         
-    @synchronized
+    @session_synchronized
     def load(self, sid):
         return self.loadData(self.dataFilePath(sid))
         
-    @synchronized
+    @session_synchronized
     def save(self, sid, data):
         return self.saveData(self.dataFilePath(sid), data)
         
-    @synchronized
+    @session_synchronized
     def delete(self, sid):
-        try:    os.unlink(self.dataFilePath(sid))
-        except: pass
+        for path in [self.dataFilePath(sid)] + list(self.bulkFiles(sid).values()):
+            try:    os.unlink(path)
+            except: pass
+
+    @session_synchronized
+    def rename(self, sid, new_sid):
+        # new_sid is a freshly generated id, not known to other requests yet, so its lock is not needed
+        moves = [(self.dataFilePath(sid), self.dataFilePath(new_sid))] + \
+            [(path, self.bulkFilePath(new_sid, key)) for key, path in self.bulkFiles(sid).items()]
+        self.createDir(os.path.dirname(self.dataFilePath(new_sid)))
+        for path, new_path in moves:
+            try:    os.replace(path, new_path)
+            except FileNotFoundError:
+                pass
         
 
+class MemorySessionStorage(SessionBackend):
+    #
+    # Keeps sessions in memory of the server process, for single process servers.
+    # Sessions expire after session_timeout seconds without access. When there are more than max_sessions sessions,
+    # least recently used ones are removed. The data is stored pickled, so that concurrent requests
+    # do not share the same objects.
+    #
+
+    def __init__(self, max_sessions=10000, session_timeout=3600, serializer=None):
+        self.MaxSessions = max_sessions
+        self.SessionTimeout = session_timeout
+        self.Serializer = serializer or DefaultSerializer
+        self.Sessions = OrderedDict()       # sid -> [expiration time, pickled data, {key: pickled bulk value}]
+        self.Lock = RLock()
+
+    @synchronized
+    def entry(self, sid, create=False):
+        now = time.time()
+        entry = self.Sessions.get(sid)
+        if entry is not None and entry[0] < now:
+            del self.Sessions[sid]
+            entry = None
+        if entry is None:
+            if not create:
+                return None
+            entry = self.Sessions[sid] = [0, None, {}]
+            while len(self.Sessions) > self.MaxSessions:
+                self.Sessions.popitem(last=False)
+        else:
+            self.Sessions.move_to_end(sid)
+        entry[0] = now + self.SessionTimeout
+        return entry
+
+    def sessionExists(self, sid):
+        return self.entry(sid) is not None
+
+    def load(self, sid):
+        entry = self.entry(sid)
+        if entry is None or entry[1] is None:
+            return None
+        return self.Serializer.loads(entry[1])
+
+    def save(self, sid, data):
+        self.entry(sid, create=True)[1] = self.Serializer.dumps(data)
+
+    @synchronized
+    def delete(self, sid):
+        self.Sessions.pop(sid, None)
+
+    @synchronized
+    def rename(self, sid, new_sid):
+        entry = self.entry(sid)
+        if entry is not None:
+            del self.Sessions[sid]
+            self.Sessions[new_sid] = entry
+
+    def bulkLoad(self, sid, key, default=None):
+        entry = self.entry(sid)
+        value = entry[2].get(key) if entry is not None else None
+        return self.Serializer.loads(value) if value is not None else None
+
+    def bulkSave(self, sid, key, value):
+        self.entry(sid, create=True)[2][key] = self.Serializer.dumps(value, bulk=True)
+
+    def bulkDelete(self, sid, key):
+        entry = self.entry(sid)
+        if entry is not None:
+            entry[2].pop(key, None)
+
+class SQLiteSessionStorage(SessionBackend):
+    #
+    # Stores sessions in an SQLite database in WAL mode, so that the database file can be shared
+    # by several server processes, e.g. multiserver workers.
+    # Sessions expire after session_timeout seconds without access to their data or bulk values.
+    # Expired sessions are removed by a CleanerThread every cleanup_interval seconds.
+    #
+
+    TouchInterval = 60          # update session access time on load at most once a minute
+
+    def __init__(self, path, session_timeout=24*3600, cleanup_interval=600, busy_timeout=10.0, serializer=None):
+        self.Path = path
+        self.Serializer = serializer or DefaultSerializer
+        self.SessionTimeout = session_timeout
+        self.CleanUpInterval = cleanup_interval
+        self.BusyTimeout = busy_timeout
+        self.Lock = RLock()
+        self.Connections = []           # idle connections
+        self.PID = os.getpid()
+        db = self.connect()
+        try:
+            db.execute("pragma journal_mode=wal")
+            db.execute("""create table if not exists sessions (
+                    sid text primary key, data blob, accessed real)""")
+            db.execute("""create table if not exists bulk (
+                    sid text, key text, data blob, accessed real,
+                    primary key (sid, key))""")
+            db.execute("create index if not exists sessions_accessed on sessions(accessed)")
+            db.execute("create index if not exists bulk_accessed on bulk(accessed)")
+        finally:
+            db.close()
+        self.CleanerThread = CleanerThread(self, self.CleanUpInterval, self.SessionTimeout)
+        self.CleanerThread.start()
+
+    def connect(self):
+        db = sqlite3.connect(self.Path, timeout=self.BusyTimeout, isolation_level=None, check_same_thread=False)
+        db.execute("pragma synchronous=normal")
+        return db
+
+    def execute(self, sql, params=(), fetch=False):
+        return self.transaction([(sql, params)], fetch=fetch)
+
+    def transaction(self, statements, fetch=False):
+        # statements: [(sql, params), ...], executed atomically
+        # fetch: return the first row of the last statement
+        with self.Lock:
+            if self.PID != os.getpid():
+                # connections can not be used after fork
+                self.Connections = []
+                self.PID = os.getpid()
+            db = self.Connections.pop() if self.Connections else None
+        if db is None:
+            db = self.connect()
+        try:
+            if len(statements) > 1:
+                db.execute("begin")
+            for sql, params in statements:
+                cursor = db.execute(sql, params)
+            out = cursor.fetchone() if fetch else None
+            if len(statements) > 1:
+                db.execute("commit")
+        except:
+            db.close()
+            raise
+        with self.Lock:
+            self.Connections.append(db)
+        return out
+
+    def touch(self, sid, now):
+        # the session and its bulk values expire together
+        self.transaction([
+            ("update sessions set accessed=? where sid=?", (now, sid)),
+            ("update bulk set accessed=? where sid=?", (now, sid))
+        ])
+
+    def sessionExists(self, sid):
+        return self.execute("select 1 from sessions where sid=? and accessed>=?",
+                (sid, time.time() - self.SessionTimeout), fetch=True) is not None
+
+    def load(self, sid):
+        now = time.time()
+        row = self.execute("select data, accessed from sessions where sid=? and accessed>=?",
+                (sid, now - self.SessionTimeout), fetch=True)
+        if row is None:
+            return None
+        data, accessed = row
+        if accessed < now - self.TouchInterval:
+            self.touch(sid, now)
+        return self.Serializer.loads(data)
+
+    def save(self, sid, data):
+        now = time.time()
+        self.transaction([
+            ("insert or replace into sessions(sid, data, accessed) values(?,?,?)", (sid, self.Serializer.dumps(data), now)),
+            ("update bulk set accessed=? where sid=?", (now, sid))
+        ])
+
+    def delete(self, sid):
+        self.transaction([
+            ("delete from sessions where sid=?", (sid,)),
+            ("delete from bulk where sid=?", (sid,))
+        ])
+
+    def rename(self, sid, new_sid):
+        self.transaction([
+            ("update sessions set sid=? where sid=?", (new_sid, sid)),
+            ("update bulk set sid=? where sid=?", (new_sid, sid))
+        ])
+
+    def bulkLoad(self, sid, key, default=None):
+        now = time.time()
+        row = self.execute("select data, accessed from bulk where sid=? and key=? and accessed>=?",
+                (sid, key, now - self.SessionTimeout), fetch=True)
+        if row is None:
+            return None
+        data, accessed = row
+        if accessed < now - self.TouchInterval:
+            self.touch(sid, now)
+        return self.Serializer.loads(data)
+
+    def bulkSave(self, sid, key, value):
+        self.execute("insert or replace into bulk(sid, key, data, accessed) values(?,?,?,?)",
+                (sid, key, self.Serializer.dumps(value, bulk=True), time.time()))
+
+    def bulkDelete(self, sid, key):
+        self.execute("delete from bulk where sid=? and key=?", (sid, key))
+
+    def cleanUp(self):
+        # called by the CleanerThread
+        cutoff = time.time() - self.SessionTimeout
+        self.execute("delete from sessions where accessed<?", (cutoff,))
+        self.execute("delete from bulk where accessed<?", (cutoff,))
+
 class BulkProxy:
 
     def __init__(self, sess):
@@ -386,16 +717,22 @@ class BulkProxy:
         return self.Session.bulkDelete(key)
         
 class Session:
-    def __init__(self, storage_path, session_id, session_timeout):
-        self.Storage = SessionStorage.storage(storage_path, 
-                session_timeout=session_timeout)
+    def __init__(self, storage, session_id, session_timeout, **storage_args):
+        # storage: SessionBackend object or path to the SessionStorage directory
+        # storage_args: other SessionStorage arguments, used when the storage for the directory is created
+        if isinstance(storage, SessionBackend):
+            self.Storage = storage
+        else:
+            self.Storage = SessionStorage.storage(storage, 
+                    session_timeout=session_timeout, **storage_args)
+        # the session is stored only when its data is first written
         self.is_new = session_id == None
-        self.Data = None
+        self.Data = {} if self.is_new else None
+        self.ClientSessionID = session_id           # received from the client with the cookie
         self.SessionID = session_id or self.generateSessionID()
-        if not self.Storage.sessionExists(self.SessionID):
-            self.Data = {}
-            self.save()
         self.Changed = False
+        self.Stored = False                         # the session was written to the storage during this request
+        self.CookieSentID = None                    # session id sent to the client with Set-Cookie
                 
     @staticmethod
     def is_valid_id(s):
@@ -420,6 +757,7 @@ class Session:
         return self.Storage.bulkLoad(self.SessionID, key)
         
     def bulkSave(self, key, value):
+        self.Stored = True
         return self.Storage.bulkSave(self.SessionID, key, value)
         
     def bulkDelete(self, key):
@@ -430,14 +768,32 @@ class Session:
         return BulkProxy(self)
         
     def save(self):
-        self.Storage.save(self.SessionID, self.Data)
+        self.Storage.save(self.SessionID, self.data)
         self.Changed = False
+        self.Stored = True
         #print "Session saved"
 
     def saveIfChanged(self):
-        if self.Changed:
+        if self.Changed and self.SessionID is not None:
             self.save()
             self.Changed = False
+
+    def rotate(self):
+        """
+        move the session data and bulk values to a new session id, e.g. after login
+        """
+        data = self.data
+        new_sid = self.generateSessionID()
+        if self.SessionID is not None:
+            self.Storage.rename(self.SessionID, new_sid)
+        self.SessionID = new_sid
+        self.Data = data
+        self.save()
+
+    def cookieNeeded(self):
+        # the cookie is sent only if the client does not have the session id yet and the session is stored
+        return self.SessionID is not None and self.SessionID != self.ClientSessionID \
+            and (self.Stored or self.Changed)
         
     def load(self):
         self.Data = self.Storage.load(self.SessionID)
@@ -506,10 +862,16 @@ class WPSessionApp(WPApp):
 
     def __init__(self, root_class,
             session_storage = "/tmp", cookie_name = 'webpie_session_id',
-            domain = None, cookie_path = None,  session_timeout = 3600  # seconds
+            domain = None, cookie_path = None,  session_timeout = 3600,  # seconds
+            **storage_args
         ):
+        # session_storage: directory for SessionStorage files or a SessionBackend object,
+        #   e.g. MemorySessionStorage or SQLiteSessionStorage
+        # storage_args: passed to SessionStorage when session_storage is a directory, e.g. serializer, fsync,
+        #   cleanup_frequency. A SessionBackend object is used as is, its arguments are given to its constructor
         WPApp.__init__(self, root_class)
         self.SessionStorage = session_storage
+        self.StorageArgs = storage_args
         self.CookieName = cookie_name
         self.CookieDomain = domain
         self.CookiePath = cookie_path
@@ -538,35 +900,66 @@ class WPSessionApp(WPApp):
         # load session data
         #
         session = Session(self.SessionStorage, session_id, 
-                self.SessionLifetime)
+                self.SessionLifetime, **self.StorageArgs)
         environ["webpie.session"] = session
 
-        def my_start_response(status, headers):
-            _cookie_path = self.CookiePath
-            if _cookie_path is None:
-                _cookie_path = environ.get('SCRIPT_NAME')
-            if not _cookie_path:
-                _cookie_path = '/'
-            #print "SCRIPT_NAME=%s" % (environ.get('SCRIPT_NAME'),)
-            #print "_cookie_path=", _cookie_path
-            cookie = Cookie(
-                self.CookieName,
-                session.SessionID,
-                path=_cookie_path,
-                domain=self.CookieDomain,
-                http_only=True
-            )
-            #print "Cookie: %s" % (cookie,)
-            return start_response(
-                status,
-                list(headers) + [("Set-Cookie", str(cookie))]
-            )
+        def my_start_response(status, headers, *exc_info):
+            if session.cookieNeeded() or session.SessionID is None and session.ClientSessionID:
+                _cookie_path = self.CookiePath
+                if _cookie_path is None:
+                    _cookie_path = environ.get('SCRIPT_NAME')
+                if not _cookie_path:
+                    _cookie_path = '/'
+                #print "SCRIPT_NAME=%s" % (environ.get('SCRIPT_NAME'),)
+                #print "_cookie_path=", _cookie_path
+                if session.SessionID is None:
+                    # invalidated
+                    cookie = expire_cookie(self.CookieName, path=_cookie_path, domain=self.CookieDomain)
+                else:
+                    cookie = Cookie(
+                        self.CookieName,
+                        session.SessionID,
+                        path=_cookie_path,
+                        domain=self.CookieDomain,
+                        http_only=True
+                    )
+                    session.CookieSentID = session.SessionID
+                #print "Cookie: %s" % (cookie,)
+                headers = list(headers) + [("Set-Cookie", str(cookie))]
+            return start_response(status, headers, *exc_info)
 
         #print "Calling WebPieApp, request: %s %s" % (environ.get("REQUEST_METHOD"), environ.get("REQUEST_URI"))
         output = WPApp.__call__(self, environ, my_start_response)
         #print "Changed: %s" % (self.Session.Changed,)
         session.saveIfChanged()
-        return output
+        if isinstance(output, (list, tuple)):
+            return output
+        # streaming response: the handler may still use the session while the body is generated
+        return _SessionResponseIterable(output, session)
+
+class _SessionResponseIterable(object):
+    #
+    # Saves the session data changed while the response body was generated, when the response is closed.
+    # The cookie is sent with the response headers, so a session created, rotated or invalidated after
+    # the response has started is not sent to the client. Such new session is not saved.
+    #
+
+    def __init__(self, app_iter, session):
+        self.AppIter = app_iter
+        self.Session = session
+
+    def __iter__(self):
+        return iter(self.AppIter)
+
+    def close(self):
+        try:
+            if hasattr(self.AppIter, "close"):
+                self.AppIter.close()
+        finally:
+            session, self.Session = self.Session, None
+            if session is not None and session.SessionID is not None \
+                    and session.SessionID in (session.ClientSessionID, session.CookieSentID):
+                session.saveIfChanged()
         
         
         
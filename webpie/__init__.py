@@ -1,7 +1,8 @@
-from .WPApp import WPApp, WPHandler, app_synchronized, webmethod, atomic, WPStaticHandler, Response
-from .WPSessionApp import WPSessionApp
+from .WPApp import WPApp, WPHandler, app_synchronized, webmethod, atomic, WPStaticHandler, StaticFileCache, Response
+from .WPSessionApp import WPSessionApp, SessionBackend, SessionStorage, MemorySessionStorage, SQLiteSessionStorage, SessionSerializer
 from .uid import uid, init as init_uid
-from .HTTPServer import run_server, HTTPServer, RequestProcessor
+from .HTTPServer import run_server, HTTPServer, RequestProcessor, listen_socket
+from .AsyncHTTPServer import AsyncHTTPServer
 from .logs import Logger, Logged
 from .yaml_expand import yaml_expand
 from .Version import Version
@@ -11,6 +12,7 @@ from .sanitizers import sanitize
 __version__ = Version
 
 __all__ = [ "WPApp", "WPHandler", "Response", 
-	"WPSessionApp", "HTTPServer", "app_synchronized", "webmethod", "WPStaticHandler",
+	"WPSessionApp", "SessionBackend", "SessionStorage", "MemorySessionStorage", "SQLiteSessionStorage", "SessionSerializer",
+	"HTTPServer", "AsyncHTTPServer", "app_synchronized", "webmethod", "WPStaticHandler", "StaticFileCache",
     "Logged", "Logger", "yaml_expand", "Version", "http_exceptions" 
 ]
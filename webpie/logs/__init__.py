@@ -1,4 +1,4 @@
-from .logs import Logged, Logger, AbstractLogger, init
+from .logs import Logged, Logger, LogChannel, AbstractLogger, init
 from .log_file import LogFile, LogStream
 
 init_logger = init     # for backward compatibility
\ No newline at end of file
@@ -1,16 +1,43 @@
 import time, gzip, os.path
-import os, sys
+import os, sys, atexit
 import datetime
 from pythreader import PyThread, synchronized, Primitive, TaskQueue, Task
-from threading import Timer, Thread
+from threading import Timer, Thread, Condition
+
+class TimestampFormatter(object):
+    #
+    # Formats timestamps as "mm/dd/YYYY HH:MM:SS.mmm". The part up to the seconds is formatted
+    # with strftime once and reused until the second changes
+    #
+
+    def __init__(self):
+        self.Cached = (None, None)      # (whole seconds, formatted prefix)
+
+    def format(self, t=None):
+        if t is None:
+            t = time.time()
+        seconds = int(t)
+        microseconds = round((t - seconds)*1000000)      # rounded like datetime.fromtimestamp() does
+        if microseconds >= 1000000:
+            seconds += 1
+            microseconds -= 1000000
+        cached_seconds, prefix = self.Cached
+        if seconds != cached_seconds:
+            prefix = time.strftime("%m/%d/%Y %H:%M:%S", time.localtime(seconds))
+            self.Cached = (seconds, prefix)
+        return "%s.%03d" % (prefix, microseconds//1000)
+
+_Timestamps = TimestampFormatter()
 
 def make_timestamp(t=None):
-    if t is None:   
-        t = datetime.datetime.now()
-    elif isinstance(t, (int, float)):
-        t = datetime.datetime.fromtimestamp(t)
+    if t is None or isinstance(t, (int, float)):
+        return _Timestamps.format(t)
     return t.strftime("%m/%d/%Y %H:%M:%S") + ".%03d" % (t.microsecond//1000)
 
+def next_midnight(t):
+    d = datetime.date.fromtimestamp(t) + datetime.timedelta(days=1)
+    return time.mktime(d.timetuple())
+
 class LogWriter(Primitive):
     
     def __init__(self, name=None):
@@ -51,11 +78,61 @@ class CompressTask(Task):
 
 _CompressQueue = TaskQueue(5)
 
+class BackgroundWriter(Thread):
+    #
+    # Collects messages logged to a LogFile in background mode and has the LogFile write them in batches,
+    # when batch_size bytes are queued or every flush_interval seconds
+    #
+
+    def __init__(self, log_file, batch_size, flush_interval):
+        Thread.__init__(self, name=f"BackgroundWriter({log_file.Path})", daemon=True)
+        self.LogFile = log_file
+        self.BatchSize = batch_size
+        self.FlushInterval = flush_interval
+        self.Queue = []                 # [(msg, raw, t), ...]
+        self.QueuedSize = 0
+        self.Condition = Condition()
+        self.Stop = False
+
+    def add(self, msg, raw, t):
+        with self.Condition:
+            self.Queue.append((msg, raw, t))
+            self.QueuedSize += len(msg)
+            if self.QueuedSize >= self.BatchSize:
+                self.Condition.notify()
+
+    def take(self):
+        with self.Condition:
+            batch, self.Queue, self.QueuedSize = self.Queue, [], 0
+        return batch
+
+    def run(self):
+        while True:
+            with self.Condition:
+                if not self.Stop and self.QueuedSize < self.BatchSize:
+                    self.Condition.wait(self.FlushInterval)
+                stop = self.Stop
+            try:
+                self.LogFile.drain()
+            except Exception as e:
+                sys.stderr.write("Error writing log file %s: %s\n" % (self.LogFile.Path, e))
+            if stop:
+                break
+
+    def stop(self):
+        with self.Condition:
+            self.Stop = True
+            self.Condition.notify()
+        self.join()
+
 class LogFile(LogWriter):
     
         def __init__(self, path, interval = '1d', keep = 10, compress_from = 1, add_timestamp=True, 
-                        append=True, flush_interval=None, name=None):
+                        append=True, flush_interval=None, name=None, background=False, batch_size=64*1024):
             # interval = 'midnight' means roll over at midnight
+            # background = True: log() only queues the message and a background thread writes them in batches
+            #   of batch_size bytes or every flush_interval seconds (default 0.5). Queued messages are written
+            #   when the LogFile is closed or the program exits.
             LogWriter.__init__(self, name=f"LogFile({path})")
             self.File = None
             assert isinstance(path, str), "LogFile.__init__: path must be a string. Got %s %s instead" % (type(path), path) 
@@ -79,7 +156,7 @@ class LogFile(LogWriter):
             self.Keep = keep
             self.AddTimestamps = add_timestamp
             self.LineBuf = ''
-            self.LastLog = None
+            self.NextRollOver = None
             self.LastFlush = time.time()
             self.CompressFrom = compress_from
             append = append and os.path.isfile(self.Path)
@@ -87,10 +164,16 @@ class LogFile(LogWriter):
                 self.File = open(self.Path, 'a')
                 self.File.write("%s: --- log reopened ---\n" % (make_timestamp(),))
                 self.CurLogBegin = time.time()
+                self.setNextRollOver()
             else:
                 self.newLog()
             #print("LogFile: created with file:", self.File)
-            if flush_interval is not None:
+            self.Writer = None
+            if background:
+                self.Writer = BackgroundWriter(self, batch_size, flush_interval or 0.5)
+                self.Writer.start()
+                atexit.register(self.close)
+            elif flush_interval is not None:
                 self.arm_flush_timer(flush_interval)
                 
         def newLog(self):
@@ -118,22 +201,75 @@ class LogFile(LogWriter):
                     pass
             self.File = open(self.Path, 'w')
             self.CurLogBegin = time.time()
+            self.setNextRollOver()
             if self.CompressFrom is not None:
                 to_compress = '%s.%d' % (self.Path, self.CompressFrom)
                 _CompressQueue << CompressTask(to_compress)
 
-        @synchronized
         def log(self, msg, raw=False, t=None):
+            # messages logged after close() are discarded
             if t is None:   t = time.time()
+            if self.Writer is not None:
+                self.Writer.add(msg, raw, t)
+            else:
+                self._log(msg, raw, t)
+
+        @synchronized
+        def _log(self, msg, raw, t):
+            if self.File is None:
+                return                  # closed
+            self.rollOver(t)
+            self._write(self.format(msg, raw, t))
+
+        def rollOver(self, t):
+            if self.rolloverNeeded(t):
+                self.newLog()
+
+        def setNextRollOver(self):
             if self.Interval == 'midnight':
-                if datetime.date.today() != self.LastLog:
-                        self.newLog()
+                self.NextRollOver = next_midnight(self.CurLogBegin)
             elif isinstance(self.Interval, (int, float)):
-                if t > self.CurLogBegin + self.Interval:
-                    self.newLog()
+                self.NextRollOver = self.CurLogBegin + self.Interval
+            else:
+                self.NextRollOver = None
+
+        def rolloverNeeded(self, t):
+            if self.NextRollOver is None:
+                return False
+            if t is False:
+                t = time.time()
+            return t >= self.NextRollOver
+
+        def format(self, msg, raw, t):
             if t != False and not raw:
                 msg = "%s: %s" % (make_timestamp(t), msg)
-            self._write(msg if raw else msg + "\n")
+            return msg if raw else msg + "\n"
+
+        @synchronized
+        def drain(self):
+            # writes messages queued in background mode with one write() per log file
+            batch = self.Writer.take() if self.Writer is not None else None
+            if batch and self.File is not None:
+                parts = []
+                for msg, raw, t in batch:
+                    if self.rolloverNeeded(t):
+                        self.File.write("".join(parts))
+                        parts = []
+                        self.newLog()
+                    parts.append(self.format(msg, raw, t))
+                self.File.write("".join(parts))
+                self.File.flush()
+
+        def close(self):
+            writer = self.Writer
+            if writer is not None:
+                writer.stop()           # writes queued messages
+                self.Writer = None
+                atexit.unregister(self.close)
+            with self:
+                if self.File is not None:
+                    self.File.close()
+                    self.File = None
 
         @synchronized
         def write(self, msg):
@@ -145,7 +281,6 @@ class LogFile(LogWriter):
                 #print("LogFile.write: writing to:", self.File)
                 self.File.write(msg)
             self.flush()
-            self.LastLog = datetime.date.today()
 
         def arm_flush_timer(self, interval):
             if interval:
@@ -153,10 +288,12 @@ class LogFile(LogWriter):
                     
         @synchronized
         def flush(self, interval=None):
+            if self.Writer is not None:
+                self.drain()
             if self.File is not None:
                 self.File.flush()
-            if interval:
-                self.arm_flush_timer(interval)
+                if interval:
+                    self.arm_flush_timer(interval)
                 
         def start(self):
             # for compatibility with clients, which think LogFile is a thread
@@ -6,9 +6,11 @@ DefaultLogger = None
 
 class LogChannel(object):
     
-    def __init__(self, output, label=None, enabled=True, timestamps=True):
+    def __init__(self, output, label=None, enabled=True, timestamps=True, show_who=True):
+        # show_who=False: messages are written as is, without the originator, e.g. JSON lines
         assert output is not None
         self.Timestamps = timestamps
+        self.ShowWho = show_who
         self.Writer = log_writer(output)
         self.Label = label
         self.Enabled = enabled
@@ -23,7 +25,7 @@ class LogChannel(object):
             label = label or self.Label
             if label is not None:
                 message = f"[{label}] {message}"
-            if who:
+            if who and self.ShowWho:
                 message = f"{who}: {message}"
             if not self.Timestamps: t = False
             self.Writer.log(message, t=t)
@@ -36,23 +38,24 @@ class AbstractLogger(object):
 
 class Logger(AbstractLogger):
 
-    def __init__(self, log_path, error_path=None, debug_path=None, debug=True, append=True):
+    def __init__(self, log_path, error_path=None, debug_path=None, debug=True, append=True, background=False):
+        # background=True: log files are written by a background thread, see LogFile
         self.Debug = debug
-        writer = log_writer(log_path, append=append)
+        writer = log_writer(log_path, append=append, background=background)
         
         # default channels
         self.Channels = {       
             "log":      LogChannel(writer),
-            "error":    LogChannel(writer if error_path is None else log_writer(error_path, append=append), label="ERROR")
+            "error":    LogChannel(writer if error_path is None else log_writer(error_path, append=append, background=background), label="ERROR")
         }
         if debug:
-            self.Channels["debug"] = LogChannel(writer if debug_path is None else log_writer(debug_path, append=append), label="DEBUG")
+            self.Channels["debug"] = LogChannel(writer if debug_path is None else log_writer(debug_path, append=append, background=background), label="DEBUG")
 
-    def add_channel(self, name, path=None, print_label=False, timestamps=True, **params):
+    def add_channel(self, name, path=None, print_label=False, timestamps=True, show_who=True, **params):
         if path:    
             channel = LogChannel(log_out if path is None else log_writer(path, **params), 
                 label = name if print_label else None,
-                timestamps = timestamps
+                timestamps = timestamps, show_who = show_who
                 )
         else:
             channel = self.Channels["log"]